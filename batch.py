@@ -0,0 +1,262 @@
+"""
+Headless batch compositing, e.g. to re-render a whole event with new tolerances or a new reference image
+
+Does not need wx or a display. Each photo is composited with the background assigned to it, taken either
+from the names of existing compound images (C1234567___Background123.JPG) or from a mapping file.
+Finished photos are recorded in a manifest in the output directory, so an interrupted run can be resumed
+by starting it again with the same arguments.
+
+Example:
+    python batch.py /photos/eye-fi -b /greenie/backgrounds -r /greenie/reference.jpg \\
+        --compounds /greenie/compound -o /greenie/rerendered --tol 25 35
+"""
+
+import argparse
+import csv
+import hashlib
+import multiprocessing
+import os
+import signal
+import sys
+import time
+import traceback
+from os import path
+
+import numpy as np
+from PIL import Image
+
+import caching
+import compoundindex
+import greenscreen
+import watcher
+
+ManifestFileName = "batch_manifest.txt"
+
+# keying parameters and caches of a worker process, set up by InitWorker()
+_worker = {}
+
+
+def FindPhotos(photoDirs):
+    """ Return list of photo paths in the given directories """
+    photos = []
+    for d in photoDirs:
+        photos += [path.join(d, n) for n in sorted(os.listdir(d)) if watcher.IsPhotoFile(n)]
+    return photos
+
+
+def AssignmentsFromCompounds(compoundImagesDir):
+    """
+    Background assignment from the names of existing compound images
+
+    Returns:
+        dict: photo stem (see compoundindex.PhotoStem) -> background image name
+    """
+    assignments = {}
+    mtimes = {}
+    for name in os.listdir(compoundImagesDir):
+        parsed = compoundindex.ParseCompoundImageName(name)
+        if parsed is None:
+            continue
+        stem, BGImageName = parsed
+        # should there be several compound images of a photo, the newest one counts
+        mtime = path.getmtime(path.join(compoundImagesDir, name))
+        if stem not in mtimes or mtime > mtimes[stem]:
+            assignments[stem] = BGImageName
+            mtimes[stem] = mtime
+    return assignments
+
+
+def AssignmentsFromMapping(mappingPath):
+    """
+    Background assignment from a CSV file with lines 'photo file name, background file name'
+
+    Returns:
+        dict: photo stem (see compoundindex.PhotoStem) -> background image name
+    """
+    assignments = {}
+    with open(mappingPath, "rb") as f:
+        for row in csv.reader(f):
+            if len(row) == 0 or row[0].strip().startswith("#"):
+                continue
+            if len(row) != 2:
+                raise ValueError("%s: expected 'photo, background', got %s" % (mappingPath, ",".join(row)))
+            assignments[compoundindex.PhotoStem(path.basename(row[0].strip()))] = row[1].strip()
+    return assignments
+
+
+def JobKey(FGImagePath, BGImagePath, refColors, tolA, tolB, useLUT, filterRadius=1):
+    """ Identifies inputs and parameters of a rendered photo, so changed ones are rendered again on resume """
+    h = hashlib.sha1()
+    h.update(repr((caching.FileStateKey(FGImagePath), caching.FileStateKey(BGImagePath),
+                   float(tolA), float(tolB), bool(useLUT), int(filterRadius))))
+    h.update(np.asarray(refColors[0], dtype=np.uint8).tobytes())
+    h.update(np.asarray(refColors[1], dtype=np.uint8).tobytes())
+    return h.hexdigest()
+
+
+def ReadManifest(outputDir):
+    """ Return dict: compound image name -> job key of the photos finished by previous runs """
+    manifest = {}
+    manifestPath = path.join(outputDir, ManifestFileName)
+    if path.exists(manifestPath):
+        with open(manifestPath) as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) == 2:
+                    manifest[fields[0]] = fields[1]
+    return manifest
+
+
+def InitWorker(refColors, tolA, tolB, useLUT, filterRadius, backgroundStoreSize):
+    # interrupts are handled by the main process
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    _worker["refColors"] = refColors
+    _worker["tol"] = (tolA, tolB)
+    _worker["filterRadius"] = filterRadius
+    _worker["alphaLUT"] = greenscreen.MakeAlphaLUT(refColors[1], tolA=tolA, tolB=tolB) if useLUT else None
+    # most backgrounds are used for many photos
+    _worker["backgrounds"] = caching.BackgroundStore(backgroundStoreSize)
+
+
+def RenderJob(job):
+    """
+    Composite one photo and write it atomically; runs in a worker process
+
+    Returns:
+        (job, error): error is None on success, else the formatted exception
+    """
+    FGImagePath, BGImagePath, outPath, _ = job
+    try:
+        fgImage = Image.open(FGImagePath)
+        bgNp = _worker["backgrounds"].Get(BGImagePath, fgImage.size)
+        tolA, tolB = _worker["tol"]
+        compoundImage = greenscreen.Overlay(fgImage, bgNp, _worker["refColors"], tolA=tolA, tolB=tolB,
+                                            alphaLUT=_worker["alphaLUT"], filterRadius=_worker["filterRadius"])
+        tmpPath = outPath + ".tmp"
+        compoundImage.save(tmpPath, "JPEG")
+        os.rename(tmpPath, outPath)
+        return job, None
+    except Exception:
+        return job, traceback.format_exc()
+
+
+def MakeJobs(photos, assignments, BGImagesDir, outputDir, refColors, tolA, tolB, useLUT, defaultBackground=None,
+             filterRadius=1):
+    """
+    Return (jobs, skipped): jobs are (photo path, background path, output path, job key) tuples,
+    skipped lists (photo path, reason) for photos that cannot be rendered
+    """
+    jobs = []
+    skipped = []
+    for FGImagePath in photos:
+        FGImageName = path.basename(FGImagePath)
+        BGImageName = assignments.get(compoundindex.PhotoStem(FGImageName), defaultBackground)
+        if BGImageName is None:
+            skipped.append((FGImagePath, "no background assigned"))
+            continue
+        BGImagePath = path.join(BGImagesDir, BGImageName)
+        if not path.exists(BGImagePath):
+            skipped.append((FGImagePath, "background %s not found" % BGImagePath))
+            continue
+        outPath = path.join(outputDir, compoundindex.CompoundImageName(FGImageName, BGImageName))
+        jobs.append((FGImagePath, BGImagePath, outPath,
+                     JobKey(FGImagePath, BGImagePath, refColors, tolA, tolB, useLUT, filterRadius)))
+    return jobs, skipped
+
+
+def RunBatch(jobs, outputDir, refColors, tolA, tolB, useLUT=False, filterRadius=1, nProcesses=None,
+             backgroundStoreSize=256 * 2 ** 20, log=sys.stdout):
+    """
+    Render jobs from MakeJobs() on a process pool, skipping those finished by an earlier run
+
+    Returns:
+        list: (job, error) of failed jobs
+    """
+    manifest = ReadManifest(outputDir)
+    todo = [job for job in jobs
+            if manifest.get(path.basename(job[2])) != job[3] or not path.exists(job[2])]
+    if len(todo) < len(jobs):
+        log.write("%d of %d photos already done, resuming\n" % (len(jobs) - len(todo), len(jobs)))
+    if len(todo) == 0:
+        return []
+
+    failed = []
+    pool = multiprocessing.Pool(nProcesses, InitWorker,
+                                (refColors, tolA, tolB, useLUT, filterRadius, backgroundStoreSize))
+    startTime = time.time()
+    try:
+        with open(path.join(outputDir, ManifestFileName), "a") as manifestFile:
+            results = pool.imap_unordered(RenderJob, todo)
+            for nDone in range(1, len(todo) + 1):
+                # waiting with a timeout keeps the main process responsive to Ctrl-C
+                job, error = results.next(timeout=24 * 3600)
+                name = path.basename(job[2])
+                if error is None:
+                    manifestFile.write("%s %s\n" % (name, job[3]))
+                    manifestFile.flush()
+                else:
+                    failed.append((job, error))
+                elapsed = time.time() - startTime
+                remaining = elapsed / nDone * (len(todo) - nDone)
+                log.write("[%d/%d] %s %s, %.1f s elapsed, %.1f s remaining\n" % (
+                    nDone, len(todo), name, "done" if error is None else "FAILED", elapsed, remaining))
+                log.flush()
+        pool.close()
+    except:
+        # also on Ctrl-C; finished photos are in the manifest
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    return failed
+
+
+def Main(argv=None):
+    parser = argparse.ArgumentParser(description="Composite green screen photos without the GUI")
+    parser.add_argument("photoDirs", nargs="+", help="directories containing foreground photos")
+    parser.add_argument("-b", "--backgrounds", required=True, help="directory containing background images")
+    parser.add_argument("-r", "--reference", required=True, help="image of the empty green screen")
+    parser.add_argument("-o", "--output", required=True, help="directory for the compound images")
+    assignment = parser.add_mutually_exclusive_group(required=True)
+    assignment.add_argument("--compounds", help="take background assignment from compound images in this directory")
+    assignment.add_argument("--mapping", help="take background assignment from CSV file 'photo, background'")
+    parser.add_argument("--default-background",
+                        help="background for photos without assignment (default: skip those photos)")
+    parser.add_argument("--tol", nargs=2, type=float, default=[30., 40.], metavar=("A", "B"),
+                        help="keying tolerances, see greenscreen.Overlay (default: 30 40)")
+    parser.add_argument("--lut", action="store_true", help="use the CbCr lookup table for keying")
+    parser.add_argument("--filter-radius", type=int, default=1, metavar="R",
+                        help="radius of the mask smoothing filter, 0 to disable (default: 1)")
+    parser.add_argument("-j", "--processes", type=int, default=multiprocessing.cpu_count(),
+                        help="number of worker processes (default: number of CPUs)")
+    args = parser.parse_args(argv)
+
+    if not path.isdir(args.output):
+        os.makedirs(args.output)
+    if args.compounds is not None:
+        assignments = AssignmentsFromCompounds(args.compounds)
+    else:
+        assignments = AssignmentsFromMapping(args.mapping)
+    refColors = greenscreen.GetRefColor(Image.open(args.reference))
+    tolA, tolB = args.tol
+
+    jobs, skipped = MakeJobs(FindPhotos(args.photoDirs), assignments, args.backgrounds, args.output,
+                             refColors, tolA, tolB, args.lut, args.default_background, args.filter_radius)
+    for FGImagePath, reason in skipped:
+        print "Skipping %s: %s" % (FGImagePath, reason)
+    try:
+        failed = RunBatch(jobs, args.output, refColors, tolA, tolB, useLUT=args.lut, filterRadius=args.filter_radius,
+                          nProcesses=args.processes)
+    except KeyboardInterrupt:
+        print "Interrupted, run again with the same arguments to resume"
+        return 130
+    for job, error in failed:
+        print "Error compositing %s:\n%s" % (job[0], error)
+    if len(failed) > 0:
+        print "%d of %d photos failed" % (len(failed), len(jobs))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(Main())
@@ -0,0 +1,484 @@
+"""
+Benchmarks of the compositing pipeline on synthetic green screen photos
+
+Synthetic foregrounds (two guests in front of an unevenly lit green screen, with soft edges and green spill),
+reference plates and backgrounds are generated at 6, 24 and 50 MP and stored as JPEG files in a fixtures
+directory, so later runs re-use them. Each stage is run in a fresh process, so its peak memory can be
+measured from the process's maximum resident set size:
+
+    decode       JPEG decoding of the foreground
+    decode_cached  reading the decoded foreground from a caching.DecodedFrameCache
+    ycbcr        greenscreen.ImageToYCbCrNumpy() of the foreground
+    refcolor     greenscreen.GetRefColor() of the reference plate
+    keying       greenscreen.KeyForeground()
+    compositing  KeyedForeground.Composite() onto the background
+    overlay      greenscreen.Overlay(), keying and compositing in one pass
+    jpeg         JPEG encoding of the compound image
+    end_to_end   GreenieGUI.MakeCompoundImage() from the files on disk up to the saved compound image,
+                 with a stand-in for wx and cold caches; the reference colors are known, as in the booth
+    recomposite  like end_to_end, but with the photo already in the decoded frame cache, as when
+                 a guest tries another background after the keyed photo has left the layer cache
+
+Results are written as JSON. Given a baseline from an earlier run, stages that became slower or need more
+memory than the tolerances allow are reported and the run fails.
+
+Example:
+    python benchmark.py -o before.json
+    python benchmark.py --baseline before.json --sizes 6MP 24MP
+"""
+
+import argparse
+import gc
+import io
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import types
+from os import path
+
+import numpy as np
+import PIL
+from PIL import Image
+
+import greenscreen
+
+# fixture sizes (width, height)
+FixtureSizes = {"6MP": (3000, 2000), "24MP": (6000, 4000), "50MP": (8688, 5792)}
+# part of the fixture file names; changing how fixtures are generated requires a new version
+FixtureVersion = 1
+Stages = ["decode", "decode_cached", "ycbcr", "refcolor", "keying", "compositing", "overlay", "jpeg", "end_to_end",
+          "recomposite"]
+ResultsVersion = 1
+
+ScreenColor = np.array([45, 170, 70], dtype=np.float32)
+
+
+def _Grid(width, height):
+    """ Normalized x and y coordinates of pixel centers, 0..1 """
+    x = (np.arange(width, dtype=np.float32) + 0.5) / width
+    y = (np.arange(height, dtype=np.float32) + 0.5) / height
+    return np.meshgrid(x, y)
+
+
+def _Lighting(x, y):
+    """ Brightness falling off towards the corners, as with a screen lit from the front """
+    return 1.05 - 0.6 * ((x - 0.5) ** 2 + (y - 0.45) ** 2)
+
+
+def _Ellipse(x, y, cx, cy, rx, ry, edge):
+    """ Coverage of an ellipse, with a soft edge of about 1 / edge of its radius """
+    d = np.sqrt(((x - cx) / rx) ** 2 + ((y - cy) / ry) ** 2)
+    return np.clip((1.0 - d) * edge, 0.0, 1.0)
+
+
+def _Blend(image, coverage, color):
+    image *= (1.0 - coverage)[:, :, np.newaxis]
+    image += coverage[:, :, np.newaxis] * np.asarray(color, dtype=np.float32)
+
+
+def _SceneForeground(x, y):
+    lighting = _Lighting(x, y)[:, :, np.newaxis]
+    image = ScreenColor * lighting
+    for cx, shirt in ((0.35, (30, 50, 120)), (0.65, (180, 40, 40))):
+        # torso with a striped shirt, head, hair
+        torso = _Ellipse(x, y, cx, 0.82, 0.14, 0.38, 12.0)
+        _Blend(image, torso, shirt)
+        stripes = (0.5 + 0.5 * np.sin(y * 180.0)) * torso
+        _Blend(image, 0.3 * stripes, (230, 230, 230))
+        _Blend(image, _Ellipse(x, y, cx, 0.32, 0.06, 0.11, 10.0), (224, 172, 140))
+        _Blend(image, _Ellipse(x, y, cx, 0.25, 0.065, 0.07, 6.0), (60, 40, 30))
+        # green light reflected onto the edges of the guests
+        fringe = torso * (1.0 - torso) * 4.0
+        _Blend(image, 0.25 * fringe, ScreenColor)
+    return image
+
+
+def _SceneReference(x, y):
+    return ScreenColor * _Lighting(x, y)[:, :, np.newaxis]
+
+
+def _SceneBackground(x, y):
+    sky = np.stack([80 + 100 * y, 140 + 80 * y, 230 - 20 * y], axis=-1)
+    hills = 0.6 + 0.08 * np.sin(x * 17.0) + 0.04 * np.sin(x * 53.0 + 1.0)
+    ground = np.clip((y - hills) * 60.0, 0.0, 1.0)
+    texture = 20.0 * np.sin(x * 400.0) * np.sin(y * 300.0)
+    _Blend(sky, ground, (90, 110, 40))
+    sky += (ground * texture)[:, :, np.newaxis]
+    return sky
+
+
+def MakeSyntheticImage(scene, size, seed):
+    """
+    Render a synthetic scene at a given size
+
+    The scene is rendered at 1/8 of the size and scaled up, which keeps edges soft like those of a photo;
+    sensor noise is added at full size.
+
+    Args:
+        scene (callable): maps normalized x and y grids to an HxWx3 float image
+        size ((int, int)): image size (width, height)
+        seed (int): seed of the noise
+
+    Returns:
+        Image: RGB image
+    """
+    width, height = size
+    x, y = _Grid(max(1, width // 8), max(1, height // 8))
+    small = np.clip(scene(x, y), 0, 255).astype(np.uint8)
+    rgbNp = np.array(Image.fromarray(small, "RGB").resize(size, Image.BILINEAR))
+    rng = np.random.RandomState(seed)
+    for r0 in range(0, height, 256):
+        band = rgbNp[r0:r0 + 256]
+        noise = rng.randint(-3, 4, band.shape).astype(np.int16)
+        noise += rng.randint(-3, 4, band.shape).astype(np.int16)
+        noise += band
+        np.clip(noise, 0, 255, out=noise)
+        np.copyto(band, noise, casting="unsafe")
+    return Image.fromarray(rgbNp, "RGB")
+
+
+def FixturePaths(fixturesDir, sizeName):
+    """ Return dict: 'foreground', 'reference', 'background' -> fixture path """
+    return dict((kind, path.join(fixturesDir, "v%d_%s_%s.jpg" % (FixtureVersion, sizeName, kind)))
+                for kind in ("foreground", "reference", "background"))
+
+
+def MakeFixtures(fixturesDir, sizeName):
+    """ Generate the fixtures of a size unless present; returns FixturePaths() """
+    if not path.isdir(fixturesDir):
+        os.makedirs(fixturesDir)
+    paths = FixturePaths(fixturesDir, sizeName)
+    scenes = {"foreground": (_SceneForeground, 1), "reference": (_SceneReference, 2),
+              "background": (_SceneBackground, 3)}
+    for kind, (scene, seed) in sorted(scenes.items()):
+        if not path.exists(paths[kind]):
+            tmpPath = paths[kind] + ".tmp"
+            MakeSyntheticImage(scene, FixtureSizes[sizeName], seed).save(tmpPath, "JPEG", quality=92)
+            os.rename(tmpPath, paths[kind])
+    return paths
+
+
+def _ProcStatusBytes(field):
+    """ Memory value from /proc/self/status, None where that is not available """
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return 1024 * int(line.split()[1])
+    except (IOError, ValueError):
+        pass
+    return None
+
+
+def ResetPeakRSS():
+    """ Start measuring the peak resident set size anew, if the system allows (Linux); returns True if so """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except IOError:
+        return False
+
+
+def PeakRSSBytes():
+    """ Peak resident set size of this process, since ResetPeakRSS() where that worked """
+    peak = _ProcStatusBytes("VmHWM")
+    if peak is not None:
+        return peak
+    maxRSS = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes elsewhere
+    return maxRSS if sys.platform == "darwin" else 1024 * maxRSS
+
+
+def CurrentRSSBytes():
+    """ Current resident set size of this process, or the peak where the current one is not available """
+    current = _ProcStatusBytes("VmRSS")
+    return current if current is not None else PeakRSSBytes()
+
+
+def StubWx():
+    """ Install a stand-in for wx, so gui.py can be imported without wxPython or a display """
+    wx = types.ModuleType("wx")
+    wx.Frame = object
+    wx.Panel = object
+    # GUI updates after compositing are skipped
+    wx.CallAfter = lambda func, *args, **kwargs: None
+    sys.modules["wx"] = wx
+
+
+def MakeHeadlessGUI(FGImagePath, referenceImagePath, compoundImagesDir, nThreads, filterRadius,
+                    frameCacheDir=None):
+    """
+    GreenieGUI with just the state used by MakeCompoundImage(), with empty caches (apart from the decoded
+    frames in frameCacheDir) and without any windows
+
+    Needs StubWx() to be called before.
+    """
+    import caching
+    import compositing
+    import compoundindex
+    import gui
+
+    greenieGUI = gui.GreenieGUI.__new__(gui.GreenieGUI)
+    greenieGUI.CompoundImagesPath = compoundImagesDir
+    greenieGUI.ReferenceImagePath = referenceImagePath
+    greenieGUI.GreenScreenTol = [30., 40.]
+    greenieGUI.GreenScreenUseLUT = False
+    greenieGUI.GreenScreenFilterRadius = filterRadius
+    greenieGUI.GreenScreenThreads = nThreads
+    greenieGUI.GreenScreenMemoryBudget = None
+    greenieGUI.CompositingServiceURL = None
+    greenieGUI.GreenScreenRefColors = None
+    greenieGUI.GreenScreenAlphaLUT = None
+    greenieGUI.GreenScreenKeyingState = None
+    greenieGUI.GreenScreenKeyingLock = threading.Lock()
+    greenieGUI.LayerCache = caching.LayerCache(512 * 2 ** 20)
+    greenieGUI.DecodedFrames = None if frameCacheDir is None else caching.DecodedFrameCache(frameCacheDir)
+    greenieGUI.BackgroundStore = caching.BackgroundStore(256 * 2 ** 20)
+    greenieGUI.CompositingQueue = compositing.CompositingQueue(1)
+    greenieGUI.CompoundImageWriter = compositing.CompositingQueue(1)
+    greenieGUI.CompoundIndex = compoundindex.CompoundIndex(compoundImagesDir)
+    greenieGUI.UnsavedCompoundImages = {}
+    greenieGUI.LatestCompoundImages = {}
+    greenieGUI.MainFGPanelSize = (1000, 667)
+    greenieGUI.FGImageList = [FGImagePath]
+    return greenieGUI
+
+
+def _LoadRGB(imgPath):
+    """ Decoded image, so decoding is not part of the measured stage """
+    img = Image.open(imgPath)
+    img.load()
+    return img.convert("RGB") if img.mode != "RGB" else img
+
+
+def PrepareStage(stage, paths, nThreads, filterRadius, workDir):
+    """
+    Load the inputs of a stage
+
+    Returns:
+        callable: runs the stage once
+    """
+    if stage in ("end_to_end", "recomposite"):
+        StubWx()
+        # as configured in greenie.py by default; for end_to_end, the frame cache is empty on each run
+        sharedFrameCacheDir = tempfile.mkdtemp(dir=workDir)
+        # the booth computes the reference colors once, not per photo
+        keyingGUI = MakeHeadlessGUI(paths["foreground"], paths["reference"], workDir, nThreads, filterRadius)
+        keyingGUI.UpdateGreenScreenKeying()
+
+        def RunEndToEnd():
+            compoundImagesDir = tempfile.mkdtemp(dir=workDir)
+            frameCacheDir = sharedFrameCacheDir if stage == "recomposite" else tempfile.mkdtemp(dir=workDir)
+            greenieGUI = MakeHeadlessGUI(paths["foreground"], paths["reference"], compoundImagesDir,
+                                         nThreads, filterRadius, frameCacheDir)
+            greenieGUI.GreenScreenRefColors = keyingGUI.GreenScreenRefColors
+            greenieGUI.GreenScreenKeyingState = keyingGUI.GreenScreenKeyingState
+            greenieGUI.MakeCompoundImage(0, paths["background"])
+            greenieGUI.CompositingQueue.WaitUntilIdle()
+            greenieGUI.CompoundImageWriter.WaitUntilIdle()
+            greenieGUI.CompositingQueue.Stop()
+            greenieGUI.CompoundImageWriter.Stop()
+            if len(greenieGUI.CompoundIndex.entries) != 1:
+                raise RuntimeError("compound image was not saved")
+        if stage == "recomposite":
+            RunEndToEnd()
+        return RunEndToEnd
+
+    if stage == "decode":
+        def RunDecode():
+            img = Image.open(paths["foreground"])
+            img.load()
+        return RunDecode
+    if stage == "decode_cached":
+        import caching
+        frameCache = caching.DecodedFrameCache(tempfile.mkdtemp(dir=workDir))
+        frameCache.Get(paths["foreground"])
+        frameCache.Flush()
+        # mapping alone reads nothing, so all pixels are read once
+        return lambda: frameCache.Get(paths["foreground"]).max()
+
+    if stage == "refcolor":
+        refImage = _LoadRGB(paths["reference"])
+        return lambda: greenscreen.GetRefColor(refImage)
+
+    fgImage = _LoadRGB(paths["foreground"])
+    if stage == "ycbcr":
+        return lambda: greenscreen.ImageToYCbCrNumpy(fgImage)
+
+    refColors = greenscreen.GetRefColor(_LoadRGB(paths["reference"]))
+    if stage == "keying":
+        return lambda: greenscreen.KeyForeground(fgImage, refColors, nThreads=nThreads, filterRadius=filterRadius)
+
+    bgNp = greenscreen.BackgroundArray(_LoadRGB(paths["background"]), fgImage.size)
+    if stage == "compositing":
+        keyed = greenscreen.KeyForeground(fgImage, refColors, nThreads=nThreads, filterRadius=filterRadius)
+        return lambda: keyed.Composite(bgNp, nThreads=nThreads)
+    if stage == "overlay":
+        return lambda: greenscreen.Overlay(fgImage, bgNp, refColors, filterRadius=filterRadius, nThreads=nThreads)
+    if stage == "jpeg":
+        compoundImage = greenscreen.Overlay(fgImage, bgNp, refColors, filterRadius=filterRadius, nThreads=nThreads)
+        # same settings as GreenieGUI.SaveCompoundImage()
+        return lambda: compoundImage.save(io.BytesIO(), "JPEG")
+    raise ValueError("unknown stage %r" % stage)
+
+
+def RunStage(stage, sizeName, fixturesDir, repeat, nThreads, filterRadius):
+    """
+    Time a stage and measure its memory; meant to run in a process of its own, see MeasureStage()
+
+    Returns:
+        dict: result of the stage
+    """
+    paths = FixturePaths(fixturesDir, sizeName)
+    workDir = tempfile.mkdtemp(prefix="greenie_benchmark_")
+    try:
+        run = PrepareStage(stage, paths, nThreads, filterRadius, workDir)
+        gc.collect()
+        # without a reset, memory used while loading the inputs may hide the peak of the stage
+        exactPeak = ResetPeakRSS()
+        rssBefore = CurrentRSSBytes()
+        seconds = []
+        for i in range(repeat):
+            startTime = time.time()
+            run()
+            seconds.append(time.time() - startTime)
+            gc.collect()
+        peakRSS = PeakRSSBytes()
+    finally:
+        shutil.rmtree(workDir, ignore_errors=True)
+    width, height = FixtureSizes[sizeName]
+    return {"size": sizeName,
+            "stage": stage,
+            "megapixels": round(width * height / 1e6, 1),
+            "seconds": [round(s, 4) for s in seconds],
+            "minSeconds": round(min(seconds), 4),
+            "medianSeconds": round(sorted(seconds)[len(seconds) // 2], 4),
+            # memory of the stage on top of its inputs, and of the whole process
+            "stagePeakMB": round(max(0, peakRSS - rssBefore) / 2.0 ** 20, 1),
+            "processPeakMB": round(peakRSS / 2.0 ** 20, 1),
+            "exactPeak": exactPeak}
+
+
+def MeasureStage(stage, sizeName, fixturesDir, repeat, nThreads, filterRadius):
+    """ Run RunStage() in a fresh Python process, so memory used by earlier stages does not count """
+    command = [sys.executable, path.abspath(__file__), "--run-stage", stage, "--sizes", sizeName,
+               "--fixtures", fixturesDir, "--repeat", str(repeat), "--threads", str(nThreads),
+               "--filter-radius", str(filterRadius)]
+    output = subprocess.check_output(command)
+    # the result is the last line, greenscreen prints some diagnostics before
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def Environment():
+    return {"python": platform.python_version(),
+            "numpy": np.__version__,
+            "pillow": getattr(PIL, "__version__", getattr(PIL, "PILLOW_VERSION", None)),
+            "platform": platform.platform(),
+            "machine": platform.machine(),
+            "cpus": multiprocessing.cpu_count()}
+
+
+def CompareResults(results, baseline, timeTolerance=0.15, memoryTolerance=0.10, minSecondsSlack=0.02,
+                   minMemorySlackMB=16.0):
+    """
+    Compare results with a baseline run
+
+    A stage regressed if its fastest time exceeds the baseline's by more than timeTolerance (relative) and
+    minSecondsSlack, or if its peak memory exceeds the baseline's by more than memoryTolerance and
+    minMemorySlackMB. Stages missing from either run are not compared.
+
+    Returns:
+        (list, list): messages about regressions, messages about the other compared stages
+    """
+    baselineResults = dict(((r["size"], r["stage"]), r) for r in baseline["results"])
+    regressions = []
+    others = []
+    for r in results["results"]:
+        b = baselineResults.get((r["size"], r["stage"]))
+        if b is None:
+            continue
+        text = "%s %s: %.3f s (baseline %.3f s, %+.0f%%), %.0f MB (baseline %.0f MB)" % (
+            r["size"], r["stage"], r["minSeconds"], b["minSeconds"],
+            100.0 * (r["minSeconds"] / b["minSeconds"] - 1) if b["minSeconds"] > 0 else 0.0,
+            r["stagePeakMB"], b["stagePeakMB"])
+        slower = r["minSeconds"] > b["minSeconds"] * (1 + timeTolerance) + minSecondsSlack
+        larger = r["stagePeakMB"] > b["stagePeakMB"] * (1 + memoryTolerance) + minMemorySlackMB
+        if slower or larger:
+            regressions.append(text + " - REGRESSION (%s)" % " and ".join(
+                [w for w, flag in (("time", slower), ("memory", larger)) if flag]))
+        else:
+            others.append(text)
+    return regressions, others
+
+
+def Main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark green screen compositing on synthetic photos")
+    parser.add_argument("--sizes", nargs="+", choices=sorted(FixtureSizes), default=sorted(FixtureSizes),
+                        help="fixture sizes (default: all)")
+    parser.add_argument("--stages", nargs="+", choices=Stages, default=Stages, help="stages (default: all)")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per stage, the fastest counts (default: 3)")
+    parser.add_argument("--threads", type=int, default=multiprocessing.cpu_count(),
+                        help="threads per photo (default: number of CPUs)")
+    parser.add_argument("--filter-radius", type=int, default=1, metavar="R",
+                        help="mask smoothing radius, see greenscreen.Overlay (default: 1)")
+    parser.add_argument("--fixtures", default=path.join(tempfile.gettempdir(), "greenie_benchmark_fixtures"),
+                        help="directory for the generated fixtures (default: in the temp directory)")
+    parser.add_argument("-o", "--output", help="write results to this JSON file")
+    parser.add_argument("--baseline", help="JSON results of an earlier run; regressions make the run fail")
+    parser.add_argument("--time-tolerance", type=float, default=0.15,
+                        help="allowed relative slowdown against the baseline (default: 0.15)")
+    parser.add_argument("--memory-tolerance", type=float, default=0.10,
+                        help="allowed relative increase of peak memory against the baseline (default: 0.10)")
+    parser.add_argument("--run-stage", choices=Stages, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.run_stage is not None:
+        result = RunStage(args.run_stage, args.sizes[0], args.fixtures, args.repeat, args.threads,
+                          args.filter_radius)
+        print json.dumps(result)
+        return 0
+
+    results = {"version": ResultsVersion,
+               "environment": Environment(),
+               "settings": {"threads": args.threads, "filterRadius": args.filter_radius, "repeat": args.repeat},
+               "results": []}
+    for sizeName in sorted(args.sizes, key=lambda s: FixtureSizes[s][0]):
+        print "Preparing %s fixtures in %s" % (sizeName, args.fixtures)
+        sys.stdout.flush()
+        MakeFixtures(args.fixtures, sizeName)
+        for stage in [s for s in Stages if s in args.stages]:
+            result = MeasureStage(stage, sizeName, args.fixtures, args.repeat, args.threads, args.filter_radius)
+            results["results"].append(result)
+            print "%-5s %-12s %8.3f s  %7.0f MB" % (sizeName, stage, result["minSeconds"], result["stagePeakMB"])
+            sys.stdout.flush()
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        baselineSettings = baseline.get("settings", {})
+        if any(baselineSettings.get(k) != results["settings"][k] for k in ("threads", "filterRadius")):
+            print "Warning: baseline was run with different settings: %s" % baselineSettings
+        regressions, others = CompareResults(results, baseline, args.time_tolerance, args.memory_tolerance)
+        for text in others + regressions:
+            print text
+        if len(regressions) > 0:
+            print "%d regressions against %s" % (len(regressions), args.baseline)
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(Main())
@@ -0,0 +1,496 @@
+"""
+Caches for intermediate results of green screen compositing
+"""
+
+import hashlib
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from os import path
+
+import numpy as np
+from PIL import Image
+
+import greenscreen
+import metrics
+
+
+class LRUCache(object):
+    """
+    Thread-safe least-recently-used cache, bounded by the total size of its entries in bytes.
+
+    Args:
+        maxBytes (int): size limit; the least recently used entries are dropped when it is exceeded
+        sizeFunc (callable): returns the size of an entry in bytes, defaults to its 'nbytes' attribute
+    """
+
+    def __init__(self, maxBytes, sizeFunc=None):
+        self.maxBytes = maxBytes
+        self.sizeFunc = sizeFunc if sizeFunc is not None else (lambda value: value.nbytes)
+        self.entries = OrderedDict()
+        self.curBytes = 0
+        self.lock = threading.RLock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def Get(self, key, default=None):
+        """ Return cached value and mark it as most recently used, or 'default' if not cached """
+        with self.lock:
+            if key not in self.entries:
+                return default
+            value, size = self.entries.pop(key)
+            self.entries[key] = (value, size)
+            return value
+
+    def Put(self, key, value):
+        """ Add value to cache, dropping least recently used entries as needed """
+        size = self.sizeFunc(value)
+        with self.lock:
+            self.Remove(key)
+            self.entries[key] = (value, size)
+            self.curBytes += size
+            # the newest entry is always kept, even if it exceeds the limit on its own
+            while self.curBytes > self.maxBytes and len(self.entries) > 1:
+                _, (_, oldSize) = self.entries.popitem(last=False)
+                self.curBytes -= oldSize
+
+    def Remove(self, key):
+        with self.lock:
+            if key in self.entries:
+                _, size = self.entries.pop(key)
+                self.curBytes -= size
+
+    def Clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.curBytes = 0
+
+
+# temporary files ('.tmp') not modified for this many seconds are left over from interrupted writes
+StaleTempFileAge = 10 * 60
+
+
+def PruneDirectory(dirPath, maxBytes, suffix=""):
+    """
+    Delete the least recently modified files ending in 'suffix' until their total size is below 'maxBytes',
+    and stale temporary files, see StaleTempFileAge.
+    """
+    files = []
+    now = time.time()
+    for name in os.listdir(dirPath):
+        if name.endswith(".tmp"):
+            # temporary files being written are left alone
+            filePath = path.join(dirPath, name)
+            try:
+                if now - os.stat(filePath).st_mtime > StaleTempFileAge:
+                    os.remove(filePath)
+            except OSError:
+                pass
+        elif name.endswith(suffix):
+            filePath = path.join(dirPath, name)
+            try:
+                st = os.stat(filePath)
+            except OSError:
+                continue
+            files.append((st.st_mtime, st.st_size, filePath))
+    total = sum(f[1] for f in files)
+    for _, size, filePath in sorted(files):
+        if total <= maxBytes:
+            break
+        try:
+            os.remove(filePath)
+        except OSError:
+            pass
+        total -= size
+
+
+def FileStateKey(filePath):
+    """ (path, mtime, size) of a file, to detect when it changes """
+    st = os.stat(filePath)
+    return filePath, st.st_mtime, st.st_size
+
+
+class BackgroundStore(object):
+    """
+    Decoded backgrounds, resized to the foreground size and ready to be blended.
+
+    Entries are keyed by background path and target size and are re-loaded when the file's
+    modification time changes.
+
+    Args:
+        maxBytes (int): memory limit for stored backgrounds
+    """
+
+    def __init__(self, maxBytes):
+        self.cache = LRUCache(maxBytes, sizeFunc=lambda entry: entry[1].nbytes)
+
+    def Get(self, bgImagePath, size, draft=False):
+        """
+        Return background as HxWx3 uint8 array at the given size (width, height)
+
+        With 'draft', the JPEG decoder does most of the down-scaling (see LoadScaled()); this is much
+        faster for small sizes, but not pixel-identical to scaling the fully decoded image.
+        """
+        mtime = path.getmtime(bgImagePath)
+        key = (bgImagePath, tuple(size), draft)
+        entry = self.cache.Get(key)
+        if entry is not None and entry[0] == mtime:
+            return entry[1]
+        bgImage = Image.open(bgImagePath)
+        if draft:
+            bgImage.draft("RGB", tuple(size))
+        if bgImage.mode != "RGB":
+            bgImage = bgImage.convert("RGB")
+        bgNp = greenscreen.BackgroundArray(bgImage, tuple(size))
+        # cached arrays are shared between callers
+        bgNp.flags.writeable = False
+        self.cache.Put(key, (mtime, bgNp))
+        return bgNp
+
+
+class LayerCache(object):
+    """
+    Cache of keyed foreground layers (see greenscreen.KeyForeground), so changing the background
+    of a photo does not require decoding and keying the photo again.
+
+    Layers are held in memory and, if 'cacheDir' is given, also stored there as .npz files.
+
+    Args:
+        maxBytes (int): memory limit for cached layers
+        cacheDir (str): optional directory for persisting layers on disk
+        maxDiskBytes (int): disk limit for persisted layers
+        recordMetrics (bool): time decoding and keying as stages of the pipeline, see metrics.py
+    """
+
+    def __init__(self, maxBytes, cacheDir=None, maxDiskBytes=4 * 2 ** 30, recordMetrics=False):
+        self.memCache = LRUCache(maxBytes)
+        self.recordMetrics = recordMetrics
+        self.cacheDir = cacheDir
+        self.maxDiskBytes = maxDiskBytes
+        if cacheDir is not None and not path.isdir(cacheDir):
+            os.makedirs(cacheDir)
+
+    def Get(self, fgImagePath, refColors, tolA, tolB, alphaLUT=None, loadFunc=None, nThreads=1, size=None,
+            filterRadius=1):
+        """
+        Return keyed foreground layer for a photo, keying it if necessary
+
+        Args:
+            fgImagePath (str): path to foreground image
+            refColors, tolA, tolB, alphaLUT, filterRadius: keying parameters, see greenscreen.Overlay()
+            loadFunc (callable): optional function returning the decoded foreground image (Image or HxWx3
+                                 uint8 array) for a path, e.g. DecodedFrameCache.Get; defaults to Image.open
+            nThreads (int): number of threads used for keying, see greenscreen.ForEachBand()
+            size ((int, int)): if given, the photo is decoded and keyed at this size (width, height)
+                               instead of full resolution, see LoadScaled()
+
+        Returns:
+            greenscreen.KeyedForeground: the keyed foreground layer
+        """
+        key = self.Key(fgImagePath, refColors, tolA, tolB, alphaLUT, size, filterRadius)
+        keyed = self.memCache.Get(key)
+        if keyed is not None:
+            return keyed
+
+        diskPath = None
+        if self.cacheDir is not None:
+            diskPath = path.join(self.cacheDir, key + ".npz")
+            if path.exists(diskPath):
+                try:
+                    with np.load(diskPath) as data:
+                        keyed = greenscreen.KeyedForeground(data["mask"], data["fgTerm"])
+                    os.utime(diskPath, None)
+                except (IOError, ValueError, KeyError):
+                    keyed = None
+
+        if keyed is None:
+            with metrics.Timed(metrics.StageDecode, self.recordMetrics):
+                if loadFunc is None:
+                    fgImage = Image.open(fgImagePath)
+                else:
+                    fgImage = loadFunc(fgImagePath)
+                if size is not None:
+                    if isinstance(fgImage, np.ndarray):
+                        fgImage = Image.fromarray(fgImage, "RGB")
+                    fgImage = LoadScaled(fgImage, size)
+                elif isinstance(fgImage, Image.Image):
+                    fgImage.load()
+            with metrics.Timed(metrics.StageKeying, self.recordMetrics):
+                keyed = greenscreen.KeyForeground(fgImage, refColors, tolA=tolA, tolB=tolB, alphaLUT=alphaLUT,
+                                                  nThreads=nThreads, filterRadius=filterRadius)
+            if diskPath is not None:
+                self.SaveLayer(keyed, diskPath)
+
+        self.memCache.Put(key, keyed)
+        return keyed
+
+    def SaveLayer(self, keyed, diskPath):
+        # write to a temporary file first, so an interrupted write never leaves a truncated cache entry
+        tmpPath = diskPath + ".tmp"
+        with open(tmpPath, "wb") as f:
+            np.savez(f, mask=keyed.mask, fgTerm=keyed.fgTerm)
+        os.rename(tmpPath, diskPath)
+        PruneDirectory(self.cacheDir, self.maxDiskBytes, ".npz")
+
+    @staticmethod
+    def Key(fgImagePath, refColors, tolA, tolB, alphaLUT=None, size=None, filterRadius=1):
+        """ Cache key covering the photo file state, all keying parameters and the layer size """
+        h = hashlib.sha1()
+        h.update(repr(FileStateKey(fgImagePath)))
+        if size is not None:
+            h.update(repr(tuple(size)))
+        h.update(repr((float(tolA), float(tolB), int(filterRadius))))
+        h.update(np.asarray(refColors[0], dtype=np.uint8).tobytes())
+        h.update(np.asarray(refColors[1], dtype=np.uint8).tobytes())
+        if alphaLUT is not None:
+            h.update(alphaLUT.tobytes())
+        return h.hexdigest()
+
+
+class DecodedFrameCache(object):
+    """
+    Decoded photos on disk as raw .npy arrays, read back memory-mapped.
+
+    Compositing a photo again, e.g. onto another background or with other keying parameters, then reads
+    its pixels from the page cache instead of decoding the JPEG file again. Entries are keyed by
+    FileStateKey() of the photo; the least recently used ones are deleted when the cache exceeds its
+    disk quota. A decoded 12 MP photo takes 36 MB, so newly decoded photos are written in a background
+    thread, not by the thread compositing them.
+
+    Args:
+        cacheDir (str): directory for the decoded photos
+        maxDiskBytes (int): disk quota
+        maxPendingWrites (int): number of decoded photos waiting to be written, further ones are not cached
+    """
+
+    def __init__(self, cacheDir, maxDiskBytes=4 * 2 ** 30, maxPendingWrites=2):
+        self.cacheDir = cacheDir
+        self.maxDiskBytes = maxDiskBytes
+        self.maxPendingWrites = maxPendingWrites
+        if not path.isdir(cacheDir):
+            os.makedirs(cacheDir)
+        # (cache file path, decoded photo) to be written, the first one is being written
+        self.pendingWrites = []
+        self.cond = threading.Condition()
+        self.writer = threading.Thread(target=self.WriterLoop, name="DecodedFrameWriter")
+        self.writer.daemon = True
+        self.writer.start()
+
+    def Get(self, imgPath):
+        """
+        Return decoded photo as read-only HxWx3 uint8 array, memory-mapped from the cache
+
+        The array stays valid even if the cache entry is evicted while it is in use.
+        """
+        h = hashlib.sha1()
+        h.update(repr(FileStateKey(imgPath)))
+        diskPath = path.join(self.cacheDir, h.hexdigest() + ".npy")
+        if path.exists(diskPath):
+            try:
+                rgbNp = np.load(diskPath, mmap_mode="r")
+                # the modification time orders entries for eviction, see PruneDirectory()
+                os.utime(diskPath, None)
+                return rgbNp
+            except (IOError, OSError, ValueError):
+                pass
+
+        img = Image.open(imgPath)
+        if img.mode != "RGB":
+            img = img.convert("RGB")
+        rgbNp = np.asarray(img)
+        with self.cond:
+            if len(self.pendingWrites) < self.maxPendingWrites and \
+                    diskPath not in [pendingPath for pendingPath, _ in self.pendingWrites]:
+                self.pendingWrites.append((diskPath, rgbNp))
+                self.cond.notify_all()
+        return rgbNp
+
+    def Flush(self):
+        """ Block until all decoded photos have been written """
+        with self.cond:
+            while len(self.pendingWrites) > 0:
+                self.cond.wait()
+
+    def WriterLoop(self):
+        while True:
+            with self.cond:
+                while len(self.pendingWrites) == 0:
+                    self.cond.wait()
+                diskPath, rgbNp = self.pendingWrites[0]
+            # written under a temporary name, so readers never see a partial file; see StaleTempFileAge
+            fd, tmpPath = tempfile.mkstemp(".tmp", dir=self.cacheDir)
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    np.save(f, rgbNp)
+                os.rename(tmpPath, diskPath)
+                PruneDirectory(self.cacheDir, self.maxDiskBytes, ".npy")
+            except (IOError, OSError):
+                # disk full or similar; the photo is decoded again next time
+                if path.exists(tmpPath):
+                    os.remove(tmpPath)
+            with self.cond:
+                self.pendingWrites.pop(0)
+                self.cond.notify_all()
+
+
+def LoadThumbnail(imgPath, scaleFac):
+    """
+    Decode an image at reduced size
+
+    JPEG draft mode lets the decoder skip most of the work for strong down-scaling.
+
+    Args:
+        imgPath (str): image file path
+        scaleFac (float): scale factor relative to the full image size
+
+    Returns:
+        Image: RGB image of scaleFac times the full size
+    """
+    img = Image.open(imgPath)
+    return LoadScaled(img, (max(1, int(img.size[0] * scaleFac)), max(1, int(img.size[1] * scaleFac))))
+
+
+def LoadScaled(img, size):
+    """
+    Decode an image directly at a given size, see LoadThumbnail()
+
+    Args:
+        img (Image or str): image freshly opened with Image.open, or its path
+        size ((int, int)): target size (width, height)
+
+    Returns:
+        Image: RGB image of the given size
+    """
+    if not isinstance(img, Image.Image):
+        img = Image.open(img)
+    size = tuple(int(s) for s in size)
+    img.draft("RGB", size)
+    img = img.convert("RGB")
+    if img.size != size:
+        img = img.resize(size, Image.ANTIALIAS)
+    return img
+
+
+class PreviewStore(object):
+    """
+    Down-scaled previews of images, persisted as JPEG files so they survive restarts.
+
+    Previews are keyed by image path, modification time and file size, so they are re-created when
+    the image changes.
+
+    Args:
+        scaleFac (float): preview scale factor, see LoadThumbnail()
+        cacheDir (str): directory for preview files; if None, previews are not persisted
+        maxDiskBytes (int): disk limit for preview files
+    """
+
+    def __init__(self, scaleFac, cacheDir=None, maxDiskBytes=1 * 2 ** 30):
+        self.scaleFac = scaleFac
+        self.cacheDir = cacheDir
+        self.maxDiskBytes = maxDiskBytes
+        self.nWritten = 0
+        if cacheDir is not None and not path.isdir(cacheDir):
+            os.makedirs(cacheDir)
+
+    def Get(self, imgPath):
+        """ Return preview of an image as RGB Image """
+        if self.cacheDir is None:
+            return LoadThumbnail(imgPath, self.scaleFac)
+        h = hashlib.sha1()
+        h.update(repr(FileStateKey(imgPath) + (self.scaleFac,)))
+        previewPath = path.join(self.cacheDir, h.hexdigest() + ".jpg")
+        if path.exists(previewPath):
+            try:
+                img = Image.open(previewPath)
+                img.load()
+                return img.convert("RGB")
+            except IOError:
+                pass
+        img = LoadThumbnail(imgPath, self.scaleFac)
+        # the preview strip and the photo browser may create the same preview at once, each writes its own file
+        fd, tmpPath = tempfile.mkstemp(".tmp", dir=self.cacheDir)
+        with os.fdopen(fd, "wb") as f:
+            img.save(f, "JPEG", quality=90)
+        os.rename(tmpPath, previewPath)
+        # pruning lists the whole directory, so only do it every now and then
+        self.nWritten += 1
+        if self.nWritten % 100 == 0:
+            PruneDirectory(self.cacheDir, self.maxDiskBytes, ".jpg")
+        return img
+
+
+class Thumbnail(object):
+    """
+    Down-scaled image, plus a GUI bitmap created from it on demand.
+
+    Attributes:
+        image (Image): the down-scaled RGB image
+        bitmap: bitmap for display, set by the GUI thread
+    """
+
+    def __init__(self, image):
+        self.image = image
+        self.bitmap = None
+
+    @property
+    def nbytes(self):
+        # image data plus a bitmap of the same size
+        return 2 * 3 * self.image.size[0] * self.image.size[1]
+
+
+class ThumbnailLoader(object):
+    """
+    Loads thumbnails into an LRUCache on a background thread, keyed by FileStateKey() of the image.
+
+    Args:
+        cache (LRUCache): cache receiving Thumbnail objects
+        loadFunc (callable): returns the down-scaled image for a path, e.g. PreviewStore.Get
+        onLoaded (callable): called with the image path in the loader thread after a thumbnail was added
+    """
+
+    def __init__(self, cache, loadFunc, onLoaded=None):
+        self.cache = cache
+        self.loadFunc = loadFunc
+        self.onLoaded = onLoaded
+        self.requested = []
+        self.cond = threading.Condition()
+        self.stopped = False
+        self.thread = threading.Thread(target=self.LoaderLoop, name="ThumbnailLoader")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def Request(self, imgPaths):
+        """ Load the given images in order, replacing all previously requested but not yet loaded ones """
+        with self.cond:
+            self.requested = list(imgPaths)
+            self.cond.notify()
+
+    def Stop(self):
+        with self.cond:
+            self.stopped = True
+            self.cond.notify()
+
+    def LoaderLoop(self):
+        while True:
+            with self.cond:
+                while not self.stopped and len(self.requested) == 0:
+                    self.cond.wait()
+                if self.stopped:
+                    return
+                imgPath = self.requested.pop(0)
+            try:
+                key = FileStateKey(imgPath)
+                if key in self.cache:
+                    continue
+                self.cache.Put(key, Thumbnail(self.loadFunc(imgPath)))
+            except (IOError, OSError):
+                # image vanished or is not complete yet, will be requested again when shown
+                continue
+            if self.onLoaded is not None:
+                self.onLoaded(imgPath)
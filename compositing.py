@@ -0,0 +1,166 @@
+"""
+Background job queue for compositing, so creating compound images never blocks the GUI
+"""
+
+import heapq
+import itertools
+import threading
+import traceback
+
+# job priorities, lower values are processed first
+PrioritySelected = 0  # photo currently selected in the GUI
+PriorityBacklog = 10  # newly added photos
+
+
+class CompositingJob(object):
+    """
+    A unit of work in a CompositingQueue.
+
+    Attributes:
+        key: identifies the job's target, e.g. the foreground image path; a newer job with the same key
+             supersedes a pending one
+        func (callable): does the work, called without arguments in a worker thread
+        callback (callable): called with the result of func in the worker thread while the queue is locked, so it
+                             should return quickly; may be None; not called if a newer job with the same key
+                             has been submitted in the meantime
+        priority (int): see PrioritySelected, PriorityBacklog
+        generation (int): increases with each submitted job, see CompositingQueue.Submit()
+    """
+
+    def __init__(self, key, func, callback, priority, generation):
+        self.key = key
+        self.func = func
+        self.callback = callback
+        self.priority = priority
+        self.generation = generation
+        self.cancelled = False
+        self.started = False
+
+
+class CompositingQueue(object):
+    """
+    Priority queue of compositing jobs, processed by a pool of worker threads.
+
+    Compositing spends its time in numpy and PIL, which release the GIL, so threads are sufficient
+    and can share the caches of the GUI.
+
+    Args:
+        nWorkers (int): number of worker threads
+    """
+
+    def __init__(self, nWorkers=1):
+        self.heap = []
+        self.pending = {}
+        self.counter = itertools.count()
+        # generation of the newest job per key; results of older jobs are dropped
+        self.generations = {}
+        self.generationCounter = itertools.count()
+        self.cond = threading.Condition()
+        self.stopped = False
+        self.workers = []
+        for i in range(nWorkers):
+            worker = threading.Thread(target=self.WorkerLoop, name="CompositingWorker%d" % i)
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def Submit(self, key, func, callback=None, priority=PriorityBacklog):
+        """
+        Queue a job, superseding any pending job with the same key; if that job is already running,
+        its result is dropped, even if it finishes after this job
+        """
+        with self.cond:
+            job = CompositingJob(key, func, callback, priority, next(self.generationCounter))
+            if key in self.pending:
+                self.pending[key].cancelled = True
+            self.pending[key] = job
+            self.generations[key] = job.generation
+            heapq.heappush(self.heap, (priority, next(self.counter), job))
+            self.cond.notify_all()
+        return job
+
+    def Promote(self, key, priority=PrioritySelected):
+        """ Move a pending job to a higher priority; returns False if there is no such job """
+        with self.cond:
+            job = self.pending.get(key)
+            if job is None:
+                return False
+            if priority < job.priority and not job.started:
+                job.cancelled = True
+                newJob = CompositingJob(key, job.func, job.callback, priority, job.generation)
+                self.pending[key] = newJob
+                heapq.heappush(self.heap, (priority, next(self.counter), newJob))
+                self.cond.notify_all()
+            return True
+
+    def CancelPending(self):
+        """ Drop all queued jobs; running jobs are not interrupted """
+        with self.cond:
+            for _, _, job in self.heap:
+                job.cancelled = True
+                if self.pending.get(job.key) is job:
+                    del self.pending[job.key]
+                    del self.generations[job.key]
+            self.heap = []
+            self.cond.notify_all()
+
+    def IsPending(self, key):
+        """ True if a job with the given key is queued or running """
+        with self.cond:
+            return key in self.pending
+
+    def __len__(self):
+        with self.cond:
+            return len(self.pending)
+
+    def WaitFor(self, key):
+        """ Block until no job with the given key is queued or running """
+        with self.cond:
+            while key in self.pending:
+                self.cond.wait()
+
+    def WaitUntilIdle(self):
+        """ Block until all queued jobs have been processed """
+        with self.cond:
+            while len(self.pending) > 0:
+                self.cond.wait()
+
+    def Stop(self, wait=False):
+        """ Let workers exit after their current job; pending jobs are dropped """
+        with self.cond:
+            self.stopped = True
+            self.cond.notify_all()
+        if wait:
+            for worker in self.workers:
+                worker.join()
+
+    def WorkerLoop(self):
+        while True:
+            with self.cond:
+                while not self.stopped and len(self.heap) == 0:
+                    self.cond.wait()
+                if self.stopped:
+                    return
+                _, _, job = heapq.heappop(self.heap)
+                if job.cancelled:
+                    continue
+                job.started = True
+
+            try:
+                result = job.func()
+            except Exception:
+                traceback.print_exc()
+                result = None
+
+            with self.cond:
+                # a newer job for the same key may have been submitted in the meantime; the callback runs
+                # under the lock, so a newer job cannot deliver its result in between the check and the callback
+                if job.callback is not None and self.generations.get(job.key) == job.generation:
+                    try:
+                        job.callback(result)
+                    except Exception:
+                        traceback.print_exc()
+                if self.pending.get(job.key) is job:
+                    del self.pending[job.key]
+                    del self.generations[job.key]
+                    self.cond.notify_all()
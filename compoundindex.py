@@ -0,0 +1,124 @@
+"""
+Persistent index of compound images, mapping each foreground photo to its current compound image
+"""
+
+import os
+import sqlite3
+import threading
+from os import path
+
+# file name conventions, see gui.py:
+# - P1234567.JPG: input image
+# - C1234567___Background123.JPG: compound image to above input image and Background123.JPG
+CompoundSeparator = "___"
+
+
+def PhotoStem(FGImageName):
+    """ Part of a foreground image file name shared with its compound images, e.g. '1234567' """
+    return FGImageName[1: -4]
+
+
+def CompoundImageName(FGImageName, BGImageName):
+    return "C" + PhotoStem(FGImageName) + CompoundSeparator + BGImageName
+
+
+def ParseCompoundImageName(name):
+    """ Return (photo stem, background image name) of a compound image file name, or None for other files """
+    if not (name.startswith("C") and CompoundSeparator in name and name.lower().endswith(".jpg")):
+        return None
+    stem, BGImageName = name[1:].split(CompoundSeparator, 1)
+    return stem, BGImageName
+
+
+class CompoundIndex(object):
+    """
+    SQLite-backed mapping from foreground photo to its current compound image, background and tolerances.
+
+    All entries are also kept in a dict, so lookups do not touch the database. The index is rebuilt
+    from a scan of the compound images directory if the database is missing or corrupt.
+
+    Args:
+        compoundImagesDir (str): directory containing the compound images
+        dbPath (str): index database file, defaults to 'compound_index.sqlite' in compoundImagesDir
+    """
+
+    def __init__(self, compoundImagesDir, dbPath=None):
+        self.compoundImagesDir = compoundImagesDir
+        self.dbPath = dbPath if dbPath is not None else path.join(compoundImagesDir, "compound_index.sqlite")
+        self.lock = threading.Lock()
+        self.entries = {}
+        try:
+            self.Open()
+        except sqlite3.DatabaseError:
+            print "Compound image index is corrupt, rebuilding it"
+            if getattr(self, "conn", None) is not None:
+                self.conn.close()
+            os.remove(self.dbPath)
+            self.Open()
+
+    def Open(self):
+        isNew = not path.exists(self.dbPath)
+        self.conn = sqlite3.connect(self.dbPath, check_same_thread=False)
+        self.conn.text_factory = str
+        self.conn.execute("CREATE TABLE IF NOT EXISTS compounds ("
+                          "stem TEXT PRIMARY KEY, compound TEXT NOT NULL, background TEXT, tolA REAL, tolB REAL)")
+        if isNew:
+            self.Rebuild()
+        else:
+            rows = self.conn.execute("SELECT stem, compound, background, tolA, tolB FROM compounds").fetchall()
+            self.entries = dict((row[0], tuple(row[1:])) for row in rows)
+
+    def Rebuild(self):
+        """
+        Re-create the index from the compound image files present on disk; of several compound images of
+        a photo, e.g. left over from an interrupted save, the most recently modified one is current
+        """
+        entries = {}
+        mtimes = {}
+        for name in sorted(os.listdir(self.compoundImagesDir)):
+            parsed = ParseCompoundImageName(name)
+            if parsed is None:
+                continue
+            stem, BGImageName = parsed
+            try:
+                mtime = path.getmtime(path.join(self.compoundImagesDir, name))
+            except OSError:
+                continue
+            if stem in entries and mtime < mtimes[stem]:
+                continue
+            entries[stem] = (name, BGImageName, None, None)
+            mtimes[stem] = mtime
+        with self.lock:
+            with self.conn:
+                self.conn.execute("DELETE FROM compounds")
+                self.conn.executemany("INSERT INTO compounds VALUES (?, ?, ?, ?, ?)",
+                                      [(entryStem,) + entry for entryStem, entry in entries.items()])
+            self.entries = entries
+
+    def Lookup(self, FGImageName):
+        """
+        Return path of the current compound image of a foreground image, or None if there is none
+        """
+        entry = self.entries.get(PhotoStem(FGImageName))
+        if entry is None:
+            return None
+        return path.join(self.compoundImagesDir, entry[0])
+
+    def Set(self, FGImageName, BGImageName, tol=(None, None)):
+        """
+        Record a new compound image for a foreground image; returns path of the previous one, or None
+        """
+        stem = PhotoStem(FGImageName)
+        entry = (CompoundImageName(FGImageName, BGImageName), BGImageName, tol[0], tol[1])
+        with self.lock:
+            previous = self.entries.get(stem)
+            with self.conn:
+                self.conn.execute("INSERT OR REPLACE INTO compounds VALUES (?, ?, ?, ?, ?)", (stem,) + entry)
+            self.entries[stem] = entry
+        if previous is None:
+            return None
+        return path.join(self.compoundImagesDir, previous[0])
+
+    def Close(self):
+        with self.lock:
+            self.conn.close()
@@ -5,10 +5,11 @@ Configuration and launch of greenie GUI
 from glob import glob
 import wx
 import threading
+import multiprocessing
 import gui
+import metrics
+import watcher
 import subprocess
-import time
-from os import path
 
 #
 # REQUIRED configuration
@@ -34,9 +35,13 @@ referenceImage = glob("/Users/someuser/greenie/reference/*.[jJ][pP][gG]")[-1]
 PrinterName = "EPSON_XP_750_Series"
 
 # printer options;
-# here: paper source 3 (tray 2), landscape, fit to page, page size as given
-PrinterOptions = ["-o", "EPIJ_FdSo=3", "-o", "landscape", "-o", "fit-to-page", "-o",
-                  "PageSize=Custom.100x153mm", "-o", "EPIJ_Qual=46"]
+# here: paper source 3 (tray 2), landscape, page size as given; no fit-to-page, photos are sent at page size
+PrinterOptions = ["-o", "EPIJ_FdSo=3", "-o", "landscape", "-o", "PageSize=Custom.100x153mm", "-o", "EPIJ_Qual=46"]
+
+# photos are rendered at the printer's page size (width, height in mm, as the photo lies on the page)
+# and resolution before they are sent, so the printer does not have to scale full-resolution images
+PrintPageSizeMM = (153., 100.)
+PrintDPI = 300
 
 #
 # OPTIONAL configuration
@@ -45,9 +50,65 @@ PrinterOptions = ["-o", "EPIJ_FdSo=3", "-o", "landscape", "-o", "fit-to-page", "
 # tolerance values for foreground masking, see greenscreen.Overlay for details
 GreenScreenTol = [30., 40.]
 
-# how often to poll the photoDirs for new photos
+# use a precomputed CbCr lookup table for masking; faster, but Cb and Cr are rounded to 8 bits,
+# which slightly changes the mask in the transition range
+GreenScreenUseLUT = False
+
+# radius (pixels) of the smoothing filter applied to the foreground mask, which also limits green spill
+# at the edges of the guests; larger values give softer edges (0: no smoothing or spill suppression)
+GreenScreenFilterRadius = 1
+
+# number of threads for compositing; each photo is split into horizontal strips processed in parallel
+GreenScreenThreads = multiprocessing.cpu_count()
+
+# memory budget (bytes) for compositing buffers; if set, photos are processed in row bands and keyed photos
+# are not cached (see greenscreen.OverlayStreaming), use this on machines with little memory
+GreenScreenMemoryBudget = None
+
+# number of compound images computed in parallel in the background
+CompositingWorkers = 1
+
+# URL of a compositing service shared by several booth stations (see service.py), e.g. "http://192.168.1.10:8765";
+# compound images are then created by the service, with its reference image and tolerances (None: composite locally)
+CompositingServiceURL = None
+
+# directory for down-scaled previews of backgrounds and compound images, kept across restarts (None: don't keep);
+# not inside the compound or printed images directories, which are handed out
+PreviewCacheDir = "/Users/someuser/greenie/previews"
+
+# memory limit (bytes) for keyed photos kept around so that changing the background skips re-keying,
+# and optional directory to also keep them on disk (None: memory only)
+LayerCacheSize = 512 * 2 ** 20
+LayerCacheDir = None
+
+# directory and disk quota (bytes) for decoded photos, read back memory-mapped when a photo is composited again,
+# e.g. onto another background, instead of decoding the JPEG file again (None: always decode);
+# a 12 MP photo takes 36 MB, so use a directory on a fast local disk outside the photo and output folders,
+# e.g. "/Users/someuser/greenie/frames"
+DecodedFrameCacheDir = None
+DecodedFrameCacheSize = 4 * 2 ** 30
+
+# memory limit (bytes) for decoded backgrounds, kept resized to the photo size
+BackgroundStoreSize = 256 * 2 ** 20
+
+# while backgrounds are browsed, the selected photo is composited at screen size onto this many backgrounds
+# before and after the selected one, so "Change background" shows the result at once (0: off)
+SpeculativeBGs = 2
+
+# per-stage latencies (transfer, detection, decoding, keying, saving, printing etc., see metrics.py):
+# CSV file logging every measurement, JSON file receiving p50/p95 per stage on exit (None: not written),
+# and whether to show p50/p95 per stage on top of the main photo; latencies are measured if any of these is set
+LatencyLogPath = None
+LatencySummaryPath = None
+ShowLatencyStats = False
+
+# how often to poll the photoDirs for new photos; on Linux, inotify reports new photos immediately
+# and this only sets how often the monitoring thread checks for shutdown
 directoryPollingInterval = 1.0
 
+# without inotify, a new photo is picked up once its size and time stamp have been unchanged for this many seconds
+newFileSettleTime = 1.0
+
 #
 # end of configuration
 #
@@ -64,30 +125,29 @@ def monitorPhotoDirs(callOnPresent=True):
     Monitor directories for new image files, call targetFunc on each new file path.
     If 'callOnPresent' is True, targetFunc is initially called for all present files.
     """
-    previous = []
-    for d in photoDirs:
-        previous += glob(path.join(d, "*.[jJ][pP][gG]"))
+    photoDirWatcher = watcher.PhotoDirWatcher(photoDirs, settleTime=newFileSettleTime)
     if callOnPresent:
-        for f in previous:
+        for f in photoDirWatcher.initialFiles:
             greenieGUI.AddFGImage(f)
-    greenieGUI.RefreshGUI()
+    # panels and the photo browser may only be touched from the main thread
+    wx.CallAfter(greenieGUI.RefreshGUI)
     while not stopThreadsFlag:
-        time.sleep(directoryPollingInterval)
-        current = []
-        for d in photoDirs:
-            current += glob(path.join(d, "*.[jJ][pP][gG]"))
-        added = [f for f in current if f not in previous]
+        added = photoDirWatcher.WaitForNewFiles(directoryPollingInterval)
         if len(added) > 0:
             for f in added:
+                metrics.RecordArrival(f)
                 greenieGUI.AddFGImage(f)
-            previous = current
-            greenieGUI.RefreshGUI()
+            wx.CallAfter(greenieGUI.RefreshGUI)
+    photoDirWatcher.Close()
 
 
 if __name__ == '__main__':
     # set default printer
     subprocess.check_call(["lpoptions", "-d", PrinterName])
 
+    if LatencyLogPath is not None or LatencySummaryPath is not None or ShowLatencyStats:
+        metrics.Enable(logPath=LatencyLogPath)
+
     # build and start GUI
     greenieApp = wx.App()
     greenieGUI = gui.GreenieGUI(BGImagesDir=BGImagesDir,
@@ -95,9 +155,30 @@ if __name__ == '__main__':
                                 PrintedImagesDir=PrintedImagesDir,
                                 ReferenceImage=referenceImage,
                                 PrinterOptions=PrinterOptions,
-                                GreenScreenTol=GreenScreenTol)
+                                GreenScreenTol=GreenScreenTol,
+                                GreenScreenUseLUT=GreenScreenUseLUT,
+                                GreenScreenFilterRadius=GreenScreenFilterRadius,
+                                GreenScreenThreads=GreenScreenThreads,
+                                GreenScreenMemoryBudget=GreenScreenMemoryBudget,
+                                CompositingWorkers=CompositingWorkers,
+                                PreviewCacheDir=PreviewCacheDir,
+                                PrinterName=PrinterName,
+                                PrintPageSizeMM=PrintPageSizeMM,
+                                PrintDPI=PrintDPI,
+                                SpeculativeBGs=SpeculativeBGs,
+                                CompositingServiceURL=CompositingServiceURL,
+                                ShowLatencyStats=ShowLatencyStats,
+                                LayerCacheSize=LayerCacheSize,
+                                LayerCacheDir=LayerCacheDir,
+                                BackgroundStoreSize=BackgroundStoreSize,
+                                DecodedFrameCacheDir=DecodedFrameCacheDir,
+                                DecodedFrameCacheSize=DecodedFrameCacheSize)
 
     greenieGUI.Show()
+    # keep a reference, the GUI object is no longer accessible once the window is closed
+    compositingQueue = greenieGUI.CompositingQueue
+    compoundImageWriter = greenieGUI.CompoundImageWriter
+    printSpooler = greenieGUI.PrintSpooler
 
     # start monitoring photo directories
     threadFSMonitor = threading.Thread(target=monitorPhotoDirs, args=(True,))
@@ -108,5 +189,13 @@ if __name__ == '__main__':
     # on return, the app has closed
 
     stopThreadsFlag = True
+    # finish the running compositing jobs and write all results to disk
+    compositingQueue.Stop(wait=True)
+    compoundImageWriter.WaitUntilIdle()
+    printSpooler.Stop()
+    if metrics.Store() is not None:
+        if LatencySummaryPath is not None:
+            metrics.Store().WriteJSON(LatencySummaryPath)
+        metrics.Disable()
 
     pass
@@ -4,6 +4,8 @@ Green screen image processing
 
 from PIL import Image
 import numpy as np
+import threading
+from multiprocessing.pool import ThreadPool
 
 
 def ImageToYCbCrNumpy(img):
@@ -49,42 +51,670 @@ def GetRefColor(refImage):
     return refColorRGB, refColorYCbCr
 
 
-def Overlay(fgImage, bgImage, refColors, tolA=30.0, tolB=40.0, filterRadius=1):
+# number of image rows processed at once by Overlay; bounds the size of the float32 work buffers
+OverlayBandRows = 128
+
+# largest supported filterRadius, see SmoothMask()
+MaxFilterRadius = 64
+# up to this radius, box filter sums are added up directly, which is faster than running sums
+_DirectSumMaxRadius = 2
+
+
+def KeyMask(rgbNp, refColorYCbCr, tolA, tolB, mask, work):
+    """
+    Compute the green-screen mask of an RGB array in place, without building a full YCbCr image.
+
+    Only Cb and Cr are computed, with the reference color folded into the constant term.
+
+    Args:
+        rgbNp (np.ndarray): HxWx3 uint8 RGB array
+        refColorYCbCr (np.ndarray): YCbCr reference color, from GetRefColor()
+        tolA (float): lower bound on linear transition range for masking, see Overlay()
+        tolB (float): upper bound on linear transition range for masking, see Overlay()
+        mask (np.ndarray): HxW float32 output array, 1 where the background shows through
+        work (np.ndarray): 2xHxW float32 work array
+
+    Returns:
+        np.ndarray: the mask array
+    """
+    R = rgbNp[:, :, 0]
+    G = rgbNp[:, :, 1]
+    B = rgbNp[:, :, 2]
+    cr = work[0]
+    tmp = work[1]
+
+    # same coefficients as ImageToYCbCrNumpy; Cb goes straight into the mask buffer
+    cb = mask
+    np.multiply(R, np.float32(-0.169), out=cb)
+    np.multiply(G, np.float32(-0.331), out=tmp)
+    cb += tmp
+    np.multiply(B, np.float32(0.5), out=tmp)
+    cb += tmp
+    cb += np.float32(128. - float(refColorYCbCr[1]))
+
+    np.multiply(R, np.float32(0.5), out=cr)
+    np.multiply(G, np.float32(-0.419), out=tmp)
+    cr += tmp
+    np.multiply(B, np.float32(-0.081), out=tmp)
+    cr += tmp
+    cr += np.float32(128. - float(refColorYCbCr[2]))
+
+    # distance in CbCr space
+    cb *= cb
+    cr *= cr
+    cb += cr
+    np.sqrt(cb, out=cb)
+
+    if tolB <= tolA:
+        # no transition range, hard threshold
+        np.less(mask, np.float32(tolA), out=mask)
+        return mask
+    # linear transition from 1 below tolA to 0 above tolB
+    mask -= np.float32(tolB)
+    mask *= np.float32(-1.0 / (tolB - tolA))
+    np.clip(mask, 0.0, 1.0, out=mask)
+    return mask
+
+
+def MakeAlphaLUT(refColorYCbCr, tolA=30.0, tolB=40.0):
+    """
+    Tabulate the mask of KeyMask() for all integer (Cb, Cr) pairs.
+
+    Args:
+        refColorYCbCr (np.ndarray): YCbCr reference color, from GetRefColor()
+        tolA (float): lower bound on linear transition range for masking, see Overlay()
+        tolB (float): upper bound on linear transition range for masking, see Overlay()
+
+    Returns:
+        np.ndarray: 256x256 uint8 table of mask values scaled to 0..255, indexed by [Cb, Cr]
+    """
+    cb = np.arange(256, dtype=np.float32)[:, np.newaxis] - np.float32(refColorYCbCr[1])
+    cr = np.arange(256, dtype=np.float32)[np.newaxis, :] - np.float32(refColorYCbCr[2])
+    colDist = np.sqrt(cb ** 2 + cr ** 2)
+    if tolB <= tolA:
+        mask = (colDist < tolA).astype(np.float32)
+    else:
+        mask = np.clip((tolB - colDist) / (tolB - tolA), 0.0, 1.0)
+    return (mask * 255.0 + 0.5).astype(np.uint8)
+
+
+def _FixedPointChannel(rgbNp, coefs, out, tmp):
+    """ 128 + coefs . (R, G, B), with coefs given in units of 2^-16 and summing to zero, rounded to int """
+    np.multiply(rgbNp[:, :, 0], coefs[0], out=out, dtype=np.int32)
+    for c in (1, 2):
+        np.multiply(rgbNp[:, :, c], coefs[c], out=tmp, dtype=np.int32)
+        out += tmp
+    out += (128 << 16) + (1 << 15)
+    out >>= 16
+    # saturated colors round up to 256, one past the table
+    np.minimum(out, 255, out=out)
+    return out
+
+
+def KeyMaskLUT(rgbNp, alphaLUT, mask, work):
+    """
+    Compute the green-screen mask of an RGB array with a single table lookup per pixel, see MakeAlphaLUT().
+
+    Cb and Cr are computed in fixed point integer arithmetic and rounded to 8 bits, so in the transition
+    range the mask deviates slightly from the one computed by KeyMask().
+
+    Args:
+        rgbNp (np.ndarray): HxWx3 uint8 RGB array
+        alphaLUT (np.ndarray): 256x256 uint8 table, from MakeAlphaLUT()
+        mask (np.ndarray): HxW float32 output array, 1 where the background shows through
+        work (np.ndarray): 2xHxW float32 work array, reused as int32 storage
+
+    Returns:
+        np.ndarray: the mask array
+    """
+    idx = work[0].view(np.int32)
+    tmp = work[1].view(np.int32)
+    cr = mask.view(np.int32)
+
+    # table index is 256 * Cb + Cr
+    _FixedPointChannel(rgbNp, (-11076, -21692, 32768), idx, tmp)
+    idx <<= 8
+    _FixedPointChannel(rgbNp, (32768, -27460, -5308), cr, tmp)
+    idx += cr
+
+    alpha = np.take(alphaLUT.ravel(), idx)
+    np.multiply(alpha, np.float32(1.0 / 255.0), out=mask)
+    return mask
+
+
+def _ForegroundTerm(fgChannel, mask, invMask, refColorChannel, term):
+    """ (1 - mask) * max(fg - mask * ref, 0) for a single channel, written to term """
+    np.multiply(mask, np.float32(refColorChannel), out=term)
+    np.subtract(fgChannel, term, out=term)
+    np.maximum(term, 0.0, out=term)
+    term *= invMask
+    return term
+
+
+def _ChannelOrder(refColorRGB, spillGain):
+    """ Order in which the channels are blended; with spill suppression, the dominant channel comes last """
+    if spillGain is None:
+        return [0, 1, 2]
+    c = int(np.argmax(refColorRGB))
+    return [o for o in range(3) if o != c] + [c]
+
+
+def _LimitSpill(term, step, mask, spillGain, limit, tmp):
+    """
+    Spill suppression on the foreground terms of the channels, in the order of _ChannelOrder():
+    the term of the dominant channel of the reference color (green for a green screen) is limited to
+    the average of the other two, in proportion to min(1, spillGain * mask), i.e. only where the
+    background shows through nearby.
+    """
+    if step == 0:
+        np.multiply(term, np.float32(0.5), out=limit)
+    elif step == 1:
+        np.multiply(term, np.float32(0.5), out=tmp)
+        limit += tmp
+    else:
+        # excess of the dominant channel, scaled by the suppression strength
+        np.subtract(term, limit, out=limit)
+        np.clip(limit, 0.0, 255.0, out=limit)
+        np.multiply(mask, np.float32(spillGain), out=tmp)
+        np.clip(tmp, 0.0, 1.0, out=tmp)
+        limit *= tmp
+        term -= limit
+
+
+def BlendMasked(fgNp, bgNp, mask, refColorRGB, out, work, spillGain=None):
+    """
+    Blend foreground and background according to a mask, removing the reference color from the foreground.
+
+    Args:
+        fgNp (np.ndarray): HxWx3 uint8 foreground array
+        bgNp (np.ndarray): HxWx3 uint8 background array
+        mask (np.ndarray): HxW float32 mask, from KeyMask()
+        refColorRGB (np.ndarray): RGB reference color, from GetRefColor()
+        out (np.ndarray): HxWx3 uint8 output array
+        work (np.ndarray): 3xHxW float32 work array, 4xHxW with spillGain
+        spillGain (float): if given, reference color spill is suppressed near the background, see _LimitSpill()
+
+    Returns:
+        np.ndarray: the output array
+    """
+    invMask = work[0]
+    term = work[1]
+    tmp = work[2]
+    np.subtract(np.float32(1.0), mask, out=invMask)
+    for step, c in enumerate(_ChannelOrder(refColorRGB, spillGain)):
+        _ForegroundTerm(fgNp[:, :, c], mask, invMask, refColorRGB[c], term)
+        if spillGain is not None:
+            _LimitSpill(term, step, mask, spillGain, work[3], tmp)
+        np.multiply(mask, bgNp[:, :, c], out=tmp)
+        term += tmp
+        np.copyto(out[:, :, c], term, casting="unsafe")
+    return out
+
+
+def BackgroundArray(bgImage, size):
+    """
+    RGB array of a background image at the given size
+
+    Args:
+        bgImage (Image or np.ndarray): background image, is resized if needed;
+                                       arrays (e.g. from caching.BackgroundStore) must already have the right size
+        size ((int, int)): target size as (width, height)
+
+    Returns:
+        np.ndarray: HxWx3 uint8 array
+    """
+    if isinstance(bgImage, np.ndarray):
+        if bgImage.shape[:2] != (size[1], size[0]):
+            raise ValueError("background array has shape %s, expected size %s" % (str(bgImage.shape), str(size)))
+        return bgImage
+    if bgImage.size != size:
+        bgImage = bgImage.resize(size)
+    return np.asarray(bgImage)
+
+
+_threadPools = {}
+_threadPoolsLock = threading.Lock()
+
+
+def _GetThreadPool(nThreads):
+    """ Shared thread pool with the given number of workers, created on first use """
+    with _threadPoolsLock:
+        if nThreads not in _threadPools:
+            _threadPools[nThreads] = ThreadPool(nThreads)
+        return _threadPools[nThreads]
+
+
+def ForEachBand(height, width, nWorkPlanes, bandFunc, nThreads=1, bandRows=None, haloRows=0):
+    """
+    Call bandFunc(r0, r1, work) for consecutive bands of image rows, or bandFunc(r0, r1, work, carry) if
+    haloRows > 0.
+
+    With nThreads > 1, the image is split into one horizontal strip per thread and the strips are
+    processed on a shared thread pool; numpy releases the GIL, so this scales across cores.
+    Each strip gets its own work buffers, bands must not depend on each other. With haloRows > 0, each strip
+    also gets a _HaloCarry, for handing rows computed for one band's halo over to the next band.
+
+    Args:
+        height (int): number of image rows
+        width (int): number of image columns
+        nWorkPlanes (int): number of HxW float32 work planes passed to bandFunc
+        bandFunc (callable): called with first row, end row and nWorkPlanes x (r1 - r0 + 2 * haloRows) x width
+                             work array, plus the strip's _HaloCarry if haloRows > 0
+        nThreads (int): number of threads to use
+        bandRows (int): number of rows per band, defaults to OverlayBandRows
+        haloRows (int): extra work rows for reading beyond the band, e.g. for filtering
+    """
+    if bandRows is None:
+        bandRows = OverlayBandRows
+
+    def ProcessStrip(strip):
+        s0, s1 = strip
+        work = np.empty((nWorkPlanes, min(bandRows, s1 - s0) + 2 * haloRows, width), dtype=np.float32)
+        extraArgs = (_HaloCarry(haloRows, width),) if haloRows > 0 else ()
+        for r0 in range(s0, s1, bandRows):
+            r1 = min(s1, r0 + bandRows)
+            bandFunc(r0, r1, work[:, :r1 - r0 + 2 * haloRows], *extraArgs)
+
+    # strip boundaries are aligned to bands, to keep the band layout independent of the thread count
+    nBands = (height + bandRows - 1) // bandRows
+    nStrips = max(1, min(nThreads, nBands))
+    bounds = [min(height, (i * nBands // nStrips) * bandRows) for i in range(nStrips + 1)]
+    strips = zip(bounds[:-1], bounds[1:])
+    if nStrips == 1:
+        map(ProcessStrip, strips)
+    else:
+        _GetThreadPool(nThreads).map(ProcessStrip, strips)
+
+
+class _HaloCarry(object):
+    """
+    Raw mask rows keyed by a band for its bottom halo, which are the top halo rows of the next band of the
+    same strip; they are handed over instead of being keyed again, see ForEachBand()
+
+    Attributes:
+        rows (np.ndarray): 2 * haloRows x width float32 mask rows, the first nRows of which are valid
+        firstRow (int): image row of rows[0], None if there are no rows yet
+    """
+
+    def __init__(self, haloRows, width):
+        self.rows = np.empty((2 * haloRows, width), dtype=np.float32)
+        self.nRows = 0
+        self.firstRow = None
+
+    def Keep(self, firstRow, rows):
+        self.nRows = min(len(rows), len(self.rows))
+        np.copyto(self.rows[:self.nRows], rows[:self.nRows])
+        self.firstRow = firstRow
+
+    def Take(self, firstRow, mask):
+        """ Copy the kept rows to the top of mask if they start at image row firstRow; returns their number """
+        if self.firstRow != firstRow:
+            return 0
+        n = min(self.nRows, len(mask))
+        np.copyto(mask[:n], self.rows[:n])
+        return n
+
+
+def _KeyBand(rgbNp, refColors, tolA, tolB, alphaLUT, mask, work):
+    """ Compute mask with KeyMask() or KeyMaskLUT(), depending on whether a table is given """
+    if alphaLUT is None:
+        return KeyMask(rgbNp, refColors[1], tolA, tolB, mask, work)
+    else:
+        return KeyMaskLUT(rgbNp, alphaLUT, mask, work)
+
+
+def _BoxSum(src, radius, out, cs):
+    """
+    Sums of src over windows of 2 * radius + 1 elements along the last axis, clipped at the ends.
+
+    Small radii are summed directly, larger ones from a running sum in cs, so the cost does not grow
+    with the radius. For integer-valued src, both give the same result.
+    """
+    n = src.shape[-1]
+    r = radius
+    if r <= _DirectSumMaxRadius:
+        np.copyto(out, src)
+        for k in range(1, r + 1):
+            if k < n:
+                out[..., k:] += src[..., :-k]
+                out[..., :-k] += src[..., k:]
+        return out
+    np.cumsum(src, axis=-1, out=cs)
+    # windows clipped at the start, the end, both, or neither
+    a1 = min(r, n - 1 - r) + 1
+    if a1 > 0:
+        out[..., :a1] = cs[..., r:r + a1]
+    b0, b1 = max(0, n - r), r + 1
+    if b1 > b0:
+        out[..., b0:b1] = cs[..., n - 1:n]
+    c0, c1 = r + 1, n - r
+    if c1 > c0:
+        np.subtract(cs[..., c0 + r:c1 + r], cs[..., c0 - r - 1:c1 - r - 1], out=out[..., c0:c1])
+    d0, d1 = max(r + 1, n - r), n
+    if d1 > d0:
+        np.subtract(cs[..., n - 1:n], cs[..., d0 - r - 1:d1 - r - 1], out=out[..., d0:d1])
+    return out
+
+
+def _WindowCounts(n, radius):
+    """ Number of elements in each window of _BoxSum() """
+    idx = np.arange(n)
+    return np.minimum(idx + radius, n - 1) - np.maximum(idx - radius, 0) + 1
+
+
+def SmoothMask(mask, radius, work):
+    """
+    Smooth a mask in place with a (2 * radius + 1)^2 box filter, clipped at the array borders.
+
+    The filter is separable and uses running sums, so the cost per pixel does not depend on the radius.
+    The mask is quantized to steps of 1/255 first; the running sums are then integers and exact in float32,
+    so smoothing a band with radius extra rows above and below gives the same result as smoothing
+    the whole image (see _FilterBandRows()).
+
+    Args:
+        mask (np.ndarray): HxW float32 mask, from KeyMask()
+        radius (int): filter radius, up to MaxFilterRadius
+        work (np.ndarray): 2xHxW float32 work array
+
+    Returns:
+        np.ndarray: the mask array
+    """
+    height, width = mask.shape
+    cs = work[0]
+    rowSums = work[1]
+    mask *= np.float32(255.0)
+    # round to integers: adding 2^23 leaves no fractional bits in float32
+    mask += np.float32(2 ** 23)
+    mask -= np.float32(2 ** 23)
+    _BoxSum(mask, radius, rowSums, cs)
+    _BoxSum(rowSums.T, radius, mask.T, cs.T)
+    # divide by 255 times the window size, which is only smaller than (2 * radius + 1)^2 near the borders
+    full = 2 * radius + 1
+    mask *= np.float32(1.0 / (255.0 * full * full))
+    for counts, view in ((_WindowCounts(width, radius), mask), (_WindowCounts(height, radius), mask.T)):
+        n = len(counts)
+        if n <= 2 * radius:
+            view *= (float(full) / counts).astype(np.float32)
+        else:
+            view[..., :radius] *= (float(full) / counts[:radius]).astype(np.float32)
+            view[..., n - radius:] *= (float(full) / counts[n - radius:]).astype(np.float32)
+    return mask
+
+
+def ClampFilterRadius(filterRadius, width, height):
+    """ filterRadius limited to what the image size and MaxFilterRadius allow """
+    return max(0, min(int(filterRadius), MaxFilterRadius, (width - 1) // 2, (height - 1) // 2))
+
+
+def _FilterBandRows(bandRows, filterRadius):
+    """ Limit band height so that the vertical running sums of SmoothMask() stay exact in float32 """
+    if filterRadius == 0:
+        return bandRows
+    return max(1, min(bandRows, 2 ** 24 // (255 * (2 * filterRadius + 1)) - 2 * filterRadius))
+
+
+def _SpillGain(filterRadius):
+    """ Spill suppression is at full strength once one pixel in the filter window is pure background """
+    return (2 * filterRadius + 1) ** 2 if filterRadius > 0 else None
+
+
+def _OverlayBandRows(filterRadius):
+    """ Band height for Overlay(); larger radii get larger bands, so that few halo rows are smoothed twice """
+    return _FilterBandRows(max(OverlayBandRows, 8 * filterRadius), filterRadius)
+
+
+def OverlayWorkPlanes(filterRadius):
+    """ Number of work planes needed by OverlayArrays() """
+    return 5 if filterRadius > 0 else 4
+
+
+def _RefinedMask(fgNp, refColors, tolA, tolB, alphaLUT, filterRadius, rows, work, carry=None, firstRow=0):
+    """
+    Mask of fgNp, smoothed if filterRadius > 0; returns the rows r0:r1 of it, a view into work[0]
+
+    With a carry, rows keyed by the previous band are not keyed again, and the rows the next band needs are kept.
+    """
+    n = fgNp.shape[0]
+    mask = work[0, :n]
+    k = carry.Take(firstRow, mask) if carry is not None else 0
+    _KeyBand(fgNp[k:], refColors, tolA, tolB, alphaLUT, mask[k:], work[1:3, :n - k])
+    if filterRadius > 0:
+        if carry is not None:
+            # the next band starts filterRadius rows above the end of this one, see ForEachBand()
+            carry.Keep(firstRow + rows[1] - filterRadius, mask[rows[1] - filterRadius:])
+        SmoothMask(mask, filterRadius, work[1:3, :n])
+    return mask[rows[0]:rows[1]]
+
+
+def OverlayArrays(fgNp, bgNp, refColors, tolA, tolB, alphaLUT, out, work, filterRadius=0, rows=None, carry=None,
+                  firstRow=0):
+    """
+    Key and blend arrays into caller-provided buffers, without allocating any image-sized memory
+
+    Used for the bands of Overlay(), and for repeatedly compositing frames of the same size,
+    see livepreview.py.
+
+    Args:
+        fgNp (np.ndarray): HxWx3 uint8 foreground array
+        bgNp (np.ndarray): background array of the rows to composite, see 'rows'
+        refColors, tolA, tolB, alphaLUT, filterRadius: see Overlay()
+        out (np.ndarray): uint8 output array of the rows to composite
+        work (np.ndarray): NxHxW float32 work array, N from OverlayWorkPlanes()
+        rows ((int, int)): rows r0:r1 of fgNp to composite, the others are only used for filtering the mask;
+                           defaults to all rows
+        carry (_HaloCarry): mask rows shared with the neighbouring bands, from ForEachBand()
+        firstRow (int): image row of fgNp[0], for the carry
+
+    Returns:
+        np.ndarray: the output array
+    """
+    if rows is None:
+        rows = (0, fgNp.shape[0])
+    mask = _RefinedMask(fgNp, refColors, tolA, tolB, alphaLUT, filterRadius, rows, work, carry, firstRow)
+    n = rows[1] - rows[0]
+    return BlendMasked(fgNp[rows[0]:rows[1]], bgNp, mask, refColors[0], out,
+                       work[1:OverlayWorkPlanes(filterRadius), :n], _SpillGain(filterRadius))
+
+
+class KeyedForeground(object):
+    """
+    Background-independent part of a composite, see KeyForeground().
+
+    Compositing onto a background only adds mask * background to the stored foreground term.
+    The mask is stored as float16 and the foreground term as rounded uint8, so composites match
+    Overlay() within +-1 per channel.
+
+    Attributes:
+        mask (np.ndarray): HxW float16 mask, 1 where the background shows through
+        fgTerm (np.ndarray): HxWx3 uint8 spill-corrected and masked foreground
+    """
+
+    def __init__(self, mask, fgTerm):
+        self.mask = mask
+        self.fgTerm = fgTerm
+
+    @property
+    def size(self):
+        """ image size as (width, height), like Image.size """
+        return self.mask.shape[1], self.mask.shape[0]
+
+    @property
+    def nbytes(self):
+        return self.mask.nbytes + self.fgTerm.nbytes
+
+    def Composite(self, bgImage, nThreads=1):
+        """
+        Composite onto a background
+
+        Args:
+            bgImage (Image or np.ndarray): background image, see BackgroundArray()
+            nThreads (int): number of threads to use, see ForEachBand()
+
+        Returns:
+            Image: composited image
+        """
+        bgNp = BackgroundArray(bgImage, self.size)
+        height, width = self.mask.shape
+        compNp = np.empty((height, width, 3), dtype=np.uint8)
+
+        def CompositeBand(r0, r1, work):
+            mask, term, tmp = work
+            np.copyto(mask, self.mask[r0:r1])
+            for c in range(3):
+                np.copyto(term, self.fgTerm[r0:r1, :, c])
+                np.multiply(mask, bgNp[r0:r1, :, c], out=tmp)
+                term += tmp
+                np.copyto(compNp[r0:r1, :, c], term, casting="unsafe")
+
+        ForEachBand(height, width, 3, CompositeBand, nThreads)
+        return Image.fromarray(compNp, "RGB")
+
+
+def KeyForeground(fgImage, refColors, tolA=30.0, tolB=40.0, alphaLUT=None, nThreads=1, filterRadius=1):
+    """
+    Remove green-screen pixels from foreground, without compositing onto a background yet
+
+    Args:
+        fgImage (Image or np.ndarray): foreground image, see Overlay()
+        refColors ((np.ndarray, np.ndarray)): RGB and YCbCr reference colors, from GetRefColor()
+        tolA (float): lower bound on linear transition range for masking, see Overlay()
+        tolB (float): upper bound on linear transition range for masking, see Overlay()
+        alphaLUT (np.ndarray): optional table from MakeAlphaLUT(), see Overlay()
+        nThreads (int): number of threads to use, see ForEachBand()
+        filterRadius (int): mask smoothing and spill suppression, see Overlay()
+
+    Returns:
+        KeyedForeground: mask and foreground term, to be composited onto any background
+    """
+    fgNp = np.asarray(fgImage)
+    height, width = fgNp.shape[:2]
+    keyed = KeyedForeground(np.empty((height, width), dtype=np.float16),
+                            np.empty((height, width, 3), dtype=np.uint8))
+    radius = ClampFilterRadius(filterRadius, width, height)
+    spillGain = _SpillGain(radius)
+
+    def KeyBand(r0, r1, work, carry=None):
+        h0, h1 = max(0, r0 - radius), min(height, r1 + radius)
+        mask = _RefinedMask(fgNp[h0:h1], refColors, tolA, tolB, alphaLUT, radius, (r0 - h0, r1 - h0), work,
+                            carry, h0)
+        np.copyto(keyed.mask[r0:r1], mask, casting="same_kind")
+        invMask, term = work[1:3, :r1 - r0]
+        # without smoothing, there is no spill suppression and no work planes for it, see OverlayWorkPlanes()
+        limit, tmp = work[3:5, :r1 - r0] if spillGain is not None else (None, None)
+        np.subtract(np.float32(1.0), mask, out=invMask)
+        for step, c in enumerate(_ChannelOrder(refColors[0], spillGain)):
+            _ForegroundTerm(fgNp[r0:r1, :, c], mask, invMask, refColors[0][c], term)
+            if spillGain is not None:
+                _LimitSpill(term, step, mask, spillGain, limit, tmp)
+            term += np.float32(0.5)
+            np.copyto(keyed.fgTerm[r0:r1, :, c], term, casting="unsafe")
+
+    ForEachBand(height, width, OverlayWorkPlanes(radius), KeyBand, nThreads,
+                _OverlayBandRows(radius), radius)
+    return keyed
+
+
+def Overlay(fgImage, bgImage, refColors, tolA=30.0, tolB=40.0, filterRadius=1, alphaLUT=None, nThreads=1):
     """
     Overlay foreground onto background, after removing green-screen pixels from foreground
 
+    The image is processed in bands of OverlayBandRows rows, so the float work buffers stay small
+    regardless of the image size. With nThreads > 1, bands are processed in parallel; the result
+    does not depend on the number of threads.
+
+    With filterRadius > 0, the mask is smoothed with a box filter of that radius (see SmoothMask()) to avoid
+    hard, fringed edges, and the reference color is removed from foreground pixels near the background
+    (spill suppression). This costs the same for any radius.
+
     Args:
-        fgImage (Image): foreground image
-        bgImage (Image): background image, is resized to fgImage if needed
+        fgImage (Image or np.ndarray): foreground image, or HxWx3 uint8 array of it (e.g. memory-mapped,
+                                       see caching.DecodedFrameCache)
+        bgImage (Image or np.ndarray): background image, is resized to fgImage if needed, see BackgroundArray()
         refColors ((np.ndarray, np.ndarray)): RGB and YCbCr reference colors, from GetRefColor()
         tolA (float): lower bound on linear transition range for masking,
                       pixels with lower CbCr-distance are not removed from the foreground image
         tolB (float): upper bound on linear transition range for masking,
                       pixels with higher CbCr-distance are removed completely from the foreground image
+        filterRadius (int): radius in pixels for mask smoothing and spill suppression, 0 to disable;
+                            limited to MaxFilterRadius
+        alphaLUT (np.ndarray): optional table from MakeAlphaLUT(); if given, the mask is looked up from it
+                               and tolA, tolB and the YCbCr reference color are not used
+        nThreads (int): number of threads to use, see ForEachBand()
 
     Returns:
         Image: composited image
     """
 
+    fgNp = np.asarray(fgImage)
+    height, width = fgNp.shape[:2]
     # automatically resize background
-    if fgImage.size != bgImage.size:
-        bgImage = bgImage.resize(fgImage.size)
+    bgNp = BackgroundArray(bgImage, (width, height))
+    compNp = np.empty((height, width, 3), dtype=np.uint8)
+    radius = ClampFilterRadius(filterRadius, width, height)
 
-    # compute distance in CbCr space
-    yFg = ImageToYCbCrNumpy(fgImage)
-    colDist = np.sqrt(np.sum((yFg[:, :, 1:] - refColors[1][1:]) ** 2, axis=2))
+    def OverlayBand(r0, r1, work, carry=None):
+        h0, h1 = max(0, r0 - radius), min(height, r1 + radius)
+        OverlayArrays(fgNp[h0:h1], bgNp[r0:r1], refColors, tolA, tolB, alphaLUT, compNp[r0:r1], work,
+                      radius, (r0 - h0, r1 - h0), carry, h0)
 
-    # compute mask with linear transition region
-    mask = np.zeros(yFg.shape[:2])
-    mask[colDist < tolB] = 1.0 - (colDist[colDist < tolB] - tolA) / (tolB - tolA)
-    mask[colDist < tolA] = 1.0
+    ForEachBand(height, width, OverlayWorkPlanes(radius), OverlayBand, nThreads,
+                _OverlayBandRows(radius), radius)
+    return Image.fromarray(compNp, "RGB")
 
-    fgNp = np.asarray(fgImage)
-    bgNp = np.asarray(bgImage)
 
-    # composite the image
-    compNp = ((1.0 - mask[:, :, np.newaxis])
-              * np.maximum(fgNp - mask[:, :, np.newaxis] * refColors[0][np.newaxis, np.newaxis, :], 0)
-              + mask[:, :, np.newaxis] * bgNp).astype(np.uint8)
+# bytes per pixel of one band in OverlayStreaming, besides the float32 work planes: the cropped foreground
+# as PIL image (4 bytes per pixel) and array, and the output band as array and PIL image
+_StreamingBandBytesPerPixel = 4 + 3 + 3 + 4
 
-    return Image.fromarray(compNp, "RGB")
+
+def StreamingBandRows(width, memoryBudget, nThreads=1, filterRadius=0):
+    """ Number of rows per band so that the band buffers of all threads fit into memoryBudget bytes """
+    bytesPerPixel = 4 * OverlayWorkPlanes(filterRadius) + _StreamingBandBytesPerPixel
+    rows = int(memoryBudget // (bytesPerPixel * width * max(1, nThreads))) - 2 * filterRadius
+    return _FilterBandRows(max(1, rows), filterRadius)
+
+
+def OverlayStreaming(fgImage, bgImage, refColors, tolA=30.0, tolB=40.0, alphaLUT=None, nThreads=1,
+                     memoryBudget=64 * 2 ** 20, filterRadius=1):
+    """
+    Like Overlay(), but with the per-band working memory capped by a budget instead of scaling with the image.
+
+    The foreground is cropped band by band from the decoded image and each composited band is pasted
+    into the output image right away, so apart from the band buffers only the decoded foreground,
+    the background array and the output image are held in memory. The result is identical to Overlay().
+
+    Args:
+        fgImage (Image or np.ndarray): foreground image, may still be undecoded (fresh from Image.open);
+                                       or HxWx3 uint8 array of it, bands are then read from it without copying
+        bgImage (Image or np.ndarray): background image, see BackgroundArray()
+        refColors, tolA, tolB, alphaLUT, nThreads, filterRadius: see Overlay()
+        memoryBudget (int): bytes available for band buffers, summed over all threads
+
+    Returns:
+        Image: composited image
+    """
+    if isinstance(fgImage, np.ndarray):
+        height, width = fgImage.shape[:2]
+        CropRows = lambda h0, h1: fgImage[h0:h1]
+    else:
+        if fgImage.mode != "RGB":
+            fgImage = fgImage.convert("RGB")
+        width, height = fgImage.size
+        fgImage.load()
+        CropRows = lambda h0, h1: np.asarray(fgImage.crop((0, h0, width, h1)))
+    bgNp = BackgroundArray(bgImage, (width, height))
+    compImage = Image.new("RGB", (width, height))
+
+    radius = ClampFilterRadius(filterRadius, width, height)
+
+    def OverlayBand(r0, r1, work, carry=None):
+        h0, h1 = max(0, r0 - radius), min(height, r1 + radius)
+        fgNp = CropRows(h0, h1)
+        compNp = np.empty((r1 - r0, width, 3), dtype=np.uint8)
+        OverlayArrays(fgNp, bgNp[r0:r1], refColors, tolA, tolB, alphaLUT, compNp, work, radius, (r0 - h0, r1 - h0),
+                      carry, h0)
+        compImage.paste(Image.fromarray(compNp, "RGB"), (0, r0))
+
+    ForEachBand(height, width, OverlayWorkPlanes(radius), OverlayBand, nThreads,
+                StreamingBandRows(width, memoryBudget, nThreads, radius), radius)
+    return compImage
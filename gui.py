@@ -7,12 +7,16 @@ import wx
 from glob import glob
 from os import path
 import greenscreen
+import caching
+import compositing
+import compoundindex
+import metrics
+import photobrowser
+import printing
+import service
 from PIL import Image
 import os
-from numpy import random
-import shutil
-import datetime
-import subprocess
+import threading
 
 
 # GUI layout
@@ -25,8 +29,17 @@ nFGSelectorPreviewPanels = 3  # number of 'preview' items in FG selector, each b
 nFGTotalPreviewPanels = 2 * nFGSelectorPreviewPanels + 1
 iMainFGPanel = 2 * nFGSelectorPreviewPanels + 1
 iMidFGPanel = nFGSelectorPreviewPanels
-nFGThumbnailCache = 30  # cache size for thumbnail cache
+FGThumbnailCacheBytes = 256 * 2 ** 20  # memory limit for foreground thumbnail cache
+nFGThumbnailPrefetch = nFGSelectorPreviewPanels + 10  # thumbnails loaded ahead in each direction
+BGPreviewCacheBytes = 512 * 2 ** 20  # memory limit for background previews
+FGRenderCacheBytes = 128 * 2 ** 20  # memory limit for compound images rendered at panel size
+MainFGImageCacheBytes = 64 * 2 ** 20  # memory limit for compound images decoded at main panel size
+nMainFGPrefetch = 2  # compound images decoded at main panel size ahead in each direction
+BGScaledBitmapCacheBytes = 64 * 2 ** 20  # memory limit for background previews scaled to panel size
 SelectedImageBorderWidth = 6  # border around selected composite image
+PreviewLayerCacheBytes = 128 * 2 ** 20  # memory limit for photos keyed at main panel size
+SpeculativeCompositeCacheBytes = 128 * 2 ** 20  # memory limit for composites computed ahead at main panel size
+LatencyStatsInterval = 1000  # ms between updates of the latency statistics shown on the main photo
 
 
 # file name conventions:
@@ -36,9 +49,11 @@ SelectedImageBorderWidth = 6  # border around selected composite image
 
 
 def PILImageToWxBitmap(img):
-    image = wx.EmptyImage(img.size[0], img.size[1])
-    image.SetData(img.convert("RGB").tostring())
-    return wx.BitmapFromImage(image)
+    if img.mode != "RGB":
+        img = img.convert("RGB")
+    # the bitmap is created from the pixel bytes, without an intermediate wx.Image; tobytes() copies them once,
+    # which cannot be avoided as PIL stores RGB padded to four bytes per pixel
+    return wx.BitmapFromBuffer(img.size[0], img.size[1], img.tobytes())
 
 
 class GreenieGUI(wx.Frame):
@@ -49,7 +64,24 @@ class GreenieGUI(wx.Frame):
                  PrintedImagesDir,
                  ReferenceImage,
                  PrinterOptions,
-                 GreenScreenTol):
+                 GreenScreenTol,
+                 GreenScreenUseLUT=False,
+                 GreenScreenFilterRadius=1,
+                 GreenScreenThreads=1,
+                 GreenScreenMemoryBudget=None,
+                 CompositingWorkers=1,
+                 LayerCacheSize=512 * 2 ** 20,
+                 LayerCacheDir=None,
+                 BackgroundStoreSize=256 * 2 ** 20,
+                 DecodedFrameCacheDir=None,
+                 DecodedFrameCacheSize=4 * 2 ** 30,
+                 PreviewCacheDir=None,
+                 PrinterName=None,
+                 PrintPageSizeMM=(153., 100.),
+                 PrintDPI=300,
+                 SpeculativeBGs=2,
+                 CompositingServiceURL=None,
+                 ShowLatencyStats=False):
 
         wx.Frame.__init__(self, None, title="Greenie GUI", pos=(0, 22), size=(1276, 778),
                           style=wx.CAPTION | wx.CLOSE_BOX | wx.CLIP_CHILDREN | wx.SYSTEM_MENU)
@@ -60,6 +92,12 @@ class GreenieGUI(wx.Frame):
         self.ReferenceImagePath = ReferenceImage
         self.PrinterOptions = PrinterOptions
         self.GreenScreenTol = GreenScreenTol
+        self.GreenScreenUseLUT = GreenScreenUseLUT
+        self.GreenScreenFilterRadius = GreenScreenFilterRadius
+        self.GreenScreenThreads = GreenScreenThreads
+        self.GreenScreenMemoryBudget = GreenScreenMemoryBudget
+        self.SpeculativeBGs = SpeculativeBGs
+        self.CompositingServiceURL = CompositingServiceURL
 
         self.Bind(wx.EVT_CLOSE, self.OnClose)
 
@@ -113,7 +151,7 @@ class GreenieGUI(wx.Frame):
         PhotoControlSelectorBox = wx.BoxSizer(wx.VERTICAL)
         PhotoControlSelectorPanel.SetSizer(PhotoControlSelectorBox)
 
-        ImageViewerPanel = wx.Panel(PhotoControlSelectorPanel)
+        self.ImageViewerPanel = ImageViewerPanel = wx.Panel(PhotoControlSelectorPanel)
         PhotoControlSelectorBox.Add(ImageViewerPanel, 5, wx.ALL | wx.EXPAND, border=5)
         ImageViewerPanelBox = wx.BoxSizer(wx.VERTICAL)
         ImageViewerPanel.SetSizer(ImageViewerPanelBox)
@@ -181,106 +219,469 @@ class GreenieGUI(wx.Frame):
         ImageViewerButtonPanelBox.Add(ImageLastButton, 0, wx.ALL | wx.ALIGN_CENTER, 5)
         ImageLastButton.Bind(wx.EVT_BUTTON, lambda evt, idx=iMidFGPanel + 1000000: self.OnFGImageClick(evt, idx))
 
-        ImageViewerButtonPanelBox.AddStretchSpacer(3)
+        ImageViewerButtonPanelBox.AddStretchSpacer(1)
+
+        self.BrowseButton = wx.Button(ImageViewerButtonPanel, label="Browse all")
+        ImageViewerButtonPanelBox.Add(self.BrowseButton, 0, wx.ALL | wx.ALIGN_CENTER, 5)
+        self.BrowseButton.Bind(wx.EVT_BUTTON, lambda evt: self.ShowPhotoBrowser(not self.PhotoBrowser.IsShown()))
+
+        ImageViewerButtonPanelBox.AddStretchSpacer(2)
 
         self.ImagePrintButton = wx.Button(ImageViewerButtonPanel, label="Print current photo")
         self.ImagePrintButton.SetFont(wx.Font(16, wx.DEFAULT, wx.NORMAL, wx.NORMAL, 0, ""))
         ImageViewerButtonPanelBox.Add(self.ImagePrintButton, 0, wx.ALL | wx.ALIGN_CENTER, 5)
         self.ImagePrintButton.Bind(wx.EVT_BUTTON, self.PrintImage)
 
-        ImageViewerButtonPanelBox.AddStretchSpacer(1)
+        self.PrintStatusText = wx.StaticText(ImageViewerButtonPanel, -1, str(printing.PrintStatus()))
+        ImageViewerButtonPanelBox.Add(self.PrintStatusText, 0, wx.ALL | wx.ALIGN_CENTER, 5)
 
-        self.RefreshBGImageList()
+        ImageViewerButtonPanelBox.AddStretchSpacer(1)
 
         self.CompoundImageList = []
         self.FGImageList = []
+        # modification times of the photos, for jumping to a time in the photo browser
+        self.FGImageTimes = []
         self.selectedFGImageIdx = -1
         self.ShownFGImagePaths = [None] * len(self.FGSelectorImagePanels)
-        self.FGImageCache = {}
+        # last bitmap rendered from an in-memory image for each panel, as (image, panel size, bitmap)
+        self.TransientFGBitmaps = [None] * len(self.FGSelectorImagePanels)
+        # thumbnails keyed by caching.FileStateKey, loaded ahead of navigation in a background thread
+        self.FGImageCache = caching.LRUCache(FGThumbnailCacheBytes)
+        self.FGPreviewStore = caching.PreviewStore(
+            FGImageThumbnailScaleFac, None if PreviewCacheDir is None else path.join(PreviewCacheDir, "compound"))
+        self.FGThumbnailLoader = caching.ThumbnailLoader(
+            self.FGImageCache, self.FGPreviewStore.Get,
+            onLoaded=lambda imgPath: wx.CallAfter(self.OnFGThumbnailLoaded, imgPath))
+
+        # contact sheet of all photos, shown instead of the image viewer
+        self.PhotoBrowser = photobrowser.PhotoBrowser(PhotoControlSelectorPanel, self.CompoundImageList,
+                                                      self.FGImageTimes, self.FGPreviewStore, self.OnBrowserSelect)
+        PhotoControlSelectorBox.Insert(1, self.PhotoBrowser, 5, wx.ALL | wx.EXPAND, border=5)
+        self.PhotoBrowser.Hide()
+
+        # compound images scaled to the size of the panels showing them
+        self.FGRenderCache = caching.LRUCache(FGRenderCacheBytes, sizeFunc=lambda bmp: 4 * bmp.GetWidth() * bmp.GetHeight())
+        # compound images decoded at main panel size in a background thread, the selected one and its neighbours
+        self.MainFGImageCache = caching.LRUCache(MainFGImageCacheBytes)
+        self.MainFGImageLoader = caching.ThumbnailLoader(
+            self.MainFGImageCache, lambda imgPath: caching.LoadScaled(imgPath, self.MainFGPanelSize),
+            onLoaded=lambda imgPath: wx.CallAfter(self.OnMainFGImageLoaded, imgPath))
+
+        # background previews are loaded in the background and shown as they come in
+        self.BGPreviewCache = caching.LRUCache(BGPreviewCacheBytes)
+        self.BGScaledBitmaps = caching.LRUCache(BGScaledBitmapCacheBytes,
+                                                sizeFunc=lambda bmp: 4 * bmp.GetWidth() * bmp.GetHeight())
+        self.BGPreviewStore = caching.PreviewStore(
+            BGImageThumbnailScaleFac, None if PreviewCacheDir is None else path.join(PreviewCacheDir, "background"))
+        self.BGPreviewLoader = caching.ThumbnailLoader(
+            self.BGPreviewCache, self.BGPreviewStore.Get,
+            onLoaded=lambda imgPath: wx.CallAfter(self.OnBGPreviewLoaded, imgPath))
+        self.RefreshBGImageList()
 
-        self.GreenScreenRefColors = greenscreen.GetRefColor(Image.open(self.ReferenceImagePath))
+        self.GreenScreenRefColors = None
+        self.GreenScreenAlphaLUT = None
+        self.GreenScreenKeyingState = None
+        if CompositingServiceURL is None:
+            # with a compositing service, its reference image is used instead
+            self.UpdateGreenScreenKeying()
+        # keyed foreground layers, so changing the background does not re-key the photo
+        self.LayerCache = caching.LayerCache(LayerCacheSize, LayerCacheDir, recordMetrics=True)
+        # decoded photos on disk, so compositing a photo again does not decode it again
+        self.DecodedFrames = None
+        if DecodedFrameCacheDir is not None:
+            self.DecodedFrames = caching.DecodedFrameCache(DecodedFrameCacheDir, DecodedFrameCacheSize)
+        # decoded backgrounds, resized to the photo size
+        self.BackgroundStore = caching.BackgroundStore(BackgroundStoreSize)
+        # compound images are computed in background threads
+        self.GreenScreenKeyingLock = threading.Lock()
+        self.CompositingQueue = compositing.CompositingQueue(CompositingWorkers)
+        # current compound image of each photo
+        self.CompoundIndex = compoundindex.CompoundIndex(self.CompoundImagesPath)
+        # compound images are written to disk in the background; until then, they are shown from
+        # display-sized renders kept in memory, by path
+        self.CompoundImageWriter = compositing.CompositingQueue(1)
+        self.UnsavedCompoundImages = {}
+        # newest compound image of each photo, by photo path, set as soon as it is queued for writing
+        self.LatestCompoundImages = {}
+        self.MainFGPanelSize = tuple(self.FGSelectorImagePanels[iMainFGPanel].Size)
+
+        # while backgrounds are browsed, the selected photo is composited onto the backgrounds around the
+        # selected one at main panel size, so a new background can be shown at once
+        self.SpeculationQueue = compositing.CompositingQueue(1)
+        self.SpeculationGeneration = 0
+        self.PreviewLayerCache = caching.LayerCache(PreviewLayerCacheBytes)
+        self.SpeculativeComposites = caching.LRUCache(SpeculativeCompositeCacheBytes,
+                                                      sizeFunc=lambda img: 3 * img.size[0] * img.size[1])
+        # compound images shown from such a composite until the full-resolution one is ready:
+        # compound image path -> (preview image, compound image path shown before)
+        self.CompoundImagePreviews = {}
+
+        # photos are rendered for and sent to the printer in the background
+        self.PrintSpooler = printing.PrintSpooler(self.PrintedImagesPath, self.PrinterOptions, printerName=PrinterName,
+                                                  pageSizeMM=PrintPageSizeMM, dpi=PrintDPI,
+                                                  onStatus=lambda status: wx.CallAfter(self.OnPrintStatus, status))
+
+        # per-stage latencies drawn on top of the main photo, see metrics.py
+        self.LatencyStatsLines = []
+        if ShowLatencyStats and metrics.Store() is not None:
+            self.LatencyStatsTimer = wx.Timer(self)
+            self.Bind(wx.EVT_TIMER, self.OnLatencyStatsTimer, self.LatencyStatsTimer)
+            self.LatencyStatsTimer.Start(LatencyStatsInterval)
 
         mainPanel.Layout()
 
+    def UpdateGreenScreenKeying(self):
+        """ Re-compute reference colors and keying table if the reference image or the tolerances have changed """
+        state = (self.ReferenceImagePath, path.getmtime(self.ReferenceImagePath), tuple(self.GreenScreenTol))
+        if state == self.GreenScreenKeyingState:
+            return
+        self.GreenScreenRefColors = greenscreen.GetRefColor(Image.open(self.ReferenceImagePath))
+        if self.GreenScreenUseLUT:
+            self.GreenScreenAlphaLUT = greenscreen.MakeAlphaLUT(self.GreenScreenRefColors[1],
+                                                                tolA=self.GreenScreenTol[0],
+                                                                tolB=self.GreenScreenTol[1])
+        self.GreenScreenKeyingState = state
+
     def RefreshBGImageList(self):
         # find all BG images
         self.BGImageFiles = glob(path.join(self.BGImagesPath, "*.[jJ][pP][gG]"))
         self.BGImageBitmaps = [None] * len(self.BGSelectorImagePanels)
         self.selectedBGImageIdx = min(nBGSelectorPreviewPanels, len(self.BGImageFiles) - 1)
 
-        # store re-sized versions of all BG images
-        self.PreviewBGImags = []
-        for imgPath in self.BGImageFiles:
-            bmp = wx.Bitmap(imgPath)
-            image = wx.ImageFromBitmap(bmp).Scale(bmp.Size[0] * BGImageThumbnailScaleFac,
-                                                  bmp.Size[1] * BGImageThumbnailScaleFac, wx.IMAGE_QUALITY_HIGH)
-            self.PreviewBGImags.append(wx.BitmapFromImage(image))
+        # load re-sized versions of all BG images, starting with the visible ones
+        self.RequestBGPreviews()
         self.RefreshGUI()
 
+    def RequestBGPreviews(self):
+        """ Request previews of all BG images, nearest to the selected one first """
+        order = sorted(range(len(self.BGImageFiles)), key=lambda i: abs(i - self.selectedBGImageIdx))
+        self.BGPreviewLoader.Request([self.BGImageFiles[i] for i in order])
+
+    def GetBGPreview(self, imgIdx):
+        """ Return preview bitmap of a BG image, or None if it is not loaded yet """
+        imgPath = self.BGImageFiles[imgIdx]
+        preview = self.BGPreviewCache.Get(caching.FileStateKey(imgPath))
+        if preview is None:
+            return None
+        if preview.bitmap is None:
+            preview.bitmap = PILImageToWxBitmap(preview.image)
+        return preview.bitmap
+
+    def OnBGPreviewLoaded(self, imgPath):
+        for panelIdx, panel in enumerate(self.BGSelectorImagePanels):
+            imgIdx = self.selectedBGImageIdx + panelIdx - nBGSelectorPreviewPanels
+            if 0 <= imgIdx < len(self.BGImageFiles) and self.BGImageFiles[imgIdx] == imgPath:
+                panel.Refresh()
+        self.PrescaleBGBitmaps()
+
+    def GetBGPanelImageSize(self, panelIdx):
+        """ Size at which BG images are shown in a panel of the BG selector """
+        panel = self.BGSelectorImagePanels[panelIdx]
+        panelScalFac = (1.0 - BGPreviewScaleFac) ** abs(panelIdx - nBGSelectorPreviewPanels)
+        imgSize = [panel.Size[0] * panelScalFac, panel.Size[1] * panelScalFac]
+        if panelIdx == nBGSelectorPreviewPanels:
+            imgSize[0] -= 2 * BGSelectedImageBorderWidth
+            imgSize[1] -= 2 * BGSelectedImageBorderWidth
+        return int(imgSize[0]), int(imgSize[1])
+
+    def GetBGScaledBitmap(self, imgIdx, panelIdx):
+        """ Return preview bitmap of a BG image scaled for a panel, or None if the preview is not loaded yet """
+        imgSize = self.GetBGPanelImageSize(panelIdx)
+        if imgSize[0] <= 0 or imgSize[1] <= 0:
+            return None
+        key = (self.BGImageFiles[imgIdx], imgSize)
+        bmp = self.BGScaledBitmaps.Get(key)
+        if bmp is None:
+            preview = self.GetBGPreview(imgIdx)
+            if preview is None:
+                return None
+            bmp = wx.BitmapFromImage(wx.ImageFromBitmap(preview).Scale(imgSize[0], imgSize[1]))
+            self.BGScaledBitmaps.Put(key, bmp)
+        return bmp
+
+    def PrescaleBGBitmaps(self):
+        """
+        Scale the previews of BG images around the selected one for all panels they can move to with
+        the next Up/Down step, so scrolling only has to draw existing bitmaps
+        """
+        for panelIdx in range(len(self.BGSelectorImagePanels)):
+            for step in (-1, 0, 1):
+                imgIdx = self.selectedBGImageIdx + step + panelIdx - nBGSelectorPreviewPanels
+                if 0 <= imgIdx < len(self.BGImageFiles):
+                    self.GetBGScaledBitmap(imgIdx, panelIdx)
+
     def AddFGImage(self, FGImagePath):
         # if no compound image does exist yet, create it
         ImageName = path.split(FGImagePath)[1]
-        CompoundImagePattern = path.join(self.CompoundImagesPath, "C" + ImageName[1: -4] + "*.[jJ][pP][gG]")
-        curCompoundImages = glob(CompoundImagePattern)
+        CompoundImagePath = self.CompoundIndex.Lookup(ImageName)
         newFile = False
-        if len(curCompoundImages) == 0:
+        if CompoundImagePath is None or not path.exists(CompoundImagePath):
             newFile = True
             BGImagePath = self.BGImageFiles[self.selectedBGImageIdx]
             BGImageName = path.split(BGImagePath)[1]
-            CompoundImagePath = path.join(self.CompoundImagesPath, "C" + ImageName[1: -4] + "___" + BGImageName[:])
-        else:
-            CompoundImagePath = curCompoundImages[0]
+            CompoundImagePath = path.join(self.CompoundImagesPath,
+                                          compoundindex.CompoundImageName(ImageName, BGImageName))
         self.CompoundImageList.append(CompoundImagePath)
         self.FGImageList.append(FGImagePath)
+        try:
+            self.FGImageTimes.append(path.getmtime(FGImagePath))
+        except OSError:
+            self.FGImageTimes.append(time.time())
         self.selectedFGImageIdx = len(self.CompoundImageList) - 1
         if newFile:
-            self.MakeCompoundImage()
-
-    def MakeCompoundImage(self):
-        BGImagePath = self.BGImageFiles[self.selectedBGImageIdx]
+            self.MakeCompoundImage(self.selectedFGImageIdx, BGImagePath, compositing.PriorityBacklog)
+
+    def MakeCompoundImage(self, FGImageIdx, BGImagePath, priority=compositing.PrioritySelected):
+        """ Queue creation of the compound image for a FG image; the GUI is updated once it is done """
+        FGImagePath = self.FGImageList[FGImageIdx]
+        self.CompositingQueue.Submit(FGImagePath,
+                                     lambda: self.ComputeCompoundImage(FGImagePath, BGImagePath),
+                                     lambda result: self.OnCompoundImageComputed(FGImageIdx, FGImagePath, BGImagePath,
+                                                                                 result),
+                                     priority)
+
+    def ComputeCompoundImage(self, FGImagePath, BGImagePath):
+        """
+        Create compound image, return it with renders for display and the keying tolerances used;
+        runs in a compositing worker thread.
+        """
+        if self.CompositingServiceURL is None:
+            with self.GreenScreenKeyingLock:
+                self.UpdateGreenScreenKeying()
+        tol = tuple(self.GreenScreenTol)
+        if self.CompositingServiceURL is not None:
+            # shared service, with its own reference image and tolerances, which are recorded instead
+            with metrics.Timed(metrics.StageRemote):
+                compoundImage, tol = service.CompositeRemote(self.CompositingServiceURL, FGImagePath,
+                                                             path.split(BGImagePath)[1])
+        elif self.GreenScreenMemoryBudget is None:
+            keyedFG = self.LayerCache.Get(FGImagePath, self.GreenScreenRefColors, tolA=self.GreenScreenTol[0],
+                                          tolB=self.GreenScreenTol[1], alphaLUT=self.GreenScreenAlphaLUT,
+                                          loadFunc=self.LoadPhoto, nThreads=self.GreenScreenThreads,
+                                          filterRadius=self.GreenScreenFilterRadius)
+            bgNp = self.BackgroundStore.Get(BGImagePath, keyedFG.size)
+            with metrics.Timed(metrics.StageCompositing):
+                compoundImage = keyedFG.Composite(bgNp, nThreads=self.GreenScreenThreads)
+        else:
+            # bounded memory: no cached full-size layers, process photo in bands
+            with metrics.Timed(metrics.StageDecode):
+                fgImage = self.LoadPhoto(FGImagePath)
+                if isinstance(fgImage, Image.Image):
+                    fgImage.load()
+                    size = fgImage.size
+                else:
+                    size = (fgImage.shape[1], fgImage.shape[0])
+            bgNp = self.BackgroundStore.Get(BGImagePath, size)
+            with metrics.Timed(metrics.StageKeying):
+                compoundImage = greenscreen.OverlayStreaming(fgImage, bgNp, self.GreenScreenRefColors,
+                                                             tolA=self.GreenScreenTol[0], tolB=self.GreenScreenTol[1],
+                                                             alphaLUT=self.GreenScreenAlphaLUT,
+                                                             nThreads=self.GreenScreenThreads,
+                                                             memoryBudget=self.GreenScreenMemoryBudget,
+                                                             filterRadius=self.GreenScreenFilterRadius)
+
+        # renders for display, at the size of the main panel and at thumbnail size
+        thumbnailSize = (max(1, int(compoundImage.size[0] * FGImageThumbnailScaleFac)),
+                         max(1, int(compoundImage.size[1] * FGImageThumbnailScaleFac)))
+        with metrics.Timed(metrics.StageThumbnail):
+            renders = (compoundImage.resize(self.MainFGPanelSize, Image.ANTIALIAS),
+                       compoundImage.resize(thumbnailSize, Image.ANTIALIAS))
+        return compoundImage, renders, tol
+
+    def OnCompoundImageComputed(self, FGImageIdx, FGImagePath, BGImagePath, result):
+        """
+        Queue a compound image for saving; runs in the compositing worker thread, only for the newest job of a
+        photo, so a superseded compound image is never saved. The GUI shows the result from in-memory renders
+        until it is saved.
+        """
+        if result is None:
+            wx.CallAfter(self.OnCompoundImageReady, FGImageIdx, None)
+            return
+        compoundImage, renders, tol = result
         BGImageName = path.split(BGImagePath)[1]
-        bgImage = Image.open(BGImagePath)
-        FGImagePath = self.FGImageList[self.selectedFGImageIdx]
         FGImageName = path.split(FGImagePath)[1]
-        fgImage = Image.open(FGImagePath)
-        CompoundImagePath = path.join(self.CompoundImagesPath, "C" + FGImageName[1: -4] + "___" + BGImageName[:])
-
-        # delete any compound images already present for that FG image
-        compoundImage = greenscreen.Overlay(fgImage, bgImage, self.GreenScreenRefColors, tolA=self.GreenScreenTol[0],
-                                            tolB=self.GreenScreenTol[1])
-        CompoundImagePattern = path.join(self.CompoundImagesPath, "C" + FGImageName[1: -4] + "___*.[jJ][pP][gG]")
-        for f in glob(CompoundImagePattern):
-            os.remove(f)
-        compoundImage.save(CompoundImagePath)
-        self.CompoundImageList[self.selectedFGImageIdx] = CompoundImagePath
+        CompoundImagePath = path.join(self.CompoundImagesPath,
+                                      compoundindex.CompoundImageName(FGImageName, BGImageName))
+        self.UnsavedCompoundImages[CompoundImagePath] = renders
+        self.LatestCompoundImages[FGImagePath] = CompoundImagePath
+        self.CompoundImageWriter.Submit(
+            CompoundImagePath,
+            lambda: self.SaveCompoundImage(compoundImage, CompoundImagePath, FGImageName, BGImageName, tol),
+            lambda result: wx.CallAfter(self.OnCompoundImageSaved, CompoundImagePath))
+        wx.CallAfter(self.OnCompoundImageReady, FGImageIdx, CompoundImagePath)
+
+    def LoadPhoto(self, FGImagePath):
+        """ Photo as memory-mapped array from the decoded frame cache, or as Image if there is no such cache """
+        if self.DecodedFrames is None:
+            return Image.open(FGImagePath)
+        return self.DecodedFrames.Get(FGImagePath)
+
+    def SaveCompoundImage(self, compoundImage, CompoundImagePath, FGImageName, BGImageName, tol):
+        """ Write compound image to disk and update the index with the tolerances used; runs in the writer thread """
+        with metrics.Timed(metrics.StageSave):
+            compoundImage.save(CompoundImagePath)
+        # delete the compound image previously present for that FG image
+        previousPath = self.CompoundIndex.Set(FGImageName, BGImageName, tol)
+        if previousPath is not None and previousPath != CompoundImagePath and path.exists(previousPath):
+            os.remove(previousPath)
+
+    def OnCompoundImageReady(self, FGImageIdx, CompoundImagePath):
+        """ Called on the main thread when a compositing job has finished """
+        if self.CompositingQueue.IsPending(self.FGImageList[FGImageIdx]):
+            # superseded by a newer job for the same photo
+            return
+        preview = self.CompoundImagePreviews.pop(self.CompoundImageList[FGImageIdx], None)
+        if CompoundImagePath is not None:
+            self.CompoundImageList[FGImageIdx] = CompoundImagePath
+            self.PrefetchFGThumbnails()
+            self.PrefetchMainFGImages()
+        elif preview is not None:
+            # compositing failed, go back to the image shown before
+            self.CompoundImageList[FGImageIdx] = preview[1]
+        for panel in self.FGSelectorImagePanels:
+            panel.Refresh()
+        if self.PhotoBrowser.IsShown():
+            self.PhotoBrowser.RefreshTiles()
+
+    def OnCompoundImageSaved(self, CompoundImagePath):
+        """ Called on the main thread when a compound image has been written to disk """
+        renders = self.UnsavedCompoundImages.pop(CompoundImagePath, None)
+        if self.PhotoBrowser.IsShown():
+            # the photo's tile could not be loaded before the file existed
+            self.PhotoBrowser.RefreshTiles()
+        if renders is None or not path.exists(CompoundImagePath):
+            return
+        # hand the in-memory renders over to the caches used for images on disk
+        mainImage, thumbnailImage = renders
+        fileStateKey = caching.FileStateKey(CompoundImagePath)
+        self.FGImageCache.Put(fileStateKey, caching.Thumbnail(thumbnailImage))
+        self.MainFGImageCache.Put(fileStateKey, caching.Thumbnail(mainImage))
+        self.FGRenderCache.Put((fileStateKey, mainImage.size), PILImageToWxBitmap(mainImage))
 
     def OnBGImageClick(self, event, panelIdx):
         self.selectedBGImageIdx += panelIdx - nBGSelectorPreviewPanels
         self.selectedBGImageIdx = max(0, min(len(self.BGImageFiles) - 1, self.selectedBGImageIdx))
+        self.RequestBGPreviews()
         # refresh all panels
         for panel in self.BGSelectorImagePanels:
             panel.Refresh()
+        # once painted, get ready for the next step
+        wx.CallAfter(self.PrescaleBGBitmaps)
+        self.SpeculateCompoundImages()
 
     def DoBGSelection(self, event):
         # create new compound image
-        self.MakeCompoundImage()
+        if self.selectedFGImageIdx < 0:
+            return
+        BGImagePath = self.BGImageFiles[self.selectedBGImageIdx]
+        self.ShowSpeculativeComposite(self.selectedFGImageIdx, BGImagePath)
+        self.MakeCompoundImage(self.selectedFGImageIdx, BGImagePath)
         self.FGSelectorImagePanels[iMainFGPanel].Refresh()
         self.FGSelectorImagePanels[iMidFGPanel].Refresh()
         pass
 
+    def SpeculateCompoundImages(self):
+        """
+        Queue composites of the selected photo onto the backgrounds around the selected one, nearest first,
+        at main panel size; composites queued for a previous selection are dropped. Not done with a compositing
+        service, as the local reference image and tolerances would give other results.
+        """
+        self.SpeculationQueue.CancelPending()
+        self.SpeculationGeneration += 1
+        if self.selectedFGImageIdx < 0 or self.SpeculativeBGs <= 0 or self.CompositingServiceURL is not None:
+            return
+        FGImagePath = self.FGImageList[self.selectedFGImageIdx]
+        for offset in range(self.SpeculativeBGs + 1):
+            for BGImageIdx in set([self.selectedBGImageIdx - offset, self.selectedBGImageIdx + offset]):
+                if 0 <= BGImageIdx < len(self.BGImageFiles):
+                    self.SubmitSpeculativeComposite(FGImagePath, self.BGImageFiles[BGImageIdx], offset)
+
+    def SubmitSpeculativeComposite(self, FGImagePath, BGImagePath, priority):
+        size = self.MainFGPanelSize
+        if self.SpeculativeCompositeKey(FGImagePath, BGImagePath, size) in self.SpeculativeComposites:
+            return
+        generation = self.SpeculationGeneration
+        self.SpeculationQueue.Submit((FGImagePath, BGImagePath),
+                                     lambda: self.ComputeSpeculativeComposite(FGImagePath, BGImagePath, size,
+                                                                              generation),
+                                     priority=priority)
+
+    def SpeculativeCompositeKey(self, FGImagePath, BGImagePath, size):
+        return FGImagePath, BGImagePath, tuple(size), self.GreenScreenKeyingState
+
+    def ComputeSpeculativeComposite(self, FGImagePath, BGImagePath, size, generation):
+        """ Composite a photo at reduced size; runs in the speculation thread once no compound images are queued """
+        # compound images the guests are waiting for come first
+        self.CompositingQueue.WaitUntilIdle()
+        if generation != self.SpeculationGeneration:
+            # selection has moved on in the meantime
+            return
+        with self.GreenScreenKeyingLock:
+            self.UpdateGreenScreenKeying()
+        key = self.SpeculativeCompositeKey(FGImagePath, BGImagePath, size)
+        keyedFG = self.PreviewLayerCache.Get(FGImagePath, self.GreenScreenRefColors, tolA=self.GreenScreenTol[0],
+                                             tolB=self.GreenScreenTol[1], alphaLUT=self.GreenScreenAlphaLUT,
+                                             size=size, filterRadius=self.GreenScreenFilterRadius)
+        compoundImage = keyedFG.Composite(self.BackgroundStore.Get(BGImagePath, size, draft=True))
+        self.SpeculativeComposites.Put(key, compoundImage)
+
+    def ShowSpeculativeComposite(self, FGImageIdx, BGImagePath):
+        """ Show a composite computed ahead, if there is one, until the full-resolution compound image is ready """
+        FGImagePath = self.FGImageList[FGImageIdx]
+        previewImage = self.SpeculativeComposites.Get(
+            self.SpeculativeCompositeKey(FGImagePath, BGImagePath, self.MainFGPanelSize))
+        if previewImage is None:
+            return
+        shownPath = self.CompoundImageList[FGImageIdx]
+        if shownPath in self.CompoundImagePreviews:
+            # previous background change has not finished yet and is superseded
+            shownPath = self.CompoundImagePreviews.pop(shownPath)[1]
+        CompoundImagePath = path.join(self.CompoundImagesPath,
+                                      compoundindex.CompoundImageName(path.split(FGImagePath)[1],
+                                                                      path.split(BGImagePath)[1]))
+        self.CompoundImagePreviews[CompoundImagePath] = (previewImage, shownPath)
+        self.CompoundImageList[FGImageIdx] = CompoundImagePath
+
     def OnFGImageClick(self, event, panelIdx):
-        self.selectedFGImageIdx += panelIdx - iMidFGPanel
-        self.selectedFGImageIdx = max(0, min(len(self.CompoundImageList) - 1, self.selectedFGImageIdx))
+        self.SelectFGImage(self.selectedFGImageIdx + panelIdx - iMidFGPanel)
+
+    def SelectFGImage(self, FGImageIdx):
+        # -1 if there are no photos yet
+        self.selectedFGImageIdx = min(len(self.CompoundImageList) - 1, max(0, FGImageIdx))
+        # the selected photo's compound image, if still being created, comes first
+        if self.selectedFGImageIdx >= 0:
+            self.CompositingQueue.Promote(self.FGImageList[self.selectedFGImageIdx])
+        self.PrefetchFGThumbnails()
+        self.PrefetchMainFGImages()
+        self.SpeculateCompoundImages()
         # refresh all panels
         for panel in self.FGSelectorImagePanels:
             panel.Refresh()
-        pass
+
+    def ShowPhotoBrowser(self, show):
+        """ Show the contact sheet of all photos instead of the image viewer, or switch back """
+        self.ImageViewerPanel.Show(not show)
+        self.PhotoBrowser.Show(show)
+        self.BrowseButton.SetLabel("Back to photo" if show else "Browse all")
+        self.PhotoBrowser.GetParent().Layout()
+        if show:
+            self.PhotoBrowser.RefreshTiles()
+            self.PhotoBrowser.ScrollToIndex(self.selectedFGImageIdx)
+
+    def OnBrowserSelect(self, FGImageIdx):
+        self.ShowPhotoBrowser(False)
+        self.SelectFGImage(FGImageIdx)
 
     def RefreshGUI(self):
+        """ Repaint all panels and load what they show; main thread only, see greenie.monitorPhotoDirs() """
+        self.PrefetchFGThumbnails()
+        self.PrefetchMainFGImages()
         for panel in self.BGSelectorImagePanels:
             panel.Refresh()
         for panel in self.FGSelectorImagePanels:
             panel.Refresh()
+        if self.PhotoBrowser.IsShown():
+            self.PhotoBrowser.RefreshTiles()
 
     def OnClose(self, event):
         dlg = wx.MessageDialog(self,
@@ -308,16 +709,12 @@ class GreenieGUI(wx.Frame):
         dc = wx.BufferedPaintDC(panel)
         dc.Clear()
         imgIdx = self.selectedBGImageIdx + panelIdx - nBGSelectorPreviewPanels
+        bmp = None
         if imgIdx >= 0 and imgIdx < len(self.BGImageFiles):
-            self.BGImageBitmaps[panelIdx] = self.PreviewBGImags[imgIdx]
-            panelScalFac = (1.0 - BGPreviewScaleFac) ** abs(panelIdx - nBGSelectorPreviewPanels)
-            imgSize = [panel.Size[0] * panelScalFac, panel.Size[1] * panelScalFac]
-            if panelIdx == nBGSelectorPreviewPanels:
-                imgSize[0] -= 2 * BGSelectedImageBorderWidth
-                imgSize[1] -= 2 * BGSelectedImageBorderWidth
-            image = wx.ImageFromBitmap(self.BGImageBitmaps[panelIdx]).Scale(imgSize[0], imgSize[1])
-            dc.DrawBitmap(wx.BitmapFromImage(image), 0.5 * (panel.Size[0] - imgSize[0]),
-                          0.5 * (panel.Size[1] - imgSize[1]))
+            bmp = self.GetBGScaledBitmap(imgIdx, panelIdx)
+        if bmp is not None:
+            self.BGImageBitmaps[panelIdx] = bmp
+            dc.DrawBitmap(bmp, 0.5 * (panel.Size[0] - bmp.GetWidth()), 0.5 * (panel.Size[1] - bmp.GetHeight()))
         else:
             self.BGImageBitmaps[panelIdx] = None
 
@@ -328,24 +725,101 @@ class GreenieGUI(wx.Frame):
         # reduce flicker
         pass
 
-    def CacheFGImage(self, imgPath):
-        """ Add image to cache; make space in cache if necessary"""
-        if imgPath in self.FGImageCache.keys():
-            # image is already cached
-            return
-        # make space in cache if necessary
-        while len(self.FGImageCache) >= nFGThumbnailCache:
-            # try to remove a random element
-            iRand = random.randint(0, len(self.FGImageCache))
-            # only remove images not currently shown
-            imgNameRand = self.FGImageCache.keys()[iRand]
-            if not imgNameRand in self.ShownFGImagePaths:
-                del self.FGImageCache[imgNameRand]
-        # cache the new image
-        bmp = wx.Bitmap(imgPath)
-        image = wx.ImageFromBitmap(bmp).Scale(bmp.Size[0] * FGImageThumbnailScaleFac,
-                                              bmp.Size[1] * FGImageThumbnailScaleFac)
-        self.FGImageCache[imgPath] = wx.BitmapFromImage(image)
+    def GetFGThumbnail(self, imgPath):
+        """ Return thumbnail bitmap of an image, or None if it is not loaded yet (it is then requested) """
+        thumbnail = self.FGImageCache.Get(caching.FileStateKey(imgPath))
+        if thumbnail is None:
+            self.PrefetchFGThumbnails([imgPath])
+            return None
+        if thumbnail.bitmap is None:
+            thumbnail.bitmap = PILImageToWxBitmap(thumbnail.image)
+        return thumbnail.bitmap
+
+    def PrefetchFGThumbnails(self, firstPaths=()):
+        """ Request thumbnails of the images around the selected one, nearest first """
+        imgPaths = list(firstPaths)
+        for offset in range(nFGThumbnailPrefetch + 1):
+            for imgIdx in set([self.selectedFGImageIdx - offset, self.selectedFGImageIdx + offset]):
+                if 0 <= imgIdx < len(self.CompoundImageList):
+                    imgPath = self.CompoundImageList[imgIdx]
+                    if imgPath not in imgPaths and path.exists(imgPath):
+                        imgPaths.append(imgPath)
+        self.FGThumbnailLoader.Request(imgPaths)
+
+    def OnFGThumbnailLoaded(self, imgPath):
+        for panelIdx, shownPath in enumerate(self.ShownFGImagePaths):
+            if shownPath == imgPath:
+                self.FGSelectorImagePanels[panelIdx].Refresh()
+
+    def PrefetchMainFGImages(self, firstPaths=()):
+        """ Request compound images at main panel size, of the selected photo and its neighbours, nearest first """
+        imgPaths = list(firstPaths)
+        for offset in range(nMainFGPrefetch + 1):
+            for imgIdx in (self.selectedFGImageIdx + offset, self.selectedFGImageIdx - offset):
+                if 0 <= imgIdx < len(self.CompoundImageList):
+                    imgPath = self.CompoundImageList[imgIdx]
+                    if imgPath not in imgPaths and path.exists(imgPath):
+                        imgPaths.append(imgPath)
+        self.MainFGImageLoader.Request(imgPaths)
+
+    def OnMainFGImageLoaded(self, imgPath):
+        if self.ShownFGImagePaths[iMainFGPanel] == imgPath:
+            self.FGSelectorImagePanels[iMainFGPanel].Refresh()
+
+    def GetTransientFGBitmap(self, image, panelIdx, imgSize):
+        """ Bitmap of an in-memory image at the size of a panel, kept while the panel shows that image """
+        shown = self.TransientFGBitmaps[panelIdx]
+        if shown is not None and shown[0] is image and shown[1] == imgSize:
+            return shown[2]
+        bmp = PILImageToWxBitmap(image if image.size == imgSize else image.resize(imgSize, Image.ANTIALIAS))
+        self.TransientFGBitmaps[panelIdx] = (image, imgSize, bmp)
+        return bmp
+
+    def GetFGRenderedBitmap(self, imgPath, panelIdx):
+        """
+        Return bitmap of a compound image at the size of a panel, or None if it is not available yet.
+
+        Rendered bitmaps are cached by image file state and panel size, so they are only re-created
+        when the compound image changes or the panel is resized. The main panel's image is decoded in a
+        background thread, the thumbnail is shown scaled up until it is ready.
+        """
+        imgSize = tuple(self.FGSelectorImagePanels[panelIdx].Size)
+        if imgSize[0] <= 0 or imgSize[1] <= 0:
+            return None
+        if panelIdx == iMainFGPanel:
+            self.MainFGPanelSize = imgSize
+        unsaved = self.UnsavedCompoundImages.get(imgPath)
+        if unsaved is not None:
+            # freshly computed image, not on disk yet
+            return self.GetTransientFGBitmap(unsaved[0] if panelIdx == iMainFGPanel else unsaved[1], panelIdx, imgSize)
+        preview = self.CompoundImagePreviews.get(imgPath)
+        if preview is not None:
+            # composite computed ahead at reduced size, full resolution is still being created
+            return self.GetTransientFGBitmap(preview[0], panelIdx, imgSize)
+        fileStateKey = caching.FileStateKey(imgPath)
+        key = (fileStateKey, imgSize)
+        bmp = self.FGRenderCache.Get(key)
+        if bmp is not None:
+            return bmp
+        if panelIdx == iMainFGPanel:
+            # main image is decoded from disk at display resolution
+            mainImage = self.MainFGImageCache.Get(fileStateKey)
+            if mainImage is not None and mainImage.image.size == imgSize:
+                bmp = PILImageToWxBitmap(mainImage.image)
+                self.FGRenderCache.Put(key, bmp)
+                return bmp
+            if mainImage is not None:
+                # decoded for a previous panel size
+                self.MainFGImageCache.Remove(fileStateKey)
+            self.PrefetchMainFGImages([imgPath])
+        thumbnail = self.GetFGThumbnail(imgPath)
+        if thumbnail is None:
+            return None
+        image = wx.ImageFromBitmap(thumbnail).Scale(imgSize[0], imgSize[1], wx.IMAGE_QUALITY_HIGH)
+        bmp = wx.BitmapFromImage(image)
+        if panelIdx != iMainFGPanel:
+            self.FGRenderCache.Put(key, bmp)
+        return bmp
 
     def OnFGPanelPaint(self, evt, panelIdx):
         panel = self.FGSelectorImagePanels[panelIdx]
@@ -356,20 +830,16 @@ class GreenieGUI(wx.Frame):
         else:
             # main panel
             imgIdx = self.selectedFGImageIdx
-        if imgIdx >= 0 and imgIdx < len(self.CompoundImageList) and path.exists(self.CompoundImageList[imgIdx]):
+        if imgIdx >= 0 and imgIdx < len(self.CompoundImageList) and (
+                self.CompoundImageList[imgIdx] in self.UnsavedCompoundImages or
+                self.CompoundImageList[imgIdx] in self.CompoundImagePreviews or
+                path.exists(self.CompoundImageList[imgIdx])):
             imgPath = self.CompoundImageList[imgIdx]
-            FGImageName = self.FGImageList[imgIdx]
-            self.CacheFGImage(imgPath)
             self.ShownFGImagePaths[panelIdx] = imgPath
             imgSize = panel.Size
-            if panelIdx != iMainFGPanel:
-                bmp = self.FGImageCache[imgPath]
-            else:
-                # always reload full-res version of main image from disk
-                bmp = wx.Bitmap(self.CompoundImageList[imgIdx])
-            image = wx.ImageFromBitmap(bmp).Scale(imgSize[0], imgSize[1], wx.IMAGE_QUALITY_HIGH)
-            dc.DrawBitmap(wx.BitmapFromImage(image), 0.5 * (panel.Size[0] - imgSize[0]),
-                          0.5 * (panel.Size[1] - imgSize[1]))
+            bmp = self.GetFGRenderedBitmap(imgPath, panelIdx)
+            if bmp is not None:
+                dc.DrawBitmap(bmp, 0.5 * (panel.Size[0] - imgSize[0]), 0.5 * (panel.Size[1] - imgSize[1]))
             if panelIdx == iMidFGPanel:
                 # draw a border around current image in preview
                 dc.SetPen(wx.Pen((0, 255, 50), 2 * SelectedImageBorderWidth))
@@ -381,6 +851,16 @@ class GreenieGUI(wx.Frame):
             dc.DrawText(str(imgIdx + 1), 3, 3)
         else:
             self.ShownFGImagePaths[panelIdx] = None
+        if 0 <= imgIdx < len(self.FGImageList) and self.CompositingQueue.IsPending(self.FGImageList[imgIdx]) and \
+                self.CompoundImageList[imgIdx] not in self.CompoundImagePreviews:
+            # compound image is not ready yet
+            dc.SetFont(wx.Font(12 if panelIdx != iMainFGPanel else 20, wx.SWISS, wx.NORMAL, wx.BOLD))
+            dc.SetTextForeground((255, 100, 0))
+            text = "processing..."
+            textSize = dc.GetTextExtent(text)
+            dc.DrawText(text, 0.5 * (panel.Size[0] - textSize[0]), 0.5 * (panel.Size[1] - textSize[1]))
+        if panelIdx == iMainFGPanel and len(self.LatencyStatsLines) > 0:
+            self.DrawLatencyStats(dc, panel)
 
     def OnFGPanelEraseBackground(self, event):
         """ Handles the wx.EVT_ERASE_BACKGROUND event for CustomCheckBox. """
@@ -390,16 +870,47 @@ class GreenieGUI(wx.Frame):
         pass
 
     def PrintImage(self, event):
-        """ Copy current compound image to PrintedImages folder, send to printer """
-        timeStr = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+        """ Queue current compound image for printing; a backup goes to the PrintedImages folder """
+        if self.selectedFGImageIdx < 0:
+            return
+        FGImagePath = self.FGImageList[self.selectedFGImageIdx]
         compoundImgPath = self.CompoundImageList[self.selectedFGImageIdx]
-        destFile = path.join(self.PrintedImagesPath, timeStr + "_" + path.split(compoundImgPath)[1])
-        shutil.copy(compoundImgPath, destFile)
-
-        ret = subprocess.call(["lpr"] + self.PrinterOptions + [destFile])
-        if ret == 0:
-            msg = "Sent photo to printer."
-        else:
-            msg = "Error printing!"
-        dlg = wx.MessageDialog(self, "", msg, wx.OK)
-        dlg.ShowModal()
+        # the photo may still be being composited or waiting to be written to disk
+        self.PrintSpooler.Submit(compoundImgPath,
+                                 waitFunc=lambda: self.WaitForCompoundImage(FGImagePath, compoundImgPath))
+
+    def WaitForCompoundImage(self, FGImagePath, CompoundImagePath):
+        """
+        Block until a photo's compound image has been created and written to disk; other photos may be queued.
+        Returns the path of the photo's newest compound image, which replaces CompoundImagePath if the
+        background has been changed in the meantime.
+        """
+        # a finished compositing job has queued its compound image for writing, see OnCompoundImageComputed()
+        self.CompositingQueue.WaitFor(FGImagePath)
+        CompoundImagePath = self.LatestCompoundImages.get(FGImagePath, CompoundImagePath)
+        self.CompoundImageWriter.WaitFor(CompoundImagePath)
+        return CompoundImagePath
+
+    def OnLatencyStatsTimer(self, event):
+        lines = metrics.Store().SummaryLines()
+        if lines != self.LatencyStatsLines:
+            self.LatencyStatsLines = lines
+            self.FGSelectorImagePanels[iMainFGPanel].Refresh()
+
+    def DrawLatencyStats(self, dc, panel):
+        """ Draw the latency statistics in the lower left corner of a panel, on a dark box """
+        dc.SetFont(wx.Font(11, wx.MODERN, wx.NORMAL, wx.NORMAL))
+        lineHeight = dc.GetTextExtent("Xg")[1]
+        width = max(dc.GetTextExtent(line)[0] for line in self.LatencyStatsLines) + 8
+        height = lineHeight * len(self.LatencyStatsLines) + 8
+        y0 = panel.Size[1] - height
+        dc.SetPen(wx.TRANSPARENT_PEN)
+        dc.SetBrush(wx.Brush((0, 0, 0)))
+        dc.DrawRectangle(0, y0, width, height)
+        dc.SetTextForeground((255, 255, 255))
+        for i, line in enumerate(self.LatencyStatsLines):
+            dc.DrawText(line, 4, y0 + 4 + i * lineHeight)
+
+    def OnPrintStatus(self, status):
+        self.PrintStatusText.SetLabel(str(status))
+        self.PrintStatusText.GetParent().Layout()
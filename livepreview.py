@@ -0,0 +1,348 @@
+"""
+Live keying preview for frame streams, so guests can see themselves on the background before the shutter fires
+
+Frames are keyed at preview resolution into buffers allocated once, at up to a target frame rate.
+A grabber thread keeps only the newest frame of the source, so frames arriving while the previous one
+is being keyed are dropped instead of piling up. Achieved frame rate and per-frame latency are reported.
+
+Frame sources:
+    DirectoryFrameSource: image files played back at a fixed rate, a stand-in for a camera in testing
+    VideoFrameSource: video file or V4L2 device, needs OpenCV (cv2)
+
+Example:
+    python livepreview.py --frames /tmp/frames --fps 15 -b backgrounds/Background1.JPG -r reference.jpg
+"""
+
+import argparse
+import os
+import sys
+import threading
+import time
+from os import path
+
+import numpy as np
+from PIL import Image
+
+import caching
+import greenscreen
+import watcher
+
+
+class Frame(object):
+    """
+    Attributes:
+        seq (int): sequence number assigned by the source, gaps mean dropped frames
+        timestamp (float): time.time() when the frame was captured
+        image (Image or np.ndarray): RGB frame
+    """
+
+    def __init__(self, seq, timestamp, image):
+        self.seq = seq
+        self.timestamp = timestamp
+        self.image = image
+
+
+class DirectoryFrameSource(object):
+    """
+    Image files of a directory in name order, delivered at a fixed frame rate like a camera would
+
+    Args:
+        frameDir (str): directory containing the frames as JPEG files
+        fps (float): frame rate at which frames become available
+        size ((int, int)): optional size (width, height) hint, frames are decoded close to it, see caching.LoadScaled()
+        loop (bool): start over at the end instead of ending the stream
+    """
+
+    def __init__(self, frameDir, fps=15.0, size=None, loop=False):
+        self.framePaths = [path.join(frameDir, n) for n in sorted(os.listdir(frameDir)) if watcher.IsPhotoFile(n)]
+        if len(self.framePaths) == 0:
+            raise IOError("no frames found in " + frameDir)
+        self.interval = 1.0 / fps
+        self.size = size
+        self.loop = loop
+        self.seq = 0
+        self.nextTime = None
+
+    def Read(self):
+        """ Block until the next frame is due and return it, or None at the end of the stream """
+        if self.seq >= len(self.framePaths) and not self.loop:
+            return None
+        now = time.time()
+        if self.nextTime is None:
+            self.nextTime = now
+        elif now < self.nextTime:
+            time.sleep(self.nextTime - now)
+        timestamp = time.time()
+        self.nextTime += self.interval
+        framePath = self.framePaths[self.seq % len(self.framePaths)]
+        if self.size is not None:
+            image = caching.LoadScaled(framePath, self.size)
+        else:
+            image = Image.open(framePath).convert("RGB")
+        self.seq += 1
+        return Frame(self.seq - 1, timestamp, image)
+
+    def Close(self):
+        pass
+
+
+class VideoFrameSource(object):
+    """
+    Frames of a video file or capture device, read with OpenCV
+
+    Args:
+        source (str or int): video file path, or device index / path of a V4L2 capture device
+    """
+
+    def __init__(self, source):
+        import cv2
+        self.cv2 = cv2
+        self.capture = cv2.VideoCapture(source)
+        if not self.capture.isOpened():
+            raise IOError("cannot open video source %r" % (source,))
+        self.seq = 0
+
+    def Read(self):
+        ok, bgr = self.capture.read()
+        if not ok:
+            return None
+        self.seq += 1
+        return Frame(self.seq - 1, time.time(), self.cv2.cvtColor(bgr, self.cv2.COLOR_BGR2RGB))
+
+    def Close(self):
+        self.capture.release()
+
+
+class FrameGrabber(object):
+    """
+    Reads a frame source on a background thread and keeps only the newest frame
+
+    Args:
+        source: frame source, see DirectoryFrameSource
+    """
+
+    def __init__(self, source):
+        self.source = source
+        self.cond = threading.Condition()
+        self.latest = None
+        self.ended = False
+        self.stopped = False
+        self.thread = threading.Thread(target=self.GrabberLoop, name="FrameGrabber")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def GrabberLoop(self):
+        while not self.stopped:
+            frame = self.source.Read()
+            with self.cond:
+                if frame is None:
+                    self.ended = True
+                else:
+                    # an older frame not picked up yet is dropped
+                    self.latest = frame
+                self.cond.notify_all()
+            if frame is None:
+                return
+
+    def Next(self, timeout=None):
+        """ Return the newest frame not returned before, waiting for one if needed; None at the end of the stream """
+        with self.cond:
+            if self.latest is None and not self.ended:
+                self.cond.wait(timeout)
+            frame = self.latest
+            self.latest = None
+            return frame
+
+    def Stop(self):
+        self.stopped = True
+        self.thread.join()
+        self.source.Close()
+
+
+class PreviewStats(object):
+    """
+    Frame rate and latency statistics of a LivePreview, over a sliding window of frames
+
+    Latency is measured from the capture of a frame to the end of its compositing.
+    """
+
+    def __init__(self, window=60):
+        self.window = window
+        self.nShown = 0
+        self.nDropped = 0
+        self.lastSeq = None
+        self.doneTimes = []
+        self.latencies = []
+
+    def AddFrame(self, frame, doneTime):
+        if self.lastSeq is not None:
+            self.nDropped += max(0, frame.seq - self.lastSeq - 1)
+        self.lastSeq = frame.seq
+        self.nShown += 1
+        self.doneTimes = (self.doneTimes + [doneTime])[-self.window:]
+        self.latencies = (self.latencies + [doneTime - frame.timestamp])[-self.window:]
+
+    @property
+    def fps(self):
+        if len(self.doneTimes) < 2 or self.doneTimes[-1] <= self.doneTimes[0]:
+            return 0.0
+        return (len(self.doneTimes) - 1) / (self.doneTimes[-1] - self.doneTimes[0])
+
+    @property
+    def meanLatency(self):
+        return sum(self.latencies) / len(self.latencies) if self.latencies else 0.0
+
+    @property
+    def maxLatency(self):
+        return max(self.latencies) if self.latencies else 0.0
+
+    def __str__(self):
+        return "%.1f fps, latency %.0f ms (max %.0f ms), %d frames shown, %d dropped" % (
+            self.fps, 1000 * self.meanLatency, 1000 * self.maxLatency, self.nShown, self.nDropped)
+
+
+class LivePreview(object):
+    """
+    Keys frames onto a background at preview resolution.
+
+    All image-sized buffers are allocated once; each frame is only scaled into the foreground buffer
+    (unless it already has the preview size) and keyed with greenscreen.OverlayArrays().
+
+    Args:
+        bgImage (Image): background image, scaled to the preview size once
+        refColors, tolA, tolB, alphaLUT, filterRadius: keying parameters, see greenscreen.Overlay()
+        previewSize ((int, int)): preview size (width, height)
+    """
+
+    def __init__(self, bgImage, refColors, tolA=30.0, tolB=40.0, alphaLUT=None, previewSize=(640, 480),
+                 filterRadius=1):
+        self.refColors = refColors
+        self.tolA = tolA
+        self.tolB = tolB
+        self.alphaLUT = alphaLUT
+        self.previewSize = tuple(previewSize)
+        width, height = self.previewSize
+        self.filterRadius = greenscreen.ClampFilterRadius(filterRadius, width, height)
+        if bgImage.mode != "RGB":
+            bgImage = bgImage.convert("RGB")
+        self.bgNp = np.ascontiguousarray(greenscreen.BackgroundArray(bgImage, self.previewSize))
+        self.fgNp = np.empty((height, width, 3), dtype=np.uint8)
+        self.work = np.empty((greenscreen.OverlayWorkPlanes(self.filterRadius), height, width), dtype=np.float32)
+        self.out = np.empty((height, width, 3), dtype=np.uint8)
+
+    def Composite(self, frameImage):
+        """
+        Key a frame onto the background
+
+        Args:
+            frameImage (Image or np.ndarray): RGB frame of any size
+
+        Returns:
+            np.ndarray: HxWx3 uint8 composite; the buffer is reused for the next frame
+        """
+        if isinstance(frameImage, np.ndarray):
+            if frameImage.shape[:2] == self.fgNp.shape[:2]:
+                np.copyto(self.fgNp, frameImage)
+                frameImage = None
+            else:
+                frameImage = Image.fromarray(frameImage, "RGB")
+        if frameImage is not None:
+            if frameImage.mode != "RGB":
+                frameImage = frameImage.convert("RGB")
+            if frameImage.size != self.previewSize:
+                frameImage = frameImage.resize(self.previewSize, Image.BILINEAR)
+            np.copyto(self.fgNp, np.asarray(frameImage))
+        return greenscreen.OverlayArrays(self.fgNp, self.bgNp, self.refColors, self.tolA, self.tolB, self.alphaLUT,
+                                         self.out, self.work, self.filterRadius)
+
+    def Run(self, source, targetFPS=15.0, onFrame=None, onStats=None, statsInterval=1.0):
+        """
+        Composite frames of a source until it ends, at no more than targetFPS
+
+        Args:
+            source: frame source, see DirectoryFrameSource
+            targetFPS (float): maximum frame rate
+            onFrame (callable): called with each composite array and the Frame; the array is reused afterwards
+            onStats (callable): called with the PreviewStats every statsInterval seconds
+
+        Returns:
+            PreviewStats: statistics at the end of the stream
+        """
+        stats = PreviewStats()
+        grabber = FrameGrabber(source)
+        interval = 1.0 / targetFPS
+        nextTime = time.time()
+        nextStatsTime = nextTime + statsInterval
+        try:
+            while True:
+                now = time.time()
+                if now < nextTime:
+                    time.sleep(nextTime - now)
+                # when behind schedule, do not try to catch up
+                nextTime = max(nextTime + interval, time.time())
+                frame = grabber.Next(timeout=1.0)
+                if frame is None:
+                    if grabber.ended:
+                        break
+                    continue
+                composite = self.Composite(frame.image)
+                stats.AddFrame(frame, time.time())
+                if onFrame is not None:
+                    onFrame(composite, frame)
+                if onStats is not None and time.time() >= nextStatsTime:
+                    onStats(stats)
+                    nextStatsTime = time.time() + statsInterval
+        finally:
+            grabber.Stop()
+        return stats
+
+
+def Main(argv=None):
+    parser = argparse.ArgumentParser(description="Live green screen preview of a frame stream")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--frames", help="directory of JPEG frames, played back at --source-fps")
+    source.add_argument("--video", help="video file or capture device (e.g. /dev/video0 or 0), needs OpenCV")
+    parser.add_argument("--source-fps", type=float, default=30.0, help="frame rate of --frames (default: 30)")
+    parser.add_argument("-b", "--background", required=True, help="background image")
+    parser.add_argument("-r", "--reference", required=True, help="image of the empty green screen")
+    parser.add_argument("--tol", nargs=2, type=float, default=[30., 40.], metavar=("A", "B"),
+                        help="keying tolerances, see greenscreen.Overlay (default: 30 40)")
+    parser.add_argument("--lut", action="store_true", help="use the CbCr lookup table for keying")
+    parser.add_argument("--filter-radius", type=int, default=1, metavar="R",
+                        help="radius of the mask smoothing filter at preview size, 0 to disable (default: 1)")
+    parser.add_argument("--fps", type=float, default=15.0, help="target preview frame rate (default: 15)")
+    parser.add_argument("--size", nargs=2, type=int, default=[640, 480], metavar=("W", "H"),
+                        help="preview size (default: 640 480)")
+    parser.add_argument("--output", help="directory to write the composited frames to, for inspection")
+    args = parser.parse_args(argv)
+
+    refColors = greenscreen.GetRefColor(Image.open(args.reference))
+    alphaLUT = greenscreen.MakeAlphaLUT(refColors[1], tolA=args.tol[0], tolB=args.tol[1]) if args.lut else None
+    preview = LivePreview(Image.open(args.background), refColors, tolA=args.tol[0], tolB=args.tol[1],
+                          alphaLUT=alphaLUT, previewSize=args.size, filterRadius=args.filter_radius)
+    if args.frames is not None:
+        frameSource = DirectoryFrameSource(args.frames, fps=args.source_fps, size=args.size)
+    else:
+        frameSource = VideoFrameSource(int(args.video) if args.video.isdigit() else args.video)
+
+    onFrame = None
+    if args.output is not None:
+        if not path.isdir(args.output):
+            os.makedirs(args.output)
+        onFrame = lambda composite, frame: Image.fromarray(composite, "RGB").save(
+            path.join(args.output, "frame%06d.jpg" % frame.seq))
+
+    def PrintStats(stats):
+        print stats
+        sys.stdout.flush()
+
+    try:
+        stats = preview.Run(frameSource, targetFPS=args.fps, onFrame=onFrame, onStats=PrintStats)
+    except KeyboardInterrupt:
+        return 130
+    print "Done:", stats
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(Main())
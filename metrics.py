@@ -0,0 +1,210 @@
+"""
+Per-stage latency metrics, to find out where the time between shutter release and print goes
+
+Timing hooks around the stages of the pipeline feed a store of recent samples per stage, from which p50 and
+p95 latencies are computed; all samples can also be logged to a CSV file. The hooks do nothing until
+Enable() is called; while disabled, a hook costs a function call and a comparison.
+
+Example:
+    with metrics.Timed(metrics.StageSave):
+        compoundImage.save(CompoundImagePath)
+"""
+
+import csv
+import json
+import math
+import os
+import threading
+import time
+from collections import deque
+from os import path
+
+from PIL import Image
+
+# pipeline stages, in the order a photo passes them
+StageTransfer = "transfer"  # shutter release (EXIF time, needs the camera clock in sync) until the file is complete
+StageDetection = "detection"  # photo file complete until it has been picked up by the directory monitor
+StageDecode = "decode"  # JPEG decoding of the photo
+StageKeying = "keying"  # keying of the photo; with a memory budget, includes compositing
+StageCompositing = "compositing"  # blending the keyed photo onto the background
+StageRemote = "remote"  # upload and compositing on a compositing service, see service.py
+StageThumbnail = "thumbnail"  # down-scaled renders of compound images for display
+StageSave = "save"  # JPEG encoding and writing of the compound image
+StagePrint = "print"  # rendering for the printer and submission with lpr
+Stages = [StageTransfer, StageDetection, StageDecode, StageKeying, StageCompositing, StageRemote, StageThumbnail,
+          StageSave, StagePrint]
+
+_EXIFDateTimeOriginal = 36867
+
+# the store receiving samples, None while disabled
+_store = None
+
+
+def Percentile(sortedValues, q):
+    """ Nearest-rank percentile q (0..100) of a sorted list """
+    if len(sortedValues) == 0:
+        return None
+    rank = int(math.ceil(q / 100.0 * len(sortedValues)))
+    return sortedValues[min(len(sortedValues), max(1, rank)) - 1]
+
+
+class MetricsStore(object):
+    """
+    Recent latency samples per stage, optionally logged to a CSV file
+
+    Args:
+        window (int): number of recent samples per stage the statistics are computed from
+        logPath (str): optional CSV file receiving every sample as 'time,stage,seconds'; appended to if it exists
+    """
+
+    def __init__(self, window=200, logPath=None):
+        self.window = window
+        self.lock = threading.Lock()
+        self.samples = {}
+        self.counts = {}
+        self.logFile = None
+        if logPath is not None:
+            newFile = not path.exists(logPath)
+            self.logFile = open(logPath, "ab")
+            self.logWriter = csv.writer(self.logFile)
+            if newFile:
+                self.logWriter.writerow(["time", "stage", "seconds"])
+
+    def Add(self, stage, seconds, timestamp=None):
+        with self.lock:
+            samples = self.samples.get(stage)
+            if samples is None:
+                samples = self.samples[stage] = deque(maxlen=self.window)
+            samples.append(seconds)
+            self.counts[stage] = self.counts.get(stage, 0) + 1
+            if self.logFile is not None:
+                self.logWriter.writerow(["%.3f" % (timestamp or time.time()), stage, "%.6f" % seconds])
+                # samples are rare, and the log should survive a crash
+                self.logFile.flush()
+
+    def Summary(self):
+        """
+        Return dict: stage -> dict with 'count' (all samples so far) and, over the recent samples,
+        'p50', 'p95' and 'last' in seconds
+        """
+        with self.lock:
+            items = [(stage, list(samples), self.counts[stage]) for stage, samples in self.samples.items()]
+        summary = {}
+        for stage, samples, count in items:
+            ordered = sorted(samples)
+            summary[stage] = {"count": count, "p50": Percentile(ordered, 50), "p95": Percentile(ordered, 95),
+                              "last": samples[-1]}
+        return summary
+
+    def SummaryLines(self):
+        """ Summary() as text, one line per stage in pipeline order """
+        summary = self.Summary()
+        return ["%-11s p50 %6.0f ms  p95 %6.0f ms  (%d)" % (
+            stage, 1000 * summary[stage]["p50"], 1000 * summary[stage]["p95"], summary[stage]["count"])
+            for stage in Stages + sorted(set(summary) - set(Stages)) if stage in summary]
+
+    def WriteJSON(self, jsonPath):
+        """ Write Summary() to a JSON file """
+        tmpPath = jsonPath + ".tmp"
+        with open(tmpPath, "w") as f:
+            json.dump({"time": time.time(), "window": self.window, "stages": self.Summary()}, f, indent=2,
+                      sort_keys=True)
+        os.rename(tmpPath, jsonPath)
+
+    def Close(self):
+        with self.lock:
+            if self.logFile is not None:
+                self.logFile.close()
+                self.logFile = None
+
+
+def Enable(window=200, logPath=None):
+    """ Start collecting samples, see MetricsStore; returns the store """
+    global _store
+    _store = MetricsStore(window, logPath)
+    return _store
+
+
+def Disable():
+    global _store
+    store, _store = _store, None
+    if store is not None:
+        store.Close()
+
+
+def Store():
+    """ The MetricsStore receiving samples, None while disabled """
+    return _store
+
+
+def Record(stage, seconds, timestamp=None):
+    """ Add a sample measured elsewhere """
+    if _store is not None:
+        _store.Add(stage, seconds, timestamp)
+
+
+class _Timer(object):
+    __slots__ = ("stage", "startTime")
+
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        self.startTime = time.time()
+        return self
+
+    def __exit__(self, excType, excValue, tb):
+        # failed stages would distort the statistics
+        if excType is None and _store is not None:
+            _store.Add(self.stage, time.time() - self.startTime)
+        return False
+
+
+class _NullTimer(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, tb):
+        return False
+
+
+_nullTimer = _NullTimer()
+
+
+def Timed(stage, record=True):
+    """
+    Context manager timing the enclosed code as a sample of a stage
+
+    Args:
+        stage (str): see the Stage* constants
+        record (bool): if False, nothing is timed, e.g. for work done ahead that no guest is waiting for
+    """
+    if _store is None or not record:
+        return _nullTimer
+    return _Timer(stage)
+
+
+def CaptureTime(photoPath):
+    """ Shutter release time of a photo from its EXIF data, as a time.time() value; None if not available """
+    try:
+        exif = Image.open(photoPath)._getexif()
+        return time.mktime(time.strptime(exif[_EXIFDateTimeOriginal], "%Y:%m:%d %H:%M:%S"))
+    except (IOError, AttributeError, KeyError, TypeError, ValueError):
+        return None
+
+
+def RecordArrival(photoPath):
+    """ Record transfer and detection latency of a photo that has just been picked up """
+    if _store is None:
+        return
+    now = time.time()
+    try:
+        mtime = path.getmtime(photoPath)
+    except OSError:
+        return
+    _store.Add(StageDetection, max(0.0, now - mtime), now)
+    captureTime = CaptureTime(photoPath)
+    # EXIF times have a resolution of a second; a negative transfer time means the clocks are not in sync
+    if captureTime is not None and mtime - captureTime >= -1.0:
+        _store.Add(StageTransfer, max(0.0, mtime - captureTime), now)
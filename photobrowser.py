@@ -0,0 +1,300 @@
+"""
+Contact sheet of all photos of a session, for browsing events with tens of thousands of photos
+
+The sheet is a single window drawing only the tiles in view; there are no windows or bitmaps per photo.
+Thumbnails of the tiles in view (and a few rows around them) are loaded in a background thread and kept in a
+cache of bounded size, so memory use and paint time do not grow with the number of photos.
+"""
+
+import datetime
+import time
+
+import wx
+from PIL import Image
+
+import caching
+
+TileSize = (192, 128)  # maximum size of a thumbnail in the sheet
+TileGap = 8  # space between tiles
+TileCacheBytes = 64 * 2 ** 20  # memory limit for tile thumbnails
+nPrefetchRows = 3  # rows above and below the view whose thumbnails are loaded ahead
+SelectedTileBorderWidth = 4  # border around the tile of the selected photo
+SheetBackgroundColour = (40, 40, 40)
+
+
+def FitSize(size, boxSize):
+    """ Largest size with the aspect ratio of 'size' that fits into 'boxSize' """
+    scale = min(float(boxSize[0]) / size[0], float(boxSize[1]) / size[1])
+    return max(1, int(round(size[0] * scale))), max(1, int(round(size[1] * scale)))
+
+
+def ParseJumpTarget(text, referenceTime):
+    """
+    Parse what to jump to
+
+    Args:
+        text (str): photo number as shown in the GUI (starting at 1), or a time 'HH:MM', 'HH:MM:SS',
+                    'YYYY-MM-DD HH:MM' or 'YYYY-MM-DD HH:MM:SS'; times without a date are on the day of referenceTime
+        referenceTime (float): time.time() value
+
+    Returns:
+        ('index', int) or ('time', float): photo index, or time.time() value
+
+    Raises:
+        ValueError: if the text is neither
+    """
+    text = text.strip()
+    if text.isdigit():
+        return "index", int(text) - 1
+    for fmt in ("%Y-%m-%d %H:%M", "%Y-%m-%d %H:%M:%S"):
+        try:
+            return "time", time.mktime(datetime.datetime.strptime(text, fmt).timetuple())
+        except ValueError:
+            pass
+    referenceDate = datetime.date.fromtimestamp(referenceTime)
+    for fmt in ("%H:%M", "%H:%M:%S"):
+        try:
+            t = datetime.datetime.strptime(text, fmt).time()
+        except ValueError:
+            continue
+        return "time", time.mktime(datetime.datetime.combine(referenceDate, t).timetuple())
+    raise ValueError("not a photo number or time: %r" % text)
+
+
+def NearestTimeIndex(times, t):
+    """ Index of the time closest to t, -1 if there are none; times need not be sorted """
+    if len(times) == 0:
+        return -1
+    return min(xrange(len(times)), key=lambda i: abs(times[i] - t))
+
+
+class PhotoBrowser(wx.Panel):
+    """
+    Scrollable contact sheet of photos, with jumping to a photo by number or time
+
+    Args:
+        parent: parent window
+        imagePaths (list): paths of the images to show, one per photo; read on each paint, so appending to
+                           the list or replacing entries is picked up by RefreshTiles()
+        photoTimes (list): time.time() value of each photo, for jumping by time
+        previewStore (caching.PreviewStore): source of the thumbnails, which are then scaled to TileSize
+        onSelect (callable): called with the index of a photo clicked on
+    """
+
+    def __init__(self, parent, imagePaths, photoTimes, previewStore, onSelect):
+        wx.Panel.__init__(self, parent)
+        self.imagePaths = imagePaths
+        self.photoTimes = photoTimes
+        self.previewStore = previewStore
+        self.onSelect = onSelect
+        self.topRow = 0
+        self.selectedIdx = -1
+        # tile rectangles of the last paint, by image path
+        self.tileRects = {}
+
+        self.tileCache = caching.LRUCache(TileCacheBytes)
+        self.tileLoader = caching.ThumbnailLoader(self.tileCache, self.LoadTile,
+                                                  onLoaded=lambda imgPath: wx.CallAfter(self.OnTileLoaded, imgPath))
+
+        box = wx.BoxSizer(wx.VERTICAL)
+        self.SetSizer(box)
+
+        jumpBox = wx.BoxSizer(wx.HORIZONTAL)
+        box.Add(jumpBox, 0, wx.ALL | wx.EXPAND, 5)
+        jumpBox.Add(wx.StaticText(self, -1, "Go to photo number or time (HH:MM):"), 0,
+                    wx.ALL | wx.ALIGN_CENTER_VERTICAL, 5)
+        self.jumpText = wx.TextCtrl(self, style=wx.TE_PROCESS_ENTER)
+        self.jumpText.Bind(wx.EVT_TEXT_ENTER, self.OnJump)
+        jumpBox.Add(self.jumpText, 0, wx.ALL | wx.ALIGN_CENTER_VERTICAL, 5)
+        jumpButton = wx.Button(self, label="Go")
+        jumpButton.Bind(wx.EVT_BUTTON, self.OnJump)
+        jumpBox.Add(jumpButton, 0, wx.ALL | wx.ALIGN_CENTER_VERTICAL, 5)
+        jumpBox.AddStretchSpacer(1)
+        self.infoText = wx.StaticText(self, -1, "")
+        jumpBox.Add(self.infoText, 0, wx.ALL | wx.ALIGN_CENTER_VERTICAL, 5)
+
+        sheetBox = wx.BoxSizer(wx.HORIZONTAL)
+        box.Add(sheetBox, 1, wx.ALL | wx.EXPAND, 0)
+        self.canvas = wx.Panel(self)
+        self.canvas.SetBackgroundColour(SheetBackgroundColour)
+        sheetBox.Add(self.canvas, 1, wx.EXPAND)
+        # scrolling is by rows, so the scroll range stays small for any number of photos
+        self.scrollBar = wx.ScrollBar(self, style=wx.SB_VERTICAL)
+        sheetBox.Add(self.scrollBar, 0, wx.EXPAND)
+
+        self.canvas.Bind(wx.EVT_PAINT, self.OnPaint)
+        self.canvas.Bind(wx.EVT_ERASE_BACKGROUND, lambda event: None)
+        self.canvas.Bind(wx.EVT_SIZE, self.OnSize)
+        self.canvas.Bind(wx.EVT_LEFT_DOWN, self.OnClick)
+        self.canvas.Bind(wx.EVT_MOUSEWHEEL, self.OnMouseWheel)
+        self.scrollBar.Bind(wx.EVT_SCROLL, self.OnScroll)
+        self.Bind(wx.EVT_WINDOW_DESTROY, self.OnDestroy)
+
+    # layout, in rows of tiles
+
+    def Columns(self):
+        return max(1, (self.canvas.Size[0] - TileGap) // (TileSize[0] + TileGap))
+
+    def VisibleRows(self):
+        """ Rows fitting into the view, the last one possibly partly """
+        rowHeight = TileSize[1] + TileGap
+        return max(1, (self.canvas.Size[1] - TileGap + rowHeight - 1) // rowHeight)
+
+    def FullRows(self):
+        """ Rows fitting into the view completely """
+        return max(1, (self.canvas.Size[1] - TileGap) // (TileSize[1] + TileGap))
+
+    def Rows(self):
+        return (len(self.imagePaths) + self.Columns() - 1) // self.Columns()
+
+    def TileRect(self, idx):
+        """ (x, y, width, height) of a photo's tile in the canvas, for the current scroll position """
+        row, col = divmod(idx, self.Columns())
+        return (TileGap + col * (TileSize[0] + TileGap), TileGap + (row - self.topRow) * (TileSize[1] + TileGap),
+                TileSize[0], TileSize[1])
+
+    def ScrollToRow(self, row):
+        self.topRow = max(0, min(row, self.Rows() - self.FullRows()))
+        self.UpdateScrollBar()
+        self.canvas.Refresh()
+
+    def ScrollToIndex(self, idx, select=True):
+        """ Scroll a photo into view, to the middle unless it is in view already, and mark it as selected """
+        if select:
+            self.selectedIdx = idx
+        if idx < 0:
+            self.canvas.Refresh()
+            return
+        row = idx // self.Columns()
+        if not self.topRow <= row < self.topRow + self.FullRows():
+            self.ScrollToRow(row - self.FullRows() // 2)
+        else:
+            self.canvas.Refresh()
+
+    def UpdateScrollBar(self):
+        fullRows = self.FullRows()
+        self.scrollBar.SetScrollbar(self.topRow, fullRows, max(self.Rows(), fullRows), max(1, fullRows - 1))
+
+    def RefreshTiles(self):
+        """ Show changes of the photo list, e.g. new photos or new compound images """
+        self.UpdateScrollBar()
+        self.UpdateInfo()
+        self.canvas.Refresh()
+
+    def UpdateInfo(self):
+        text = "%d photos" % len(self.imagePaths)
+        if len(self.photoTimes) > 0:
+            text += ", %s - %s" % tuple(time.strftime("%a %H:%M", time.localtime(t))
+                                        for t in (min(self.photoTimes), max(self.photoTimes)))
+        self.infoText.SetLabel(text)
+        self.Layout()
+
+    # tiles
+
+    def LoadTile(self, imgPath):
+        """ Thumbnail at tile size; runs in the loader thread """
+        image = self.previewStore.Get(imgPath)
+        return image.resize(FitSize(image.size, TileSize), Image.ANTIALIAS)
+
+    def GetTileBitmap(self, imgPath):
+        """ Bitmap of a tile, or None if its thumbnail is not loaded (yet) """
+        try:
+            thumbnail = self.tileCache.Get(caching.FileStateKey(imgPath))
+        except OSError:
+            # compound image not created yet
+            return None
+        if thumbnail is None:
+            return None
+        if thumbnail.bitmap is None:
+            thumbnail.bitmap = wx.BitmapFromBuffer(thumbnail.image.size[0], thumbnail.image.size[1],
+                                                   thumbnail.image.tobytes())
+        return thumbnail.bitmap
+
+    def OnTileLoaded(self, imgPath):
+        rect = self.tileRects.get(imgPath)
+        if rect is not None:
+            self.canvas.RefreshRect(wx.Rect(*rect), False)
+
+    def OnPaint(self, event):
+        dc = wx.BufferedPaintDC(self.canvas)
+        dc.SetBackground(wx.Brush(SheetBackgroundColour))
+        dc.Clear()
+        columns = self.Columns()
+        first = self.topRow * columns
+        last = min(len(self.imagePaths), first + self.VisibleRows() * columns)
+        self.tileRects = {}
+        missing = []
+        dc.SetFont(wx.Font(10, wx.SWISS, wx.NORMAL, wx.BOLD))
+        for idx in range(first, last):
+            imgPath = self.imagePaths[idx]
+            x, y, w, h = rect = self.TileRect(idx)
+            self.tileRects[imgPath] = rect
+            bmp = self.GetTileBitmap(imgPath)
+            if bmp is not None:
+                dc.DrawBitmap(bmp, x + (w - bmp.GetWidth()) // 2, y + (h - bmp.GetHeight()) // 2)
+            else:
+                missing.append(imgPath)
+                dc.SetPen(wx.Pen((90, 90, 90)))
+                dc.SetBrush(wx.Brush((60, 60, 60)))
+                dc.DrawRectangle(x, y, w, h)
+            label = str(idx + 1)
+            if idx < len(self.photoTimes):
+                label += "  " + time.strftime("%H:%M", time.localtime(self.photoTimes[idx]))
+            dc.SetTextForeground((0, 0, 0))
+            dc.DrawText(label, x + 5, y + 5)
+            dc.SetTextForeground((255, 255, 255))
+            dc.DrawText(label, x + 4, y + 4)
+            if idx == self.selectedIdx:
+                dc.SetPen(wx.Pen((0, 255, 50), SelectedTileBorderWidth))
+                dc.SetBrush(wx.TRANSPARENT_BRUSH)
+                dc.DrawRectangle(x, y, w, h)
+
+        # thumbnails in view first, then the rows around it, nearest first
+        prefetch = []
+        for offset in range(1, nPrefetchRows + 1):
+            for row in (self.topRow + self.VisibleRows() - 1 + offset, self.topRow - offset):
+                prefetch += self.imagePaths[max(0, row * columns):max(0, (row + 1) * columns)]
+        self.tileLoader.Request(missing + prefetch)
+
+    # input
+
+    def OnSize(self, event):
+        # keep the first photo in view when the number of columns changes
+        self.ScrollToRow(self.topRow)
+        event.Skip()
+
+    def OnScroll(self, event):
+        self.topRow = self.scrollBar.GetThumbPosition()
+        self.canvas.Refresh()
+
+    def OnMouseWheel(self, event):
+        steps = -event.GetWheelRotation() // max(1, event.GetWheelDelta())
+        self.ScrollToRow(self.topRow + steps)
+
+    def OnClick(self, event):
+        col = (event.GetX() - TileGap // 2) // (TileSize[0] + TileGap)
+        row = self.topRow + (event.GetY() - TileGap // 2) // (TileSize[1] + TileGap)
+        idx = row * self.Columns() + col
+        if 0 <= col < self.Columns() and 0 <= idx < len(self.imagePaths):
+            self.selectedIdx = idx
+            self.onSelect(idx)
+
+    def OnJump(self, event):
+        referenceTime = time.time()
+        if 0 <= self.selectedIdx < len(self.photoTimes):
+            referenceTime = self.photoTimes[self.selectedIdx]
+        try:
+            kind, value = ParseJumpTarget(self.jumpText.GetValue(), referenceTime)
+        except ValueError:
+            wx.Bell()
+            return
+        if kind == "time":
+            idx = NearestTimeIndex(self.photoTimes, value)
+        else:
+            idx = max(0, min(len(self.imagePaths) - 1, value))
+        self.ScrollToIndex(idx)
+
+    def OnDestroy(self, event):
+        if event.GetEventObject() is self:
+            self.tileLoader.Stop()
+        event.Skip()
@@ -0,0 +1,206 @@
+"""
+Background print queue, sending compound images to the printer without blocking the GUI
+"""
+
+import datetime
+import os
+import Queue
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+import traceback
+from os import path
+
+from PIL import Image
+
+import metrics
+
+
+def RenderForPrint(img, pageSizeMM, dpi):
+    """
+    Scale an image to fit a page at the printer's native resolution, centered on white
+
+    Args:
+        img (Image): image to print
+        pageSizeMM ((float, float)): page width and height in mm, as the image is oriented on the page
+        dpi (int): printer resolution
+
+    Returns:
+        Image: RGB image of exactly the page size in pixels
+    """
+    pageSize = tuple(int(round(s / 25.4 * dpi)) for s in pageSizeMM)
+    scale = min(float(pageSize[0]) / img.size[0], float(pageSize[1]) / img.size[1])
+    imgSize = (max(1, int(round(img.size[0] * scale))), max(1, int(round(img.size[1] * scale))))
+    # the decoder can do most of the down-scaling
+    img.draft("RGB", imgSize)
+    img = img.convert("RGB").resize(imgSize, Image.ANTIALIAS)
+    page = Image.new("RGB", pageSize, (255, 255, 255))
+    page.paste(img, ((pageSize[0] - imgSize[0]) // 2, (pageSize[1] - imgSize[1]) // 2))
+    return page
+
+
+class PrintSpooler(object):
+    """
+    Print queue processed by a background thread.
+
+    Each job copies the compound image to the printed images directory as a backup, renders it at the
+    page size and resolution of the printer to a temporary file and submits that with 'lpr'. The printer's
+    queue is tracked with 'lpstat'; both commands can be replaced, e.g. by stubs for testing.
+
+    Args:
+        printedImagesDir (str): directory for backup copies
+        printerOptions (list): options passed to lpr
+        printerName (str): printer whose queue is tracked, None for all printers
+        pageSizeMM ((float, float)): page width and height in mm, see RenderForPrint()
+        dpi (int): printer resolution, see RenderForPrint()
+        lprCommand (list): command used to submit a file, the file path is appended
+        lpstatCommand (list): command listing the printer's jobs, one per output line
+        nAttempts (int): times lpr is run for a job before it counts as failed
+        retryDelay (float): seconds between attempts
+        statusPollInterval (float): seconds between lpstat calls while jobs are in the printer queue
+        onStatus (callable): called in the spooler thread with a PrintStatus whenever the status changes
+    """
+
+    def __init__(self, printedImagesDir, printerOptions, printerName=None, pageSizeMM=(153., 100.), dpi=300,
+                 lprCommand=("lpr",), lpstatCommand=("lpstat", "-o"), nAttempts=3, retryDelay=2.0,
+                 statusPollInterval=5.0, onStatus=None):
+        self.printedImagesDir = printedImagesDir
+        self.printerOptions = list(printerOptions)
+        self.printerName = printerName
+        self.pageSizeMM = pageSizeMM
+        self.dpi = dpi
+        self.lprCommand = list(lprCommand)
+        self.lpstatCommand = list(lpstatCommand)
+        self.nAttempts = nAttempts
+        self.retryDelay = retryDelay
+        self.statusPollInterval = statusPollInterval
+        self.onStatus = onStatus
+
+        self.jobs = Queue.Queue()
+        self.status = PrintStatus()
+        self.statusLock = threading.Lock()
+        self.stopped = False
+        self.thread = threading.Thread(target=self.SpoolerLoop, name="PrintSpooler")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def Submit(self, imgPath, waitFunc=None):
+        """
+        Queue an image for printing
+
+        Args:
+            imgPath (str): path of the image to print
+            waitFunc (callable): called in the spooler thread before the image is read, e.g. to wait until it
+                                 has been written to disk; may return the path of the image to print instead,
+                                 e.g. if it has been replaced in the meantime
+        """
+        with self.statusLock:
+            self.status.nQueued += 1
+        self.jobs.put((imgPath, waitFunc))
+        self.ReportStatus()
+
+    def Stop(self):
+        self.stopped = True
+        self.jobs.put(None)
+
+    def SpoolerLoop(self):
+        while not self.stopped:
+            try:
+                job = self.jobs.get(timeout=self.statusPollInterval)
+            except Queue.Empty:
+                job = None
+            if job is not None:
+                imgPath, waitFunc = job
+                try:
+                    if waitFunc is not None:
+                        imgPath = waitFunc() or imgPath
+                    with metrics.Timed(metrics.StagePrint):
+                        ok = self.PrintImage(imgPath)
+                except Exception:
+                    traceback.print_exc()
+                    ok = False
+                with self.statusLock:
+                    self.status.nQueued -= 1
+                    self.status.lastJobOK = ok
+            if job is not None or self.status.nPrinterJobs:
+                self.UpdatePrinterJobs()
+            if job is not None:
+                self.ReportStatus()
+
+    def PrintImage(self, imgPath):
+        """ Back up, render and submit an image; returns True if it was accepted by lpr """
+        timeStr = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+        imgName = path.split(imgPath)[1]
+        backupPath = path.join(self.printedImagesDir, timeStr + "_" + imgName)
+        # the backup is rendered, the compound image may be replaced in the meantime
+        shutil.copy(imgPath, backupPath)
+
+        page = RenderForPrint(Image.open(backupPath), self.pageSizeMM, self.dpi)
+        fd, printPath = tempfile.mkstemp("_print_" + imgName)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                page.save(f, "JPEG", quality=95, dpi=(self.dpi, self.dpi))
+            command = list(self.lprCommand)
+            if self.printerName is not None:
+                command += ["-P", self.printerName]
+            # e.g. the CUPS scheduler restarting after the printer was switched on
+            for attempt in range(self.nAttempts):
+                if attempt > 0:
+                    time.sleep(self.retryDelay)
+                if subprocess.call(command + self.printerOptions + [printPath]) == 0:
+                    return True
+            return False
+        finally:
+            # lpr has copied the file to the spool directory
+            os.remove(printPath)
+
+    def UpdatePrinterJobs(self):
+        """ Count the printer's pending jobs with lpstat """
+        command = list(self.lpstatCommand)
+        if self.printerName is not None:
+            command.append(self.printerName)
+        try:
+            output = subprocess.check_output(command)
+            nPrinterJobs = len([line for line in output.splitlines() if line.strip()])
+        except (OSError, subprocess.CalledProcessError):
+            nPrinterJobs = None
+        with self.statusLock:
+            changed = nPrinterJobs != self.status.nPrinterJobs
+            self.status.nPrinterJobs = nPrinterJobs
+        if changed:
+            self.ReportStatus()
+
+    def ReportStatus(self):
+        if self.onStatus is not None:
+            with self.statusLock:
+                status = self.status.Copy()
+            self.onStatus(status)
+
+
+class PrintStatus(object):
+    """
+    Attributes:
+        nQueued (int): jobs waiting in the spooler, not yet submitted to the printer
+        nPrinterJobs (int): jobs in the printer queue as reported by lpstat, None if unknown
+        lastJobOK (bool): whether the last submitted job was accepted, None if there was none yet
+    """
+
+    def __init__(self):
+        self.nQueued = 0
+        self.nPrinterJobs = 0
+        self.lastJobOK = None
+
+    def Copy(self):
+        status = PrintStatus()
+        status.nQueued = self.nQueued
+        status.nPrinterJobs = self.nPrinterJobs
+        status.lastJobOK = self.lastJobOK
+        return status
+
+    def __str__(self):
+        text = "Print queue: %d" % (self.nQueued + (self.nPrinterJobs or 0))
+        if self.lastJobOK is False:
+            text += " - Error printing!"
+        return text
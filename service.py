@@ -0,0 +1,299 @@
+"""
+Local HTTP compositing service, shared by several booth stations
+
+The service keeps the reference colors and resized backgrounds in memory and composites uploaded photos
+on a shared pool of workers, so all stations get the same results without each decoding the reference
+image and backgrounds. It does not need wx or a display.
+
+Requests:
+    GET  /backgrounds                      JSON list of background IDs (file names in the backgrounds directory)
+    GET  /status                           JSON with keying parameters and counters
+    POST /composite?background=<ID>        body: JPEG foreground photo; response: JPEG compound image, with the
+                                           keying tolerances used in the X-Keying-Tolerances header
+
+Example:
+    python service.py -b /greenie/backgrounds -r /greenie/reference.jpg --host 0.0.0.0 --port 8765
+"""
+
+import argparse
+import BaseHTTPServer
+import io
+import json
+import multiprocessing
+import os
+import SocketServer
+import threading
+import urllib
+import urllib2
+import urlparse
+from os import path
+
+from PIL import Image
+
+import caching
+import compositing
+import greenscreen
+import watcher
+
+DefaultPort = 8765
+MaxUploadBytes = 64 * 2 ** 20  # larger uploads are rejected
+CompositeJPEGQuality = 95  # compound images are sent back at high quality, clients usually re-encode them
+TolerancesHeader = "X-Keying-Tolerances"  # tolerances used for a compound image, e.g. "30 40"
+
+
+class ServiceError(Exception):
+    """ Error reported to the client with an HTTP status code """
+
+    def __init__(self, status, message):
+        Exception.__init__(self, message)
+        self.status = status
+
+
+class CompositingService(object):
+    """
+    Compositing state shared by all requests.
+
+    Args:
+        BGImagesDir (str): directory containing the background images
+        referenceImagePath (str): image of the empty green screen; reloaded when the file changes
+        tol ((float, float)): keying tolerances, see greenscreen.Overlay()
+        useLUT (bool): use the CbCr lookup table for keying, see greenscreen.MakeAlphaLUT()
+        filterRadius (int): radius of the mask smoothing filter, see greenscreen.Overlay()
+        nWorkers (int): number of photos composited at the same time
+        nThreads (int): number of threads per photo, see greenscreen.ForEachBand()
+        backgroundStoreSize (int): memory limit for resized backgrounds, see caching.BackgroundStore
+    """
+
+    def __init__(self, BGImagesDir, referenceImagePath, tol=(30., 40.), useLUT=False, filterRadius=1, nWorkers=1,
+                 nThreads=1, backgroundStoreSize=512 * 2 ** 20):
+        self.BGImagesDir = BGImagesDir
+        self.referenceImagePath = referenceImagePath
+        self.tol = tuple(tol)
+        self.useLUT = useLUT
+        self.filterRadius = filterRadius
+        self.nThreads = nThreads
+        self.backgroundStore = caching.BackgroundStore(backgroundStoreSize)
+        self.queue = compositing.CompositingQueue(nWorkers)
+        self.keyingLock = threading.Lock()
+        self.keyingState = None
+        self.refColors = None
+        self.alphaLUT = None
+        self.counterLock = threading.Lock()
+        self.nComposited = 0
+        self.nFailed = 0
+        self.requestCounter = 0
+        self.UpdateKeying()
+
+    def UpdateKeying(self):
+        """ Re-compute reference colors and keying table if the reference image has changed """
+        with self.keyingLock:
+            state = (self.referenceImagePath, path.getmtime(self.referenceImagePath))
+            if state == self.keyingState:
+                return
+            self.refColors = greenscreen.GetRefColor(Image.open(self.referenceImagePath))
+            if self.useLUT:
+                self.alphaLUT = greenscreen.MakeAlphaLUT(self.refColors[1], tolA=self.tol[0], tolB=self.tol[1])
+            self.keyingState = state
+
+    def BackgroundIDs(self):
+        return sorted(n for n in os.listdir(self.BGImagesDir) if watcher.IsPhotoFile(n))
+
+    def BackgroundPath(self, backgroundID):
+        # IDs are plain file names, anything else could point outside the backgrounds directory
+        if backgroundID is None or backgroundID != path.basename(backgroundID) or \
+                backgroundID not in self.BackgroundIDs():
+            raise ServiceError(404, "unknown background %r" % backgroundID)
+        return path.join(self.BGImagesDir, backgroundID)
+
+    def Composite(self, fgImageData, backgroundID):
+        """
+        Composite an uploaded photo onto a background on the worker pool, blocking until it is done
+
+        Args:
+            fgImageData (str): encoded foreground image
+            backgroundID (str): background file name, see BackgroundIDs()
+
+        Returns:
+            str: JPEG-encoded compound image
+        """
+        BGImagePath = self.BackgroundPath(backgroundID)
+        try:
+            fgImage = Image.open(io.BytesIO(fgImageData))
+            fgImage.load()
+        except IOError:
+            raise ServiceError(400, "upload is not a readable image")
+        if fgImage.mode != "RGB":
+            fgImage = fgImage.convert("RGB")
+
+        done = threading.Event()
+        result = []
+
+        def Run():
+            self.UpdateKeying()
+            compoundImage = greenscreen.Overlay(fgImage, self.backgroundStore.Get(BGImagePath, fgImage.size),
+                                                self.refColors, tolA=self.tol[0], tolB=self.tol[1],
+                                                alphaLUT=self.alphaLUT, filterRadius=self.filterRadius,
+                                                nThreads=self.nThreads)
+            out = io.BytesIO()
+            compoundImage.save(out, "JPEG", quality=CompositeJPEGQuality)
+            return out.getvalue()
+
+        def OnDone(data):
+            result.append(data)
+            done.set()
+
+        with self.counterLock:
+            self.requestCounter += 1
+            key = ("request", self.requestCounter)
+        self.queue.Submit(key, Run, OnDone, compositing.PrioritySelected)
+        done.wait()
+        with self.counterLock:
+            if result[0] is None:
+                self.nFailed += 1
+            else:
+                self.nComposited += 1
+        if result[0] is None:
+            raise ServiceError(500, "compositing failed")
+        return result[0]
+
+    def Status(self):
+        with self.counterLock:
+            return {"reference": self.referenceImagePath,
+                    "refColors": [[int(c) for c in rc] for rc in self.refColors],
+                    "tol": list(self.tol),
+                    "useLUT": self.useLUT,
+                    "filterRadius": self.filterRadius,
+                    "queued": len(self.queue),
+                    "composited": self.nComposited,
+                    "failed": self.nFailed}
+
+
+class CompositingRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """ HTTP front end of the CompositingService in self.server.service """
+
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        if url.path == "/backgrounds":
+            self.SendJSON(self.server.service.BackgroundIDs())
+        elif url.path == "/status":
+            self.SendJSON(self.server.service.Status())
+        else:
+            self.SendError(404, "not found")
+
+    def do_POST(self):
+        url = urlparse.urlparse(self.path)
+        if url.path != "/composite":
+            self.SendError(404, "not found")
+            return
+        length = int(self.headers.getheader("Content-Length") or 0)
+        if length <= 0 or length > MaxUploadBytes:
+            self.SendError(413 if length > 0 else 411, "upload must have a Content-Length of up to %d bytes"
+                           % MaxUploadBytes)
+            return
+        fgImageData = self.rfile.read(length)
+        backgroundID = urlparse.parse_qs(url.query).get("background", [None])[0]
+        try:
+            data = self.server.service.Composite(fgImageData, backgroundID)
+        except ServiceError as e:
+            self.SendError(e.status, str(e))
+            return
+        self.SendData(data, "image/jpeg", headers=[(TolerancesHeader, "%r %r" % self.server.service.tol)])
+
+    def SendJSON(self, obj):
+        self.SendData(json.dumps(obj), "application/json")
+
+    def SendError(self, status, message):
+        # unlike send_error, keeps the connection usable and sends a plain text message
+        self.SendData(message + "\n", "text/plain", status)
+
+    def SendData(self, data, contentType, status=200, headers=()):
+        self.send_response(status)
+        self.send_header("Content-Type", contentType)
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class CompositingServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """ Serves each connection in its own thread; compositing itself happens on the service's worker pool """
+
+    daemon_threads = True
+
+    def __init__(self, address, service):
+        BaseHTTPServer.HTTPServer.__init__(self, address, CompositingRequestHandler)
+        self.service = service
+
+
+def CompositeRemote(serviceURL, FGImagePath, BGImageName, timeout=120.0):
+    """
+    Have a compositing service composite a photo; used by the GUI instead of compositing locally
+
+    Args:
+        serviceURL (str): base URL of the service, e.g. 'http://192.168.1.10:8765'
+        FGImagePath (str): foreground photo, uploaded as is
+        BGImageName (str): background file name, must be present on the service
+        timeout (float): seconds to wait for the service
+
+    Returns:
+        Image: the compound image
+        (float, float): keying tolerances used by the service, (None, None) if it did not report them
+    """
+    with open(FGImagePath, "rb") as f:
+        fgImageData = f.read()
+    url = serviceURL.rstrip("/") + "/composite?" + urllib.urlencode({"background": BGImageName})
+    request = urllib2.Request(url, fgImageData, {"Content-Type": "image/jpeg"})
+    response = urllib2.urlopen(request, timeout=timeout)
+    try:
+        image = Image.open(io.BytesIO(response.read()))
+        image.load()
+        tolHeader = response.info().getheader(TolerancesHeader)
+    finally:
+        response.close()
+    try:
+        tol = tuple(float(t) for t in tolHeader.split())
+    except (AttributeError, ValueError):
+        tol = ()
+    if len(tol) != 2:
+        tol = (None, None)
+    return image, tol
+
+
+def Main(argv=None):
+    parser = argparse.ArgumentParser(description="Green screen compositing service for several booth stations")
+    parser.add_argument("-b", "--backgrounds", required=True, help="directory containing background images")
+    parser.add_argument("-r", "--reference", required=True, help="image of the empty green screen")
+    parser.add_argument("--tol", nargs=2, type=float, default=[30., 40.], metavar=("A", "B"),
+                        help="keying tolerances, see greenscreen.Overlay (default: 30 40)")
+    parser.add_argument("--lut", action="store_true", help="use the CbCr lookup table for keying")
+    parser.add_argument("--filter-radius", type=int, default=1, metavar="R",
+                        help="radius of the mask smoothing filter, 0 to disable (default: 1)")
+    parser.add_argument("--host", default="127.0.0.1",
+                        help="address to listen on, use 0.0.0.0 to serve other machines (default: 127.0.0.1)")
+    parser.add_argument("--port", type=int, default=DefaultPort, help="port (default: %d)" % DefaultPort)
+    parser.add_argument("--workers", type=int, default=2, help="photos composited at the same time (default: 2)")
+    parser.add_argument("--threads", type=int, default=multiprocessing.cpu_count(),
+                        help="threads per photo (default: number of CPUs)")
+    parser.add_argument("--background-cache", type=int, default=512, metavar="MB",
+                        help="memory for resized backgrounds in MB (default: 512)")
+    args = parser.parse_args(argv)
+
+    service = CompositingService(args.backgrounds, args.reference, tol=args.tol, useLUT=args.lut,
+                                 filterRadius=args.filter_radius, nWorkers=args.workers, nThreads=args.threads,
+                                 backgroundStoreSize=args.background_cache * 2 ** 20)
+    server = CompositingServer((args.host, args.port), service)
+    print "Compositing service listening on http://%s:%d" % (args.host, args.port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.queue.Stop()
+
+
+if __name__ == '__main__':
+    Main()
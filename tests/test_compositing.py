@@ -0,0 +1,123 @@
+"""
+Tests of the background job queue in compositing.py
+
+Run from the repository root with: python -m unittest discover tests
+"""
+
+import threading
+import unittest
+
+import compositing
+
+
+class CompositingQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.queue = compositing.CompositingQueue(nWorkers=1)
+        self.lock = threading.Lock()
+        self.order = []
+        self.results = {}
+
+    def tearDown(self):
+        self.queue.Stop(wait=True)
+
+    def Block(self):
+        """ Occupy the worker until the returned event is set, so that jobs submitted meanwhile stay queued """
+        started = threading.Event()
+        release = threading.Event()
+
+        def Func():
+            started.set()
+            self.assertTrue(release.wait(30.0))
+
+        self.queue.Submit("blocker", Func)
+        self.assertTrue(started.wait(30.0))
+        return release
+
+    def Job(self, name):
+        """ Job function recording the order in which jobs run; its result is the name """
+        def Func():
+            with self.lock:
+                self.order.append(name)
+            return name
+        return Func
+
+    def Callback(self, key):
+        def OnResult(result):
+            self.results.setdefault(key, []).append(result)
+        return OnResult
+
+    def Submit(self, key, name, priority=compositing.PriorityBacklog):
+        self.queue.Submit(key, self.Job(name), self.Callback(key), priority)
+
+    def testPriorityOrder(self):
+        release = self.Block()
+        self.Submit("a", "a")
+        self.Submit("b", "b", compositing.PrioritySelected)
+        self.Submit("c", "c")
+        self.Submit("d", "d", compositing.PrioritySelected)
+        self.assertEqual(len(self.queue), 5)
+        release.set()
+        self.queue.WaitUntilIdle()
+        # by priority, then in order of submission
+        self.assertEqual(self.order, ["b", "d", "a", "c"])
+        self.assertEqual(self.results, {"a": ["a"], "b": ["b"], "c": ["c"], "d": ["d"]})
+
+    def testSupersedePending(self):
+        release = self.Block()
+        self.Submit("a", "a1")
+        self.Submit("a", "a2")
+        release.set()
+        self.queue.WaitUntilIdle()
+        self.assertEqual(self.order, ["a2"])
+        self.assertEqual(self.results, {"a": ["a2"]})
+
+    def testPromote(self):
+        release = self.Block()
+        self.Submit("a", "a")
+        self.Submit("b", "b")
+        self.Submit("c", "c")
+        self.assertTrue(self.queue.Promote("c"))
+        self.assertFalse(self.queue.Promote("x"))
+        release.set()
+        self.queue.WaitUntilIdle()
+        self.assertEqual(self.order, ["c", "a", "b"])
+        self.assertEqual(self.results, {"a": ["a"], "b": ["b"], "c": ["c"]})
+
+    def testCancelPending(self):
+        release = self.Block()
+        self.Submit("a", "a")
+        self.Submit("b", "b")
+        self.assertTrue(self.queue.IsPending("a"))
+        self.queue.CancelPending()
+        self.assertFalse(self.queue.IsPending("a"))
+        # the running job is not affected
+        self.assertTrue(self.queue.IsPending("blocker"))
+        self.Submit("c", "c")
+        release.set()
+        self.queue.WaitUntilIdle()
+        self.assertEqual(self.order, ["c"])
+        self.assertEqual(self.results, {"c": ["c"]})
+
+    def testSupersedeRunning(self):
+        started = threading.Event()
+        release = threading.Event()
+
+        def Func():
+            started.set()
+            self.assertTrue(release.wait(30.0))
+            return "a1"
+
+        self.queue.Submit("a", Func, self.Callback("a"))
+        self.assertTrue(started.wait(30.0))
+        # the running job's result is dropped, even though it finishes before the newer job has run
+        self.queue.Promote("a")
+        self.Submit("a", "a2")
+        release.set()
+        self.queue.WaitFor("a")
+        self.assertEqual(self.order, ["a2"])
+        self.assertEqual(self.results, {"a": ["a2"]})
+
+
+if __name__ == '__main__':
+    unittest.main()
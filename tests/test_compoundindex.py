@@ -0,0 +1,80 @@
+"""
+Tests of the compound image index in compoundindex.py
+
+Run from the repository root with: python -m unittest discover tests
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+from os import path
+
+import compoundindex
+
+
+class CompoundIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.compoundImagesDir = tempfile.mkdtemp()
+        self.dbPath = path.join(self.compoundImagesDir, "compound_index.sqlite")
+
+    def tearDown(self):
+        shutil.rmtree(self.compoundImagesDir)
+
+    def Touch(self, name, mtime=None):
+        imgPath = path.join(self.compoundImagesDir, name)
+        with open(imgPath, "wb"):
+            pass
+        if mtime is not None:
+            os.utime(imgPath, (mtime, mtime))
+        return imgPath
+
+    def Open(self):
+        index = compoundindex.CompoundIndex(self.compoundImagesDir)
+        self.addCleanup(index.Close)
+        return index
+
+    def testRebuildMissing(self):
+        compoundPath = self.Touch("C0001___B1.JPG")
+        self.Touch("notes.txt")
+        index = self.Open()
+        self.assertTrue(path.exists(self.dbPath))
+        self.assertEqual(index.Lookup("P0001.JPG"), compoundPath)
+        self.assertIsNone(index.Lookup("P0002.JPG"))
+        self.assertEqual(len(index.entries), 1)
+
+    def testRebuildCorrupt(self):
+        compoundPath = self.Touch("C0001___B1.JPG")
+        with open(self.dbPath, "wb") as f:
+            f.write("this is not a database" * 100)
+        index = self.Open()
+        self.assertEqual(index.Lookup("P0001.JPG"), compoundPath)
+
+    def testSetPersists(self):
+        self.Touch("C0001___B1.JPG")
+        index = self.Open()
+        self.assertEqual(index.Set("P0001.JPG", "B2.JPG", (20.0, 30.0)),
+                         path.join(self.compoundImagesDir, "C0001___B1.JPG"))
+        self.assertIsNone(index.Set("P0002.JPG", "B1.JPG"))
+        index.Close()
+        # the files are not rescanned when the index exists, it is the only record of the current compounds
+        index = self.Open()
+        self.assertEqual(index.Lookup("P0001.JPG"), path.join(self.compoundImagesDir, "C0001___B2.JPG"))
+        self.assertEqual(index.Lookup("P0002.JPG"), path.join(self.compoundImagesDir, "C0002___B1.JPG"))
+        self.assertEqual(index.entries["0001"], ("C0001___B2.JPG", "B2.JPG", 20.0, 30.0))
+
+    def testRebuildSeveralCompounds(self):
+        # the most recently written compound image is the current one, whatever the order of names
+        for newer, older in (("B2", "B1"), ("B1", "B2")):
+            self.Touch("C0001___%s.JPG" % older, mtime=1000000000)
+            newerPath = self.Touch("C0001___%s.JPG" % newer, mtime=1000000100)
+            index = self.Open()
+            self.assertEqual(index.Lookup("P0001.JPG"), newerPath)
+            self.assertEqual(index.entries["0001"][1], newer + ".JPG")
+            index.Close()
+            os.remove(self.dbPath)
+
+
+if __name__ == '__main__':
+    unittest.main()
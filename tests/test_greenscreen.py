@@ -0,0 +1,159 @@
+"""
+Tests of the green screen keying in greenscreen.py
+
+Run from the repository root with: python -m unittest discover tests
+"""
+
+import unittest
+
+import numpy as np
+from PIL import Image
+
+import greenscreen
+
+# green screen (40, 200, 60) as returned by GetRefColor()
+RefColors = (np.array([40, 200, 60], dtype=np.uint8), np.array([136, 85, 59], dtype=np.uint8))
+
+
+def _TestImages(width, height, seed=0):
+    """ Foreground with screen, screen-like and other pixels, and a random background, as HxWx3 uint8 arrays """
+    rng = np.random.RandomState(seed)
+    fgNp = rng.randint(0, 256, (height, width, 3)).astype(np.uint8)
+    kind = rng.rand(height, width)
+    fgNp[kind < 0.4] = RefColors[0]
+    # pixels in and around the transition range of the mask
+    nearScreen = (kind >= 0.4) & (kind < 0.7)
+    noise = rng.randint(-40, 41, (np.count_nonzero(nearScreen), 3))
+    fgNp[nearScreen] = np.clip(RefColors[0].astype(np.int32) + noise, 0, 255)
+    bgNp = rng.randint(0, 256, (height, width, 3)).astype(np.uint8)
+    return fgNp, bgNp
+
+
+def _BaselineOverlay(fgNp, bgNp, refColors, tolA, tolB):
+    """ Overlay() as it was before the band-wise kernel, which had no mask smoothing """
+    R, G, B = [fgNp[:, :, c].astype(np.float32) for c in range(3)]
+    cb = 128. - 0.169 * R - 0.331 * G + 0.5 * B
+    cr = 128. + 0.5 * R - 0.419 * G - 0.081 * B
+    colDist = np.sqrt((cb - refColors[1][1]) ** 2 + (cr - refColors[1][2]) ** 2)
+    mask = np.zeros(fgNp.shape[:2])
+    mask[colDist < tolB] = 1.0 - (colDist[colDist < tolB] - tolA) / (tolB - tolA)
+    mask[colDist < tolA] = 1.0
+    return ((1.0 - mask[:, :, np.newaxis])
+            * np.maximum(fgNp - mask[:, :, np.newaxis] * refColors[0][np.newaxis, np.newaxis, :], 0)
+            + mask[:, :, np.newaxis] * bgNp).astype(np.uint8)
+
+
+def _KeyMask(rgbNp, refColorYCbCr, tolA, tolB):
+    height, width = rgbNp.shape[:2]
+    mask = np.empty((height, width), dtype=np.float32)
+    return greenscreen.KeyMask(rgbNp, refColorYCbCr, tolA, tolB, mask,
+                               np.empty((2, height, width), dtype=np.float32))
+
+
+def _KeyMaskLUT(rgbNp, alphaLUT):
+    height, width = rgbNp.shape[:2]
+    mask = np.empty((height, width), dtype=np.float32)
+    return greenscreen.KeyMaskLUT(rgbNp, alphaLUT, mask, np.empty((2, height, width), dtype=np.float32))
+
+
+class KeyMaskLUTTest(unittest.TestCase):
+
+    def testSaturatedColors(self):
+        # pure red, green and blue have Cb or Cr at the edge of the table
+        rgbNp = np.array([[[255, 0, 0], [0, 255, 0], [0, 0, 255], [255, 255, 255], [0, 0, 0]]], dtype=np.uint8)
+        for refColorYCbCr in ([0, 43, 21], [0, 85, 255], [0, 255, 107], [0, 128, 128]):
+            refColorYCbCr = np.array(refColorYCbCr, dtype=np.uint8)
+            for tolA, tolB in ((30., 40.), (35., 35.)):
+                alphaLUT = greenscreen.MakeAlphaLUT(refColorYCbCr, tolA, tolB)
+                expected = _KeyMask(rgbNp, refColorYCbCr, tolA, tolB)
+                np.testing.assert_allclose(_KeyMaskLUT(rgbNp, alphaLUT), expected, atol=0.15)
+
+
+class OverlayTest(unittest.TestCase):
+
+    def testMatchesBaseline(self):
+        fgNp, bgNp = _TestImages(97, 61)
+        for tolA, tolB in ((30., 40.), (20., 45.)):
+            composite = np.asarray(greenscreen.Overlay(fgNp, bgNp, RefColors, tolA, tolB, filterRadius=0))
+            expected = _BaselineOverlay(fgNp, bgNp, RefColors, tolA, tolB)
+            self.assertLessEqual(np.abs(composite.astype(np.int16) - expected).max(), 1)
+
+
+class BandTest(unittest.TestCase):
+    """ Results must not depend on how the image is split into bands """
+
+    def setUp(self):
+        # many bands even for small test images
+        self.savedBandRows = greenscreen.OverlayBandRows
+        greenscreen.OverlayBandRows = 16
+
+    def tearDown(self):
+        greenscreen.OverlayBandRows = self.savedBandRows
+
+    def testThreads(self):
+        fgNp, bgNp = _TestImages(83, 150)
+        for filterRadius in (0, 1, 3):
+            expected = np.asarray(greenscreen.Overlay(fgNp, bgNp, RefColors, filterRadius=filterRadius))
+            keyed = greenscreen.KeyForeground(fgNp, RefColors, filterRadius=filterRadius)
+            expectedKeyed = np.asarray(keyed.Composite(bgNp))
+            for nThreads in (2, 3):
+                composite = greenscreen.Overlay(fgNp, bgNp, RefColors, filterRadius=filterRadius, nThreads=nThreads)
+                np.testing.assert_array_equal(np.asarray(composite), expected)
+                keyed = greenscreen.KeyForeground(fgNp, RefColors, filterRadius=filterRadius, nThreads=nThreads)
+                np.testing.assert_array_equal(np.asarray(keyed.Composite(bgNp, nThreads=nThreads)), expectedKeyed)
+
+    def testFilterHalo(self):
+        # bands are smoothed with halo rows from their neighbours, the result must equal smoothing the whole image
+        fgNp, bgNp = _TestImages(83, 150)
+        for filterRadius in (1, 2, 3, 7):
+            banded = np.asarray(greenscreen.Overlay(fgNp, bgNp, RefColors, filterRadius=filterRadius))
+            bandedMask = greenscreen.KeyForeground(fgNp, RefColors, filterRadius=filterRadius).mask
+            greenscreen.OverlayBandRows = 10 ** 6
+            whole = np.asarray(greenscreen.Overlay(fgNp, bgNp, RefColors, filterRadius=filterRadius))
+            wholeMask = greenscreen.KeyForeground(fgNp, RefColors, filterRadius=filterRadius).mask
+            greenscreen.OverlayBandRows = 16
+            np.testing.assert_array_equal(banded, whole)
+            np.testing.assert_array_equal(bandedMask, wholeMask)
+
+    def testStreaming(self):
+        fgNp, bgNp = _TestImages(83, 150)
+        alphaLUT = greenscreen.MakeAlphaLUT(RefColors[1])
+        for filterRadius in (0, 2):
+            for lut in (None, alphaLUT):
+                expected = np.asarray(greenscreen.Overlay(fgNp, bgNp, RefColors, filterRadius=filterRadius,
+                                                          alphaLUT=lut))
+                # bands of a few rows, smaller than those of Overlay()
+                memoryBudget = 7 * 83 * (4 * greenscreen.OverlayWorkPlanes(filterRadius) +
+                                         greenscreen._StreamingBandBytesPerPixel)
+                for fgImage in (fgNp, Image.fromarray(fgNp, "RGB")):
+                    for nThreads in (1, 2):
+                        composite = greenscreen.OverlayStreaming(fgImage, bgNp, RefColors, alphaLUT=lut,
+                                                                 nThreads=nThreads, memoryBudget=memoryBudget,
+                                                                 filterRadius=filterRadius)
+                        np.testing.assert_array_equal(np.asarray(composite), expected)
+
+
+class KeyForegroundTest(unittest.TestCase):
+
+    def AssertMatchesOverlay(self, width, height, filterRadius):
+        fgNp, bgNp = _TestImages(width, height, seed=width * 1000 + height)
+        keyed = greenscreen.KeyForeground(fgNp, RefColors, filterRadius=filterRadius)
+        composite = np.asarray(keyed.Composite(bgNp)).astype(np.int16)
+        expected = np.asarray(greenscreen.Overlay(fgNp, bgNp, RefColors, filterRadius=filterRadius))
+        # see KeyedForeground
+        self.assertLessEqual(np.abs(composite - expected).max(), 1)
+
+    def testNoFilter(self):
+        self.AssertMatchesOverlay(64, 48, filterRadius=0)
+
+    def testFilter(self):
+        self.AssertMatchesOverlay(64, 48, filterRadius=2)
+
+    def testTinyImages(self):
+        # the filter radius is clamped to 0
+        for width, height in ((1, 1), (2, 5), (7, 2)):
+            self.AssertMatchesOverlay(width, height, filterRadius=1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,122 @@
+"""
+Tests of the print spooler in printing.py, against stub lpr and lpstat commands
+
+Run from the repository root with: python -m unittest discover tests
+"""
+
+import os
+import shutil
+import stat
+import tempfile
+import threading
+import unittest
+from os import path
+
+from PIL import Image
+
+import printing
+
+# logs its arguments and keeps a copy of the file to print, fails as long as fewer than $STUB_LPR_FAILURES calls
+# have been logged before
+_StubLpr = """#!/bin/sh
+echo "$@" >> "$STUB_LPR_LOG"
+for last; do :; done
+cp "$last" "$STUB_LPR_LOG.jpg"
+test $(wc -l < "$STUB_LPR_LOG") -gt "$STUB_LPR_FAILURES"
+"""
+
+_StubLpstat = """#!/bin/sh
+exit 0
+"""
+
+
+class PrintSpoolerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        binDir = path.join(self.tmpDir, "bin")
+        os.mkdir(binDir)
+        for name, script in (("lpr", _StubLpr), ("lpstat", _StubLpstat)):
+            scriptPath = path.join(binDir, name)
+            with open(scriptPath, "w") as f:
+                f.write(script)
+            os.chmod(scriptPath, stat.S_IRWXU)
+        self.savedEnviron = dict(os.environ)
+        os.environ["PATH"] = binDir + os.pathsep + os.environ.get("PATH", "")
+        self.lprLog = os.environ["STUB_LPR_LOG"] = path.join(self.tmpDir, "lpr.log")
+
+        self.printedImagesDir = path.join(self.tmpDir, "printed")
+        os.mkdir(self.printedImagesDir)
+        self.imgPath = path.join(self.tmpDir, "C1234567___Background1.JPG")
+        Image.new("RGB", (120, 80), (0, 128, 255)).save(self.imgPath)
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.savedEnviron)
+        shutil.rmtree(self.tmpDir)
+
+    def Print(self, nFailures, nAttempts=3, waitFunc=None):
+        """ Print the test image with lpr failing nFailures times; returns the final PrintStatus """
+        os.environ["STUB_LPR_FAILURES"] = str(nFailures)
+        done = threading.Event()
+        statuses = []
+
+        def OnStatus(status):
+            statuses.append(status)
+            if status.nQueued == 0 and status.lastJobOK is not None:
+                done.set()
+
+        spooler = printing.PrintSpooler(self.printedImagesDir, ["-o", "landscape"], printerName="Stub",
+                                        pageSizeMM=(50.8, 25.4), dpi=100, nAttempts=nAttempts, retryDelay=0.0,
+                                        statusPollInterval=0.1, onStatus=OnStatus)
+        try:
+            spooler.Submit(self.imgPath, waitFunc)
+            self.assertTrue(done.wait(30.0))
+        finally:
+            spooler.Stop()
+        return statuses[-1]
+
+    def LprCalls(self):
+        with open(self.lprLog) as f:
+            return f.read().splitlines()
+
+    def testSuccess(self):
+        status = self.Print(nFailures=0)
+        self.assertTrue(status.lastJobOK)
+        self.assertEqual(str(status), "Print queue: 0")
+        calls = self.LprCalls()
+        self.assertEqual(len(calls), 1)
+        args = calls[0].split()
+        self.assertEqual(args[:4], ["-P", "Stub", "-o", "landscape"])
+        # the rendered page is printed from a temporary file, the original is kept as a backup
+        self.assertIn("_print_", args[-1])
+        self.assertFalse(path.exists(args[-1]))
+        self.assertEqual(Image.open(self.lprLog + ".jpg").size, (200, 100))
+        self.assertEqual(len(os.listdir(self.printedImagesDir)), 1)
+        self.assertTrue(os.listdir(self.printedImagesDir)[0].endswith("_C1234567___Background1.JPG"))
+
+    def testWaitFuncPath(self):
+        # the compound image was replaced by one with another background while the job was queued
+        newImgPath = path.join(self.tmpDir, "C1234567___Background2.JPG")
+        os.rename(self.imgPath, newImgPath)
+        status = self.Print(nFailures=0, waitFunc=lambda: newImgPath)
+        self.assertTrue(status.lastJobOK)
+        self.assertTrue(self.LprCalls()[0].endswith("_print_C1234567___Background2.JPG"))
+        self.assertTrue(os.listdir(self.printedImagesDir)[0].endswith("_C1234567___Background2.JPG"))
+
+    def testRetry(self):
+        status = self.Print(nFailures=2)
+        self.assertTrue(status.lastJobOK)
+        self.assertEqual(len(self.LprCalls()), 3)
+
+    def testFailure(self):
+        status = self.Print(nFailures=5)
+        self.assertFalse(status.lastJobOK)
+        self.assertIn("Error printing", str(status))
+        calls = self.LprCalls()
+        self.assertEqual(len(calls), 3)
+        self.assertFalse(path.exists(calls[-1].split()[-1]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,204 @@
+"""
+Watching photo directories for new image files
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import time
+from os import path
+
+# inotify event flags, see inotify(7)
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_Q_OVERFLOW = 0x00004000
+_InotifyEventHeader = struct.Struct("iIII")
+
+
+def IsPhotoFile(fileName):
+    return fileName.lower().endswith(".jpg")
+
+
+class _Inotify(object):
+    """ Minimal ctypes wrapper around Linux inotify; raises OSError if it is not available """
+
+    def __init__(self):
+        libcName = ctypes.util.find_library("c")
+        if libcName is None:
+            raise OSError(errno.ENOSYS, "libc not found")
+        libc = ctypes.CDLL(libcName, use_errno=True)
+        if not hasattr(libc, "inotify_init"):
+            raise OSError(errno.ENOSYS, "inotify not available")
+        self.libc = libc
+        self.fd = libc.inotify_init()
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init failed")
+        self.dirs = {}
+
+    def AddWatch(self, dirPath, mask):
+        wd = self.libc.inotify_add_watch(self.fd, dirPath, mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_add_watch failed for " + dirPath)
+        self.dirs[wd] = dirPath
+
+    def Read(self, timeout):
+        """ Return list of (directory, file name, mask) for events arriving within 'timeout' seconds """
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        data = os.read(self.fd, 64 * 1024)
+        events = []
+        pos = 0
+        while pos + _InotifyEventHeader.size <= len(data):
+            wd, mask, _, nameLen = _InotifyEventHeader.unpack_from(data, pos)
+            pos += _InotifyEventHeader.size
+            name = data[pos:pos + nameLen].rstrip(b"\0")
+            pos += nameLen
+            events.append((self.dirs.get(wd), name, mask))
+        return events
+
+    def Close(self):
+        os.close(self.fd)
+
+
+class PhotoDirWatcher(object):
+    """
+    Reports photo files newly added to a set of directories, in batches.
+
+    Uses inotify where available, so new files are reported as soon as the writer closes them.
+    Elsewhere, and for directories that cannot be watched, e.g. because they do not exist yet, it falls
+    back to polling: a directory is only listed again when its modification time changes, and a new
+    file is reported once its size and modification time have not changed for 'settleTime' seconds,
+    i.e. when the upload has finished.
+
+    Args:
+        dirs (list): directories to watch
+        settleTime (float): seconds a polled file must be unchanged before it is reported
+        batchWindow (float): after a first inotify event, further events arriving within this time
+                             are reported in the same batch
+    """
+
+    def __init__(self, dirs, settleTime=1.0, batchWindow=0.05):
+        self.dirs = list(dirs)
+        self.settleTime = settleTime
+        self.batchWindow = batchWindow
+        self.known = set()
+        self.dirMTimes = {}
+        self.candidates = {}  # file path -> (size, mtime, time of first observation with this state)
+
+        # directories without an inotify watch
+        self.polledDirs = list(self.dirs)
+        try:
+            self.inotify = _Inotify()
+        except (OSError, AttributeError):
+            self.inotify = None
+        if self.inotify is not None:
+            for d in self.dirs:
+                try:
+                    self.inotify.AddWatch(d, IN_CLOSE_WRITE | IN_MOVED_TO)
+                    self.polledDirs.remove(d)
+                except OSError as e:
+                    print "Polling %s instead of watching it: %s" % (d, e)
+            if len(self.polledDirs) == len(self.dirs):
+                self.Close()
+
+        # files present at start-up, with watches already in place so nothing falls through the cracks;
+        # directories that cannot be listed yet are left to _ScanDirs()
+        self.initialFiles = []
+        for d in self.dirs:
+            try:
+                mtime = path.getmtime(d)
+                names = sorted(n for n in os.listdir(d) if IsPhotoFile(n))
+            except OSError as e:
+                print "Cannot list %s yet: %s" % (d, e)
+                continue
+            self.initialFiles += [path.join(d, n) for n in names]
+            self.dirMTimes[d] = mtime
+        self.known.update(self.initialFiles)
+
+    def WaitForNewFiles(self, timeout):
+        """
+        Block for up to 'timeout' seconds, return list of newly added photo files (may be empty).
+        Directories without inotify watch are polled once after 'timeout' seconds.
+        """
+        if self.inotify is None:
+            time.sleep(timeout)
+            return self._Poll()
+        added = self._WaitInotify(timeout)
+        if len(self.polledDirs) > 0:
+            added += self._Poll()
+        return added
+
+    def _WaitInotify(self, timeout):
+        events = self.inotify.Read(timeout)
+        if len(events) == 0:
+            return []
+        # collect events arriving shortly after the first one into the same batch
+        while True:
+            more = self.inotify.Read(self.batchWindow)
+            if len(more) == 0:
+                break
+            events += more
+
+        added = []
+        for dirPath, name, mask in events:
+            if mask & IN_Q_OVERFLOW:
+                # events were lost, fall back to a full comparison with the directory contents
+                self.dirMTimes = {}
+                added += self._ScanDirs(self.dirs, requireSettled=False)
+                continue
+            if dirPath is None or not IsPhotoFile(name):
+                continue
+            filePath = path.join(dirPath, name)
+            if filePath not in self.known:
+                self.known.add(filePath)
+                added.append(filePath)
+        return added
+
+    def _Poll(self):
+        return self._ScanDirs(self.polledDirs, requireSettled=True)
+
+    def _ScanDirs(self, dirs, requireSettled):
+        now = time.time()
+        for d in dirs:
+            try:
+                mtime = path.getmtime(d)
+                # with coarse timestamps, later changes within the same second do not alter the mtime
+                if self.dirMTimes.get(d) == mtime and now - mtime > 2.0:
+                    continue
+                names = os.listdir(d)
+            except OSError:
+                continue
+            self.dirMTimes[d] = mtime
+            for name in names:
+                filePath = path.join(d, name)
+                if IsPhotoFile(name) and filePath not in self.known and filePath not in self.candidates:
+                    self.candidates[filePath] = None
+
+        added = []
+        for filePath, prevState in self.candidates.items():
+            try:
+                st = os.stat(filePath)
+            except OSError:
+                # file vanished again
+                del self.candidates[filePath]
+                continue
+            state = (st.st_size, st.st_mtime)
+            if prevState is None or prevState[:2] != state:
+                self.candidates[filePath] = state + (now,)
+                if requireSettled:
+                    continue
+            elif now - prevState[2] < self.settleTime:
+                continue
+            del self.candidates[filePath]
+            self.known.add(filePath)
+            added.append(filePath)
+        return sorted(added)
+
+    def Close(self):
+        if self.inotify is not None:
+            self.inotify.Close()
+            self.inotify = None